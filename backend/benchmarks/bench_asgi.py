@@ -0,0 +1,187 @@
+'''
+Compares the ASGI mode (flaskr/asgi.py under uvicorn) with the WSGI app under a threaded server for
+the routes the ASGI mode answers asynchronously: GET /questions, search and POST /quizzes. Each
+server runs in its own process with a single worker, and is hit by an increasing number of
+concurrent clients; for each level the throughput, latency percentiles and errors are reported.
+
+Needs Postgres and the optional asyncpg, asgiref and uvicorn packages. Use a database seeded by
+bench_load.py, e.g.:
+    python benchmarks/bench_load.py --database-url postgresql://... --seed --questions 100000 --mode test_client
+    python benchmarks/bench_asgi.py --database-url postgresql://... --output asgi.json
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, BACKEND)
+
+from bench_load import WORDS, LATENCY_PERCENTILES, QuietRequestHandler, git_commit, percentile
+
+ROW_FORMAT = '{:<6} {:>6} {:<14} {:>6} {:>6} {:>9} {:>9} {:>9} {:>9}'
+
+
+def serve_wsgi(database_url, port):
+    ''' Runs the WSGI app on a threaded werkzeug server, in the subprocess started by start_server '''
+    from werkzeug.serving import make_server
+    from flaskr import create_app
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_url})
+    make_server('127.0.0.1', port, app, threaded=True, request_handler=QuietRequestHandler).serve_forever()
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_server(kind, database_url):
+    ''' Starts the WSGI or ASGI server in a subprocess and waits until it accepts connections '''
+    port = free_port()
+    if kind == 'wsgi':
+        command = [sys.executable, os.path.abspath(__file__), '--serve-wsgi', str(port), '--database-url', database_url]
+    else:
+        command = [sys.executable, '-m', 'uvicorn', '--factory', 'flaskr.asgi:create_asgi_app',
+                   '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning', '--no-access-log']
+    process = subprocess.Popen(command, cwd=BACKEND, env=dict(os.environ, DATABASE_URL=database_url))
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise SystemExit('the {} server did not start'.format(kind))
+
+
+async def send_request(port, method, path, body=None):
+    ''' Sends one HTTP/1.1 request on a new connection and returns the status code and body '''
+    payload = json.dumps(body).encode('utf-8') if body is not None else b''
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write('{} {} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n'
+                     'Content-Type: application/json\r\nContent-Length: {}\r\n\r\n'
+                     .format(method, path, len(payload)).encode('latin-1') + payload)
+        response = await reader.read()
+    finally:
+        writer.close()
+    head, _, content = response.partition(b'\r\n\r\n')
+    return int(head.split(b' ', 2)[1]), content
+
+
+async def drive(port, make_request, requests, concurrency, rng):
+    ''' Sends requests from concurrency clients, returns the latencies, errors and elapsed time '''
+    latencies = []
+    errors = 0
+    remaining = [requests]
+
+    async def client():
+        nonlocal errors
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            method, path, body = make_request(rng)
+            started = time.perf_counter()
+            try:
+                status, _ = await send_request(port, method, path, body)
+            except (OSError, ValueError, IndexError):
+                status = 599
+            latencies.append(time.perf_counter() - started)
+            errors += status >= 400
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def scenarios(total_questions, categories):
+    pages = max(1, total_questions // 10)
+
+    def quiz_category(rng):
+        if rng.random() < 0.2:
+            return {'type': 'click', 'id': 0}
+        return {'type': 'Category', 'id': rng.randint(1, categories)}
+
+    return [
+        ('list questions', lambda rng: ('GET', '/questions?page={}'.format(rng.randint(1, pages)), None)),
+        ('search', lambda rng: ('POST', '/questions', {'searchTerm': rng.choice(WORDS)})),
+        ('play quiz', lambda rng: ('POST', '/quizzes', {
+            'quiz_category': quiz_category(rng),
+            'previous_questions': [rng.randint(1, total_questions) for _ in range(rng.randint(0, 20))]})),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'), help='Postgres database to use')
+    parser.add_argument('--concurrency', default='8,32,128,256', help='comma separated concurrent client counts')
+    parser.add_argument('--requests', type=int, default=1000, help='requests per route and concurrency level')
+    parser.add_argument('--random-seed', type=int, default=1)
+    parser.add_argument('--output', help='file to write the JSON results to')
+    parser.add_argument('--serve-wsgi', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if not args.database_url:
+        raise SystemExit('pass --database-url or set DATABASE_URL')
+    if args.serve_wsgi:
+        serve_wsgi(args.database_url, args.serve_wsgi)
+        return
+
+    levels = [int(level) for level in args.concurrency.split(',')]
+    results = []
+    print(ROW_FORMAT.format('server', 'conc', 'route', 'reqs', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'),
+          file=sys.stderr)
+
+    for kind in ('wsgi', 'asgi'):
+        process, port = start_server(kind, args.database_url)
+        try:
+            loop = asyncio.new_event_loop()
+            _, content = loop.run_until_complete(send_request(port, 'GET', '/questions'))
+            first_page = json.loads(content)
+            routes = scenarios(first_page['total_questions'], len(first_page['categories']))
+
+            for level in levels:
+                for name, make_request in routes:
+                    rng = random.Random(args.random_seed)
+                    latencies, errors, elapsed = loop.run_until_complete(
+                        drive(port, make_request, args.requests, level, rng))
+                    ordered = sorted(latencies)
+                    result = {
+                        'server': kind,
+                        'concurrency': level,
+                        'route': name,
+                        'requests': len(ordered),
+                        'errors': errors,
+                        'throughput_rps': round(len(ordered) / elapsed, 1),
+                        'latency_ms': {'p{}'.format(percent): round(percentile(ordered, percent) * 1000, 3)
+                                       for percent in LATENCY_PERCENTILES},
+                    }
+                    results.append(result)
+                    print(ROW_FORMAT.format(kind, level, name, result['requests'], errors, result['throughput_rps'],
+                                            result['latency_ms']['p50'], result['latency_ms']['p95'],
+                                            result['latency_ms']['p99']), file=sys.stderr)
+            loop.close()
+        finally:
+            process.terminate()
+            process.wait()
+
+    output = {'meta': {'commit': git_commit(), 'requests_per_route': args.requests}, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(output, output_file, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,549 @@
+'''
+Load test for the API routes. Seeds a database with a configurable number of questions and
+categories, then drives every route (question listings, cursor pages, category listings and stats,
+search, suggestions, quizzes and quiz sessions, export, add and delete, bulk import, update and
+delete) first through the Flask test client and then through a real threaded WSGI server hit by
+concurrent clients. For each route it reports throughput, latency
+percentiles and the SQL statements run per request (read from the app's own metrics), as JSON that
+can be saved and compared across commits. Requests shed by admission control are counted apart from
+the errors and left out of the latencies, so a run over the limits shows as shed, not as failing.
+
+The write scenarios only touch the questions they added themselves and delete them again, so the
+dataset is the same after a run. The database is the one from DATABASE_URL or the DB_* environment variables unless --database-url is given, and
+--seed DELETES EVERY QUESTION AND CATEGORY in it before seeding, so point it at a scratch database.
+SQLite works too, e.g. --database-url sqlite:////tmp/trivia-bench.db
+
+From the backend folder run:
+    python benchmarks/bench_load.py --seed --questions 100000 --categories 50 --output before.json
+    python benchmarks/bench_load.py --output after.json
+    python benchmarks/bench_load.py --compare before.json after.json
+'''
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import func
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from models import db, database_url, Question, Category
+from flaskr import create_app
+from flaskr.pagination import encode_cursor
+
+WORDS = ('actor', 'album', 'ancient', 'animal', 'army', 'artist', 'atlas', 'author', 'ball', 'band',
+         'battle', 'bird', 'border', 'bridge', 'canal', 'capital', 'castle', 'cell', 'century', 'champion',
+         'chemical', 'city', 'climate', 'coast', 'comet', 'composer', 'country', 'crown', 'dance', 'desert',
+         'dynasty', 'earth', 'element', 'emperor', 'empire', 'energy', 'engine', 'film', 'flag', 'forest',
+         'fossil', 'galaxy', 'game', 'gene', 'goal', 'gold', 'gravity', 'harbor', 'hero', 'island',
+         'king', 'lake', 'language', 'league', 'legend', 'light', 'machine', 'map', 'medal', 'metal',
+         'molecule', 'moon', 'mountain', 'museum', 'music', 'nation', 'novel', 'ocean', 'opera', 'orbit',
+         'painter', 'painting', 'planet', 'poem', 'poet', 'president', 'queen', 'record', 'republic', 'river',
+         'rocket', 'scientist', 'sculpture', 'season', 'ship', 'singer', 'song', 'species', 'sport', 'star',
+         'statue', 'team', 'temple', 'theory', 'tournament', 'tower', 'treaty', 'valley', 'volcano', 'war')
+SEED_BATCH_SIZE = 10000
+LATENCY_PERCENTILES = (50, 90, 95, 99)
+# answers of the questions the add and bulk import scenarios create, so they can be found and deleted again
+ADD_ANSWER = 'Load test'
+IMPORT_ANSWER = 'Load test import'
+IMPORT_ROWS = 10
+BULK_DELETE_IDS = 10
+
+# a request body that isn't JSON, e.g. an NDJSON upload
+Upload = namedtuple('Upload', 'mimetype data')
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    ''' Request handler that doesn't log every request to stderr '''
+
+    def log(self, *args):
+        pass
+
+
+def seed(app, questions, categories, random_seed):
+    ''' Replaces every question and category with generated ones '''
+    rng = random.Random(random_seed)
+
+    with app.app_context():
+        # a new database, e.g. a SQLite file, has no tables yet
+        db.create_all()
+        db.session.query(Question).delete()
+        db.session.query(Category).delete()
+        # ids from 1 like the sample data, the listing shows category 1 as the current one
+        db.session.execute(Category.__table__.insert(),
+                           [{'id': number, 'type': 'Category {}'.format(number)} for number in range(1, categories + 1)])
+        db.session.commit()
+        category_ids = [row[0] for row in db.session.query(Category.id).order_by(Category.id)]
+
+        for start in range(0, questions, SEED_BATCH_SIZE):
+            db.session.execute(Question.__table__.insert(), [
+                {'question': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 10))).capitalize() + '?',
+                 'answer': rng.choice(WORDS).capitalize(),
+                 'difficulty': rng.randint(1, 5),
+                 'category': rng.choice(category_ids)}
+                for _ in range(start, min(start + SEED_BATCH_SIZE, questions))
+            ])
+            db.session.commit()
+            print('seeded {} questions'.format(min(start + SEED_BATCH_SIZE, questions)), file=sys.stderr)
+
+        app.extensions['question_counts'].rebuild()
+        app.extensions['dataset_version'].bump()
+        db.session.commit()
+
+
+def load_dataset(app):
+    ''' Reads what the scenarios need to know about the database '''
+    with app.app_context():
+        category_ids = [row[0] for row in db.session.query(Category.id).order_by(Category.id)]
+        lowest, highest, total = db.session.query(func.min(Question.id), func.max(Question.id),
+                                                  func.count(Question.id)).one()
+
+    if not category_ids or not total:
+        raise SystemExit('the database has no questions or categories, run with --seed first')
+
+    return {
+        'category_ids': category_ids,
+        'lowest_id': lowest,
+        'highest_id': highest,
+        'questions': total,
+        # ids added by the add phase, deleted again by the delete phase
+        'added_ids': [],
+        # ids of the bulk imported questions, deleted again by the bulk delete phase
+        'imported_ids': [],
+        'session_ids': []
+    }
+
+
+def scenarios(dataset, per_page):
+    ''' The routes to load, as (name, metrics route label, request factory) tuples
+
+    A request factory takes a random.Random and returns (method, path, JSON body, Upload or None), or None
+    once there is nothing left to request.
+    '''
+    category_ids = dataset['category_ids']
+    pages = max(1, dataset['questions'] // per_page)
+    category_pages = max(1, pages // len(category_ids))
+
+    def quiz_category(rng):
+        # the frontend sends 0-indexed category ids, or type 'click' for all categories
+        if rng.random() < 0.2:
+            return {'type': 'click', 'id': 0}
+        category_id = rng.choice(category_ids)
+        return {'type': 'Category', 'id': category_id - 1}
+
+    def previous_questions(rng):
+        return [rng.randint(dataset['lowest_id'], dataset['highest_id']) for _ in range(rng.randint(0, 20))]
+
+    def delete_added(rng):
+        try:
+            return 'DELETE', '/questions/{}'.format(dataset['added_ids'].pop()), None
+        except IndexError:
+            return None
+
+    def next_in_session(rng):
+        if not dataset['session_ids']:
+            return None
+        return 'POST', '/quizzes/sessions/{}/next'.format(rng.choice(dataset['session_ids'])), None
+
+    def bulk_import(rng):
+        rows = [{'question': 'Load test import {}?'.format(rng.random()), 'answer': IMPORT_ANSWER,
+                 'difficulty': rng.randint(1, 5), 'category': rng.choice(category_ids)} for _ in range(IMPORT_ROWS)]
+        return 'POST', '/questions/bulk', Upload('application/x-ndjson', '\n'.join(json.dumps(row) for row in rows))
+
+    def bulk_update_imported(rng):
+        if not dataset['imported_ids']:
+            return None
+        ids = rng.sample(dataset['imported_ids'], min(BULK_DELETE_IDS, len(dataset['imported_ids'])))
+        return 'PATCH', '/questions', {'ids': ids, 'set': {'difficulty': rng.randint(1, 5)}}
+
+    def bulk_delete_imported(rng):
+        ids = dataset['imported_ids'][-BULK_DELETE_IDS:]
+        if not ids:
+            return None
+        del dataset['imported_ids'][-BULK_DELETE_IDS:]
+        return 'DELETE', '/questions', {'ids': ids}
+
+    return [
+        ('list categories', '/categories',
+         lambda rng: ('GET', '/categories', None)),
+        ('list questions by page', '/questions',
+         lambda rng: ('GET', '/questions?page={}'.format(rng.randint(1, pages)), None)),
+        ('list questions by cursor', '/questions',
+         lambda rng: ('GET', '/questions?after={}'.format(
+             encode_cursor(rng.randint(dataset['lowest_id'], dataset['highest_id']))), None)),
+        ('list category questions', '/categories/<int:id>/questions',
+         lambda rng: ('GET', '/categories/{}/questions?page={}'.format(
+             rng.choice(category_ids), rng.randint(1, category_pages)), None)),
+        ('category stats', '/categories/stats',
+         lambda rng: ('GET', '/categories/stats', None)),
+        ('search questions', '/questions',
+         lambda rng: ('POST', '/questions', {'searchTerm': rng.choice(WORDS)})),
+        ('suggest questions', '/questions/suggest',
+         lambda rng: ('GET', '/questions/suggest?q={}'.format(rng.choice(WORDS)[:3]), None)),
+        ('suggest index stats', '/questions/suggest/stats',
+         lambda rng: ('GET', '/questions/suggest/stats', None)),
+        ('export category', '/questions/export',
+         lambda rng: ('GET', '/questions/export?category={}'.format(rng.choice(category_ids)), None)),
+        ('play quiz', '/quizzes',
+         lambda rng: ('POST', '/quizzes', {'quiz_category': quiz_category(rng),
+                                           'previous_questions': previous_questions(rng)})),
+        ('play quiz batch', '/quizzes/batch',
+         lambda rng: ('POST', '/quizzes/batch', {'quiz_category': quiz_category(rng),
+                                                 'previous_questions': previous_questions(rng), 'count': 10})),
+        ('start quiz session', '/quizzes/sessions',
+         lambda rng: ('POST', '/quizzes/sessions', {'quiz_category': quiz_category(rng),
+                                                    'previous_questions': previous_questions(rng)})),
+        ('next quiz session question', '/quizzes/sessions/<session_id>/next', next_in_session),
+        ('add question', '/add_question',
+         lambda rng: ('POST', '/add_question', {'question': 'Load test question {}?'.format(rng.random()),
+                                                'answer': ADD_ANSWER, 'difficulty': rng.randint(1, 5),
+                                                'category': rng.choice(category_ids) - 1})),
+        ('delete question', '/questions/<question_id>', delete_added),
+        ('bulk import questions', '/questions/bulk', bulk_import),
+        ('bulk update questions', '/questions', bulk_update_imported),
+        ('bulk delete questions', '/questions', bulk_delete_imported),
+    ]
+
+
+def clean_up(app):
+    ''' Deletes the questions the write scenarios added and failed to delete again, e.g. after a shed request '''
+    with app.app_context():
+        left = db.session.query(Question).filter(Question.answer.in_((ADD_ANSWER, IMPORT_ANSWER))).delete(
+            synchronize_session=False)
+        if left:
+            app.extensions['question_counts'].rebuild()
+            app.extensions['dataset_version'].bump()
+        db.session.commit()
+    return left
+
+
+def percentile(ordered, percent):
+    ''' Nearest-rank percentile of an already sorted list '''
+    if not ordered:
+        return None
+    index = max(0, min(len(ordered) - 1, int(round(percent / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def is_shed(status, headers):
+    ''' Whether a response is admission control refusing the request, a 503 with Retry-After '''
+    return status == 503 and headers.get('Retry-After') is not None
+
+
+def summarize(name, route, mode, latencies, errors, shed, elapsed, statements, db_seconds):
+    ''' Turns the raw timings of one route into a result record, latencies are of the requests that weren't shed '''
+    ordered = sorted(latencies)
+    count = len(ordered)
+    return {
+        'mode': mode,
+        'route': name,
+        'rule': route,
+        'requests': count,
+        'errors': errors,
+        'shed': shed,
+        'throughput_rps': round(count / elapsed, 1) if elapsed > 0 else None,
+        'latency_ms': dict(
+            [('p{}'.format(percent), round(percentile(ordered, percent) * 1000, 3) if ordered else None)
+             for percent in LATENCY_PERCENTILES] +
+            [('mean', round(sum(ordered) / count * 1000, 3) if count else None),
+             ('max', round(ordered[-1] * 1000, 3) if ordered else None)]),
+        'queries_per_request': round(statements / count, 2) if count else None,
+        'db_ms_per_request': round(db_seconds / count * 1000, 3) if count else None,
+    }
+
+
+def route_totals(app, route):
+    ''' Returns the SQL statements and database seconds the app recorded so far for a route '''
+    metrics = app.extensions['metrics']
+    labels = (('route', route),)
+    with metrics._lock:
+        statements, _ = metrics.request_statements.totals(labels)
+        db_seconds, _ = metrics.request_db_time.totals(labels)
+    return statements, db_seconds
+
+
+def run_test_client(app, scenario, requests, warmup, rng):
+    ''' Sends the requests of one scenario one after the other through the test client '''
+    name, route, make_request = scenario
+    client = app.test_client()
+
+    def send(request):
+        method, path, body = request
+        started = time.perf_counter()
+        if isinstance(body, Upload):
+            response = client.open(path, method=method, data=body.data, content_type=body.mimetype)
+        else:
+            response = client.open(path, method=method, json=body)
+        payload = response.get_data()
+        # a WSGI server closes the response, which also ends a streamed one and releases its admission slot
+        response.close()
+        latency = time.perf_counter() - started
+        record(app, method, path, response.status_code, payload)
+        return latency, response.status_code, is_shed(response.status_code, response.headers)
+
+    for _ in range(warmup):
+        request = make_request(rng)
+        if request is None:
+            break
+        send(request)
+
+    statements_before, db_before = route_totals(app, route)
+    latencies, errors, shed = [], 0, 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        request = make_request(rng)
+        if request is None:
+            break
+        latency, status, was_shed = send(request)
+        if was_shed:
+            shed += 1
+            continue
+        latencies.append(latency)
+        errors += status >= 400
+    elapsed = time.perf_counter() - started
+    statements_after, db_after = route_totals(app, route)
+
+    return summarize(name, route, 'test_client', latencies, errors, shed, elapsed,
+                     statements_after - statements_before, db_after - db_before)
+
+
+def run_server(app, server, scenario, requests, warmup, concurrency, rng):
+    ''' Sends the requests of one scenario to the WSGI server from concurrent client threads '''
+    name, route, make_request = scenario
+    host, port = server.server_address[:2]
+    lock = threading.Lock()
+
+    def send(request):
+        method, path, body = request
+        if isinstance(body, Upload):
+            headers, data = {'Content-Type': body.mimetype}, body.data
+        elif body is not None:
+            headers, data = {'Content-Type': 'application/json'}, json.dumps(body)
+        else:
+            headers, data = {}, None
+        connection = http.client.HTTPConnection(host, port, timeout=60)
+        started = time.perf_counter()
+        try:
+            connection.request(method, path, body=data, headers=headers)
+            response = connection.getresponse()
+            payload = response.read()
+            status = response.status
+            shed = is_shed(status, response.headers)
+        except (OSError, http.client.HTTPException):
+            return time.perf_counter() - started, 599, False
+        finally:
+            connection.close()
+        latency = time.perf_counter() - started
+        with lock:
+            record(app, method, path, status, payload)
+        return latency, status, shed
+
+    def next_request():
+        # the factories share the random generator and the added ids, so only one thread uses them at a time
+        with lock:
+            return make_request(rng)
+
+    for _ in range(warmup):
+        request = next_request()
+        if request is None:
+            break
+        send(request)
+
+    latencies, errors, shed = [], [0], [0]
+
+    def client(count):
+        for _ in range(count):
+            request = next_request()
+            if request is None:
+                return
+            latency, status, was_shed = send(request)
+            with lock:
+                if was_shed:
+                    shed[0] += 1
+                    continue
+                latencies.append(latency)
+                errors[0] += status >= 400
+
+    shares = [requests // concurrency + (index < requests % concurrency) for index in range(concurrency)]
+    statements_before, db_before = route_totals(app, route)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(client, shares))
+    elapsed = time.perf_counter() - started
+    statements_after, db_after = route_totals(app, route)
+
+    return summarize(name, route, 'wsgi_server', latencies, errors[0], shed[0], elapsed,
+                     statements_after - statements_before, db_after - db_before)
+
+
+def record(app, method, path, status, payload):
+    ''' Remembers what a successful write created, for the scenarios that use or delete it later '''
+    if method != 'POST' or status != 200:
+        return
+    dataset = app.extensions['bench_load_dataset']
+    if path == '/add_question':
+        dataset['added_ids'].append(json.loads(payload)['id'])
+    elif path == '/quizzes/sessions':
+        dataset['session_ids'].append(json.loads(payload)['session_id'])
+    elif path.startswith('/questions/bulk'):
+        # a bulk import doesn't return the new ids, so they are looked up by their answer
+        with app.app_context():
+            dataset['imported_ids'] = [row[0] for row in db.session.query(Question.id).filter(
+                Question.answer == IMPORT_ANSWER).order_by(Question.id)]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+ROW_FORMAT = '{:<12} {:<26} {:>6} {:>6} {:>6} {:>9} {:>9} {:>9} {:>9} {:>8}'
+
+
+def print_header():
+    print(ROW_FORMAT.format('mode', 'route', 'reqs', 'errors', 'shed', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'),
+          file=sys.stderr)
+
+
+def print_result(result):
+    latency = result['latency_ms']
+    print(ROW_FORMAT.format(result['mode'], result['route'], result['requests'], result['errors'], result.get('shed', 0),
+                            str(result['throughput_rps']), str(latency['p50']), str(latency['p95']),
+                            str(latency['p99']), str(result['queries_per_request'])), file=sys.stderr)
+
+
+def compare(before_file, after_file):
+    ''' Prints the change of each route between two saved runs '''
+    with open(before_file) as before_json, open(after_file) as after_json:
+        before, after = json.load(before_json), json.load(after_json)
+
+    previous = {(result['mode'], result['route']): result for result in before['results']}
+    print('{} ({}) -> {} ({})'.format(before_file, before['meta'].get('commit'),
+                                      after_file, after['meta'].get('commit')))
+    print('{:<12} {:<26} {:>18} {:>20} {:>14} {:>10}'.format('mode', 'route', 'req/s', 'p95 ms', 'queries', 'shed'))
+
+    def change(old, new):
+        if old is None or new is None:
+            return '{} -> {}'.format(old, new)
+        percent = (new - old) / old * 100 if old else 0.0
+        return '{} ({:+.0f}%)'.format(new, percent)
+
+    for result in after['results']:
+        old = previous.get((result['mode'], result['route']))
+        if old is None:
+            continue
+        print('{:<12} {:<26} {:>18} {:>20} {:>14} {:>10}'.format(
+            result['mode'], result['route'], change(old['throughput_rps'], result['throughput_rps']),
+            change(old['latency_ms']['p95'], result['latency_ms']['p95']),
+            change(old['queries_per_request'], result['queries_per_request']),
+            # runs saved before shed requests were counted apart have no shed field
+            '{} -> {}'.format(old.get('shed', 0), result.get('shed', 0))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url',
+                        help='database to load, the one from DATABASE_URL or the DB_* environment variables by default')
+    parser.add_argument('--seed', action='store_true',
+                        help='delete every question and category and generate new ones first')
+    parser.add_argument('--questions', type=int, default=1000, help='questions to seed, e.g. 1000, 100000, 1000000')
+    parser.add_argument('--categories', type=int, default=20, help='categories to seed')
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per route and mode')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests per route and mode')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients against the WSGI server')
+    parser.add_argument('--mode', choices=('test_client', 'wsgi_server', 'both'), default='both')
+    parser.add_argument('--no-response-cache', action='store_true',
+                        help='disable the response cache, so every read goes to the database')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='serve the listings and quizzes from the in-memory snapshot (SNAPSHOT_ENABLED)')
+    parser.add_argument('--random-seed', type=int, default=1)
+    parser.add_argument('--output', help='file to write the JSON results to, stdout by default')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two saved result files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    config = {'SQLALCHEMY_DATABASE_URI': args.database_url or database_url()}
+    if args.no_response_cache:
+        config['RESPONSE_CACHE_SIZE'] = 0
+    if args.snapshot:
+        config['SNAPSHOT_ENABLED'] = True
+    app = create_app(config)
+
+    if args.seed:
+        seed(app, args.questions, args.categories, args.random_seed)
+
+    dataset = load_dataset(app)
+    app.extensions['bench_load_dataset'] = dataset
+    rng = random.Random(args.random_seed)
+    modes = ('test_client', 'wsgi_server') if args.mode == 'both' else (args.mode,)
+    results = []
+
+    print_header()
+    for mode in modes:
+        server = None
+        if mode == 'wsgi_server':
+            server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            for scenario in scenarios(dataset, app.config.get('QUESTIONS_PER_PAGE', 10)):
+                if mode == 'test_client':
+                    result = run_test_client(app, scenario, args.requests, args.warmup, rng)
+                else:
+                    result = run_server(app, server, scenario, args.requests, args.warmup, args.concurrency, rng)
+                results.append(result)
+                print_result(result)
+        finally:
+            if server is not None:
+                server.shutdown()
+
+    left = clean_up(app)
+    if left:
+        print('deleted {} questions left over by failed writes'.format(left), file=sys.stderr)
+
+    with app.app_context():
+        dialect = db.get_engine().dialect.name
+
+    output = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'database': dialect,
+            'questions': dataset['questions'],
+            'categories': len(dataset['category_ids']),
+            'requests_per_route': args.requests,
+            'concurrency': args.concurrency,
+            'response_cache': not args.no_response_cache,
+            'snapshot': args.snapshot,
+        },
+        'results': results
+    }
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(output, output_file, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
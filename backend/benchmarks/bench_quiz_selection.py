@@ -0,0 +1,60 @@
+'''
+Micro-benchmark for drawing a quiz question: the old shuffle-and-scan approach against the
+QuizIndex used by POST /quizzes. Runs in memory, no database is needed.
+
+From the backend folder run:
+    python benchmarks/bench_quiz_selection.py
+'''
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flaskr.quiz import QuizIndex
+
+NUM_QUESTIONS = 100000
+NUM_CATEGORIES = 6
+PREVIOUS_LENGTHS = [0, 10, 100, 1000, 10000, 50000]
+
+
+class FakeQuestion:
+    ''' Stands in for a Question row, the old code only looked at the id '''
+
+    def __init__(self, id):
+        self.id = id
+
+
+def shuffle_and_scan(questions, previous_questions):
+    ''' The original selection: shuffle every question, then scan the previous_questions list '''
+    questions = list(questions)
+    random.shuffle(questions)
+    for question in questions:
+        if question.id not in previous_questions:
+            return question.id
+    return None
+
+
+def main():
+    rows = [(question_id, question_id % NUM_CATEGORIES + 1) for question_id in range(1, NUM_QUESTIONS + 1)]
+    questions = [FakeQuestion(question_id) for question_id, _ in rows]
+
+    quiz_index = QuizIndex()
+    quiz_index.load(rows)
+
+    print('{:>10} {:>18} {:>18} {:>10}'.format('previous', 'shuffle+scan (ms)', 'quiz index (ms)', 'speedup'))
+    for num_previous in PREVIOUS_LENGTHS:
+        previous_questions = random.sample(range(1, NUM_QUESTIONS + 1), num_previous)
+
+        number = 3 if num_previous < 10000 else 1
+        old = timeit.timeit(lambda: shuffle_and_scan(questions, previous_questions), number=number) / number
+        # building the set is part of every request, so it is included in the timing
+        new = timeit.timeit(lambda: quiz_index.draw(None, set(previous_questions)), number=number * 100) / (number * 100)
+
+        print('{:>10} {:>18.3f} {:>18.3f} {:>9.0f}x'.format(num_previous, old * 1000, new * 1000, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+'''
+Micro-benchmark for the read path of the question listings: the original ORM path (Question objects,
+format(), jsonify) against the Core rows and fast serializer used by the read routes now, for a range
+of result sizes. Uses a throwaway SQLite database, so no Postgres is needed.
+
+From the backend folder run:
+    python benchmarks/bench_serialization.py
+'''
+
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask, jsonify
+
+from models import db, setup_db, Question, Category
+from flaskr.queries import fetch_questions, select_questions
+from flaskr.serializers import get_serializer, orjson
+
+RESULT_SIZES = [10, 100, 1000, 10000]
+
+
+def orm_path(size):
+    ''' The original path: ORM objects, Question.format() and jsonify '''
+    questions = Question.query.order_by(Question.id).limit(size).all()
+    return jsonify({'questions': [question.format() for question in questions]}).get_data()
+
+
+def core_path(size, dumps):
+    ''' The new path: Core rows turned into dicts and encoded by the fast serializer '''
+    questions = fetch_questions(select_questions().order_by(Question.id).limit(size))
+    return dumps({'questions': questions})
+
+
+def main():
+    database_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    database_file.close()
+
+    app = Flask(__name__)
+    setup_db(app, 'sqlite:///' + database_file.name)
+
+    try:
+        with app.app_context():
+            db.create_all()
+            db.session.add(Category('Science'))
+            db.session.commit()
+            db.session.execute(Question.__table__.insert(), [
+                {'question': 'Benchmark question number {}?'.format(number), 'answer': 'Answer {}'.format(number),
+                 'difficulty': number % 5 + 1, 'category': 1}
+                for number in range(max(RESULT_SIZES))
+            ])
+            db.session.commit()
+
+            serializers = [('stdlib', get_serializer('stdlib'))]
+            if orjson is not None:
+                serializers.append(('orjson', get_serializer('orjson')))
+
+            header = '{:>8} {:>12}'.format('rows', 'orm (ms)')
+            for name, _ in serializers:
+                header += ' {:>16} {:>8}'.format('core+' + name + ' (ms)', 'speedup')
+            print(header)
+
+            for size in RESULT_SIZES:
+                number = max(1, 10000 // size)
+                # the session is cleared between runs, so the ORM path builds new objects every time
+                old = timeit.timeit(lambda: (orm_path(size), db.session.expunge_all()), number=number) / number
+                line = '{:>8} {:>12.3f}'.format(size, old * 1000)
+                for _, dumps in serializers:
+                    new = timeit.timeit(lambda: core_path(size, dumps), number=number) / number
+                    line += ' {:>16.3f} {:>7.1f}x'.format(new * 1000, old / new)
+                print(line)
+    finally:
+        os.remove(database_file.name)
+
+
+if __name__ == '__main__':
+    main()
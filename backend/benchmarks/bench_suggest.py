@@ -0,0 +1,46 @@
+'''
+Micro-benchmark for the type-ahead prefix index behind GET /questions/suggest: time per
+suggestion lookup and memory footprint for a synthetic question bank. Runs in memory, no
+database is needed.
+
+From the backend folder run:
+    python benchmarks/bench_suggest.py
+'''
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flaskr.suggest import PrefixIndex
+
+NUM_QUESTIONS = 100000
+VOCABULARY_SIZE = 20000
+WORDS_PER_QUESTION = 10
+QUERIES = ['w', 'wo', 'word1', 'word12 wor', 'word123 word4']
+
+
+def main():
+    random.seed(1)
+    vocabulary = ['word{}'.format(number) for number in range(VOCABULARY_SIZE)]
+    rows = [(question_id, ' '.join(random.choices(vocabulary, k=WORDS_PER_QUESTION)) + '?')
+            for question_id in range(1, NUM_QUESTIONS + 1)]
+
+    suggest_index = PrefixIndex()
+    load_seconds = timeit.timeit(lambda: suggest_index.load(rows), number=1)
+
+    stats = suggest_index.stats()
+    print('loaded {} questions, {} tokens in {:.2f} s, {:.1f} MB'.format(
+        stats['questions'], stats['tokens'], load_seconds, stats['memory_bytes'] / 1024 / 1024))
+
+    print('{:>16} {:>12}'.format('query', 'us/lookup'))
+    for query in QUERIES:
+        number = 1000
+        seconds = timeit.timeit(lambda: suggest_index.suggest(query, 10), number=number) / number
+        print('{:>16} {:>12.1f}'.format(query, seconds * 1000000))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,137 @@
+import click
+import functools
+import json
 import os
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, jsonify, make_response, stream_with_context, g
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.exc import SQLAlchemyError
 from flask_cors import CORS
 import random
+import tempfile
 import werkzeug
 
 from models import db, setup_db, Question, Category
+from .admission import AdmissionControl, ADMISSION_RETRY_AFTER, ADMISSION_THREADS
+from .bulk import (import_questions, read_csv, read_ndjson, question_criteria, question_changes,
+                   delete_questions, update_questions)
+from .cache import CategoryCache, ResponseCache
+from .compression import (ResponseCompressor, COMPRESSION_MIN_SIZE, COMPRESSION_GZIP_LEVEL,
+                          COMPRESSION_BROTLI_QUALITY)
+from .counts import QuestionCounts
+from .metrics import Metrics
+from .pagination import encode_cursor, decode_cursor
+from .queries import fetch_question, fetch_questions, fetch_questions_by_id, select_questions, select_quiz_index
+from .profiling import RequestProfiler
+from .replicas import ReplicaRouter, replica_urls
+from .quiz import QuizIndex
+from .search import QuestionSearch
+from .serializers import get_serializer
+from .sessions import DatabaseQuizSessionStore, QuizSessionStore
+from .snapshot import QuestionSnapshot
+from .suggest import PrefixIndex
+from .versioning import VersionCounter
+from .warmup import WarmUp
 
 QUESTIONS_PER_PAGE = 10
+# rows per INSERT and transaction in /questions/bulk, and the largest batch a client may ask for
+BULK_BATCH_SIZE = 1000
+BULK_BATCH_SIZE_MAX = 10000
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonl', 'application/json-lines')
+# the most ids one bulk DELETE or PATCH /questions may list, and the most changed questions applied to the
+# quiz and suggest indexes one by one, larger changes make them reload
+BULK_IDS_MAX = 10000
+BULK_INDEX_UPDATE_MAX = 1000
+# rows fetched from the server-side cursor and sent per chunk by /questions/export
+EXPORT_CHUNK_SIZE = 1000
+# add a Server-Timing header with the request and database time to every response
+SERVER_TIMING = False
+# where PROFILING_ENABLED writes request profiles, and how many it keeps
+PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'trivia-profiles')
+PROFILE_MAX_FILES = 50
+# seconds before the cached categories are reloaded, categories are only changed by hand in the db
+CATEGORY_CACHE_TTL = 5 * 60
+# seconds a dataset version read from the db is trusted, 0 reads it on every conditional request
+VERSION_CHECK_TTL = 0
+# number of rendered read responses kept per worker, 0 disables the response cache
+RESPONSE_CACHE_SIZE = 256
+# seconds before the quiz index is reloaded to pick up questions written by other workers
+QUIZ_INDEX_TTL = 60
+# where the quiz session decks are kept, 'database' for every worker to share or 'memory' for a single process
+QUIZ_SESSION_STORE = 'database'
+# quiz sessions expire after this many seconds unused, and with the memory store at most this many are kept
+QUIZ_SESSION_TTL = 60 * 60
+QUIZ_SESSION_MAX = 10000
+# the most questions /quizzes/batch hands out in one call
+QUIZ_BATCH_MAX = 50
+# default and largest number of suggestions from /questions/suggest, and how often its index is reloaded
+SUGGEST_LIMIT = 10
+SUGGEST_LIMIT_MAX = 50
+SUGGEST_INDEX_TTL = 60
+# seconds a client that added or deleted a question reads from the primary instead of a replica
+READ_YOUR_WRITES_WINDOW = 5
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     setup_db(app)
 
+    metrics = Metrics()
+    app.extensions['metrics'] = metrics
+
+    # per-process limits of the expensive routes, a request over the limit gets a 503
+    admission = AdmissionControl(app.config.get('ADMISSION_LIMITS'), metrics, threads=app.config.get(
+        'ADMISSION_THREADS', int(os.environ.get('GUNICORN_THREADS', ADMISSION_THREADS))))
+    app.extensions['admission'] = admission
+
+    dumps = get_serializer(app.config.get('JSON_SERIALIZER', 'auto'))
+
+    category_cache = CategoryCache(ttl=app.config.get('CATEGORY_CACHE_TTL', CATEGORY_CACHE_TTL))
+    app.extensions['category_cache'] = category_cache
+
+    dataset_version = VersionCounter(ttl=app.config.get('VERSION_CHECK_TTL', VERSION_CHECK_TTL))
+    app.extensions['dataset_version'] = dataset_version
+
+    question_counts = QuestionCounts()
+    app.extensions['question_counts'] = question_counts
+
+    response_cache = ResponseCache(max_entries=app.config.get('RESPONSE_CACHE_SIZE', RESPONSE_CACHE_SIZE))
+    app.extensions['response_cache'] = response_cache
+
+    quiz_index = QuizIndex(ttl=app.config.get('QUIZ_INDEX_TTL', QUIZ_INDEX_TTL))
+    app.extensions['quiz_index'] = quiz_index
+
+    quiz_session_store = app.config.get('QUIZ_SESSION_STORE', QUIZ_SESSION_STORE)
+    if quiz_session_store == 'database':
+        quiz_sessions = DatabaseQuizSessionStore(ttl=app.config.get('QUIZ_SESSION_TTL', QUIZ_SESSION_TTL))
+    elif quiz_session_store == 'memory':
+        quiz_sessions = QuizSessionStore(max_sessions=app.config.get('QUIZ_SESSION_MAX', QUIZ_SESSION_MAX),
+                                         ttl=app.config.get('QUIZ_SESSION_TTL', QUIZ_SESSION_TTL))
+    else:
+        raise ValueError('unknown QUIZ_SESSION_STORE {!r}, use database or memory'.format(quiz_session_store))
+    app.extensions['quiz_sessions'] = quiz_sessions
+
+    suggest_index = PrefixIndex(ttl=app.config.get('SUGGEST_INDEX_TTL', SUGGEST_INDEX_TTL))
+    app.extensions['suggest_index'] = suggest_index
+
+    # comma separated replica URLs for the read-only routes, e.g. DB_REPLICA_URLS=postgresql://.../trivia
+    replica_router = ReplicaRouter(
+        replica_urls(app.config.get('DATABASE_REPLICA_URLS', os.environ.get('DB_REPLICA_URLS'))),
+        engine_options=app.config.get('SQLALCHEMY_ENGINE_OPTIONS'),
+        read_your_writes_window=app.config.get('READ_YOUR_WRITES_WINDOW', READ_YOUR_WRITES_WINDOW))
+    app.extensions['replica_router'] = replica_router
+
+    # with SNAPSHOT_ENABLED the listings and quizzes are served from an in-memory copy of every question
+    snapshot = QuestionSnapshot() if app.config.get('SNAPSHOT_ENABLED', False) else None
+    app.extensions['snapshot'] = snapshot
+
+    # opens the pooled connections and loads the caches and indexes before a worker takes traffic, see /readyz
+    warm_up = WarmUp(app)
+    app.extensions['warm_up'] = warm_up
+
+    question_search = QuestionSearch(per_page=QUESTIONS_PER_PAGE, full_text=app.config.get('SEARCH_FULL_TEXT'))
+
     '''
     @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
     '''
@@ -26,74 +143,350 @@ def create_app(test_config=None):
     @app.after_request
     def after_request(response):
         response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,true')
-        response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+        response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,PATCH,DELETE,OPTIONS')
+        return response
+
+    @app.before_request
+    def start_request_metrics():
+        ''' Starts the latency and SQL counters of the request, see /metrics '''
+        # the primary goes last, the pool gauges report the pool of the last engine instrumented
+        for replica in replica_router.engines:
+            metrics.instrument_engine(replica)
+        metrics.instrument_engine(db.get_engine())
+        metrics.start_request()
+
+    @app.after_request
+    def finish_request_metrics(response):
+        ''' Records the request in /metrics and, if SERVER_TIMING is on, adds a Server-Timing header '''
+        # label by route pattern, not by path, so /questions/<question_id> is one series
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        if response.is_streamed:
+            # the body, and its queries, run after this, so record once it has been sent. the headers are gone
+            # by then, so a streamed response has no Server-Timing header
+            response.call_on_close(functools.partial(
+                metrics.finish_request, route, request.method, response.status_code, g._get_current_object()))
+            return response
+        duration, statements, db_seconds = metrics.finish_request(route, request.method, response.status_code)
+
+        if app.config.get('SERVER_TIMING', SERVER_TIMING):
+            response.headers.add('Server-Timing', 'app;dur={:.2f}, db;dur={:.2f};desc="{} queries"'.format(
+                duration * 1000, db_seconds * 1000, statements))
         return response
 
-    def paginate_questions(page, questions):
+    if app.config.get('COMPRESSION_ENABLED', True):
+        compressor = ResponseCompressor(
+            min_size=app.config.get('COMPRESSION_MIN_SIZE', COMPRESSION_MIN_SIZE),
+            gzip_level=app.config.get('COMPRESSION_GZIP_LEVEL', COMPRESSION_GZIP_LEVEL),
+            brotli_quality=app.config.get('COMPRESSION_BROTLI_QUALITY', COMPRESSION_BROTLI_QUALITY),
+            cache=response_cache, metrics=metrics)
+        app.extensions['compressor'] = compressor
+
+        # registered after the metrics hooks so it runs before them and its time is part of the request duration,
+        # Flask runs the after_request hooks in reverse order
+        @app.after_request
+        def compress_response(response):
+            ''' Sends large JSON bodies gzip or brotli compressed to clients that accept it '''
+            return compressor.compress_response(response, request.headers.get('Accept-Encoding'),
+                                                g.get('response_cache_key'))
+
+    if app.config.get('PROFILING_ENABLED', False):
+        profiler = RequestProfiler(
+            directory=app.config.get('PROFILE_DIR', PROFILE_DIR),
+            max_files=app.config.get('PROFILE_MAX_FILES', PROFILE_MAX_FILES),
+            sample_rate=app.config.get('PROFILE_SAMPLE_RATE', 0.0),
+            token=app.config.get('PROFILE_TOKEN'))
+        app.extensions['profiler'] = profiler
+
+        @app.before_request
+        def start_profiling():
+            ''' Profiles the request if it sent the X-Profile header or was sampled '''
+            if profiler.should_profile(request):
+                profiler.instrument_engine(db.get_engine())
+                profiler.start(request)
+
+        @app.after_request
+        def finish_profiling(response):
+            ''' Writes the profile of a profiled request and tells the client its name '''
+            profile_name = profiler.finish()
+            if profile_name is not None:
+                response.headers['X-Profile-Id'] = profile_name
+            return response
+
+        @app.teardown_request
+        def stop_profiling(error=None):
+            ''' Makes sure a request that failed before after_request still stops and writes its profile '''
+            profiler.finish()
+
+    def json_response(data, status=200):
+        ''' Like jsonify, but encoded with the serializer picked by JSON_SERIALIZER, orjson when installed '''
+        return app.response_class(dumps(data), status=status, mimetype='application/json')
+
+    def categories_version():
+        ''' ETag of the routes that only return categories, changes when the cached categories do '''
+        refresh_category_cache()
+        return 'c-{}'.format(category_cache.digest)
+
+    def questions_version():
+        ''' ETag of the routes that return questions, changes with every write and when the categories change '''
+        refresh_category_cache()
+        if snapshot is not None:
+            # the snapshot is what gets served, so its version is the one to send
+            refresh_snapshot()
+            return 'q{}-{}'.format(snapshot.version, category_cache.digest)
+        return 'q{}-{}'.format(dataset_version.current(), category_cache.digest)
+
+    def category_questions_version(id):
+        ''' ETag of /categories/<id>/questions, a category that doesn't exist is a 404 even for a client with an ETag '''
+        refresh_category_cache()
+        if id not in category_cache.by_id:
+            abort(404)
+        return questions_version()
+
+    def conditional(get_version):
+        ''' Decorator for read routes whose response only depends on the URL and a version.
+
+        The version is sent as a strong ETag. If the client already has it (If-None-Match), a 304 is
+        returned without running the route at all, otherwise the rendered body is served from the
+        response cache or rendered and cached under (path, query args, version).
+
+        :param get_version: function returning the current version string of the route's data, called with the
+        route's URL arguments
+        '''
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                try:
+                    version = get_version(**kwargs)
+                except SQLAlchemyError:
+                    abort(500)
+
+                # weak comparison, compressed responses carry the weak form of the ETag
+                if request.if_none_match.contains_weak(version):
+                    response = app.response_class(status=304)
+                    response.set_etag(version)
+                    return response
+
+                key = (request.path, tuple(sorted(request.args.items(multi=True))), version)
+                body = response_cache.get(key)
+
+                if body is not None:
+                    response = app.response_class(body, mimetype='application/json')
+                    g.response_cache_key = key
+                else:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code == 200:
+                        response_cache.put(key, response.get_data())
+                        g.response_cache_key = key
+
+                response.set_etag(version)
+                return response
+            return wrapper
+        return decorator
+
+    def read_replica(view):
+        ''' Decorator for read-only routes, their SELECTs run on a replica if any are configured.
+        Clients that wrote within READ_YOUR_WRITES_WINDOW seconds keep reading from the primary.
+        '''
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            g.db_replica = replica_router.choose(request)
+            return view(*args, **kwargs)
+        return wrapper
+
+    def admitted(route_class):
+        ''' Decorator limiting how many requests of route_class run at once, see flaskr/admission.py.
+        A request that can't get a slot in time is shed with a 503 and a Retry-After header.
+        '''
+        def decorator(view):
+            limit = admission.limit(route_class)
+            if limit is None:
+                return view
+
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                shed_reason = limit.acquire()
+                if shed_reason is not None:
+                    admission.count_shed(route_class, shed_reason)
+                    abort(503)
+
+                try:
+                    response = make_response(view(*args, **kwargs))
+                except BaseException:
+                    limit.release()
+                    raise
+                if response.is_streamed:
+                    # keep the slot until the body has been sent
+                    response.call_on_close(limit.release)
+                else:
+                    limit.release()
+                return response
+            return wrapper
+        return decorator
+
+    def page_args():
+        ''' Reads the ?page=N or ?after=<cursor> arguments of a paginated route, aborting with a 400 if invalid
+
+        :return: tuple of the page number and the id the cursor points at, or None without a cursor
+        '''
+        page_num = request.args.get('page', 1, type=int)
+        cursor = request.args.get('after')
+
+        if page_num < 1:
+            abort(400)
+
+        after = None
+        if cursor is not None:
+            try:
+                after = decode_cursor(cursor)
+            except ValueError:
+                abort(400)
+
+        return page_num, after
+
+    def paginate_questions(page, after=None, category_id=None):
         ''' Returns a selection of all questions that fit on one page
 
+        The page is cut out by the database, so only QUESTIONS_PER_PAGE rows are ever loaded.
+        Only the columns we return are selected with a Core query, so no ORM objects are built.
+        Deep pages should be requested with a keyset cursor instead of a page number.
+
         Keyword arguments:
-        :param page: the page number to return questions for
-        :param questions: all the questions, a selection of which is returned
+        :param page: the page number to return questions for, used with LIMIT/OFFSET
+        :param after: id of the last question already seen, if given the page starts after it
+        :param category_id: only return questions of this category, served by the (category, id) index
         :return: current list of questions
         '''
-        # page = request.args.get('page', 1, type=int)
-        start = (page - 1) * QUESTIONS_PER_PAGE
-        end = start + QUESTIONS_PER_PAGE
+        if snapshot is not None:
+            refresh_snapshot()
+            return snapshot.page(QUESTIONS_PER_PAGE, page, after, category_id)
+
+        statement = select_questions().order_by(Question.id)
+
+        if category_id is not None:
+            statement = statement.where(Question.category == category_id)
+
+        if after is not None:
+            statement = statement.where(Question.id > after)
+        else:
+            statement = statement.offset((page - 1) * QUESTIONS_PER_PAGE)
+
+        return fetch_questions(statement.limit(QUESTIONS_PER_PAGE))
+
+    def count_questions(category_id=None):
+        ''' Returns the number of questions, in category_id if given, from the snapshot when it is enabled
+        or else from the stored counts '''
+        if snapshot is not None:
+            refresh_snapshot()
+            return snapshot.count(category_id)
+
+        return question_counts.total(category_id)
+
+    def load_question(question_id):
+        ''' Returns one question dict by id, or None if it doesn't exist, from the snapshot when it is enabled '''
+        if snapshot is not None:
+            refresh_snapshot()
+            return snapshot.question(question_id)
+        return fetch_question(question_id)
+
+    def load_questions_by_id(question_ids):
+        ''' Returns a dict of question id -> question dict, from the snapshot when it is enabled '''
+        if snapshot is not None:
+            refresh_snapshot()
+            return snapshot.questions_by_id(question_ids)
+        return fetch_questions_by_id(question_ids)
+
+    def refresh_snapshot():
+        ''' Loads a new snapshot if the dataset version moved on since the current one was loaded.
+
+        One request builds the new snapshot while the others keep being served from the old one, then
+        swaps it in. Only the first load, with no snapshot to serve yet, makes the other requests wait.
+        The category cache and the quiz index are reloaded from it, so all three agree.
+        '''
+        # one version check per request is enough, a route may page and count from the snapshot
+        if g.get('snapshot_checked'):
+            return
+        g.snapshot_checked = True
+
+        if snapshot.version == dataset_version.current():
+            return
 
-        question_list = [question.format() for question in questions]
-        current_questions = question_list[start:end]
+        if not snapshot.lock.acquire(blocking=snapshot.version is None):
+            # another thread is loading the new one, the current snapshot is served until it's swapped in
+            return
+        try:
+            # another thread may have loaded it while we waited for the lock
+            version = dataset_version.current()
+            if snapshot.version == version:
+                return
+
+            rows = db.session.execute(select_questions().order_by(Question.id)
+                                      .execution_options(stream_results=True))
+            snapshot.load(rows, db.session.query(Category.id, Category.type), version)
+            category_cache.load(snapshot.category_types.items())
+            quiz_index.load(snapshot.id_category_pairs())
+        finally:
+            snapshot.lock.release()
 
-        return current_questions
+    def next_page_cursor(questions):
+        ''' Returns the cursor for the page after questions, None if this page wasn't full so it's the last one '''
+        if len(questions) < QUESTIONS_PER_PAGE:
+            return None
+        return encode_cursor(questions[-1]['id'])
+
+    def refresh_category_cache():
+        ''' Reloads the category cache from the database if it was never loaded, was invalidated or has gone stale '''
+        if category_cache.is_stale():
+            category_cache.load(db.session.query(Category.id, Category.type))
 
     @app.route('/categories', methods=['GET'])
+    @read_replica
+    @conditional(categories_version)
     def get_categories():
         ''' Returns a JSON-based list of categories, used by quiz pages that list categories
 
         :return: JSON list of categories
         '''
         try:
-            categories = Category.query.all()
+            refresh_category_cache()
         except SQLAlchemyError:
             abort(500)
-        finally:
-            # make a list out of the categories returned from the db
-            categories_list = [category.type for category in categories]
 
-            return jsonify({
-                'categories': categories_list
-            })
+        return json_response({
+            'categories': category_cache.types
+        })
 
     @app.route('/questions', methods=['GET'])
+    @read_replica
+    @conditional(questions_version)
     def get_questions():
         ''' Gets the questions for a specific page of questions being displayed
 
+        Pages are selected with ?page=N, or with ?after=<cursor> using the next_cursor returned
+        by the previous page, which stays cheap no matter how deep into the list the client is.
+
         :return: JSON-based list of questions and other properties related to the returned questions
         '''
-        page_num = request.args.get('page', 1, type=int)
+        page_num, after = page_args()
 
         try:
-            questions = Question.query.all()
+            selected_questions = paginate_questions(page_num, after)
+            total_questions = count_questions()
+            refresh_category_cache()
         except SQLAlchemyError:
             abort(500)
-        finally:
-            selected_questions = paginate_questions(page_num, questions)
-            current_category = 1
-
-            category = Category.query.filter(Category.id == current_category).one_or_none()
-            db_categories = Category.query.all()
-
-            # need a list of categories in text from the db objects
-            categories = {}
-            for item in db_categories:
-                categories[item.id] = item.type
-
-            return jsonify({
-                'questions': selected_questions,
-                'total_questions': len(questions),
-                'categories': categories,
-                'category': categories[current_category]
-            })
+
+        current_category = 1
+
+        # id -> type map of the categories, from the cache
+        categories = category_cache.by_id
+
+        return json_response({
+            'questions': selected_questions,
+            'total_questions': total_questions,
+            'categories': categories,
+            'category': categories[current_category],
+            'next_cursor': next_page_cursor(selected_questions)
+        })
 
     @app.route('/add_question', methods=['POST'])
     def add_new_question():
@@ -109,14 +502,109 @@ def create_app(test_config=None):
 
         try:
             db.session.add(new_question)
+            question_counts.added([(new_question.category, new_question.difficulty)])
+            dataset_version.bump()
             db.session.commit()
         except SQLAlchemyError:
             abort(500)
 
-        return jsonify({
+        quiz_index.add(new_question.id, new_question.category)
+        suggest_index.add(new_question.id, new_question.question)
+        if snapshot is not None:
+            # reload right away, so reads in this worker don't have to wait for it
+            refresh_snapshot()
+
+        return replica_router.wrote(jsonify({
             'success': True,
             'id': new_question.id
-        })
+        }))
+
+    @app.route('/questions/bulk', methods=['POST'])
+    @admitted('bulk')
+    def bulk_import_questions():
+        ''' Imports many questions from one upload, either NDJSON (Content-Type application/x-ndjson,
+        one question object per line) or CSV (Content-Type text/csv, with a header row). Rows have the
+        same fields as /add_question, but category is the database id of the category.
+
+        The upload is read as a stream and inserted in batches of ?batch_size= rows, each batch in its own
+        transaction. Invalid rows are skipped and reported with their line number.
+
+        :return: JSON with the number of questions inserted and rejected, a result per batch and the row errors
+        '''
+        if request.mimetype in NDJSON_MIMETYPES:
+            read_rows = read_ndjson
+        elif request.mimetype == 'text/csv':
+            read_rows = read_csv
+        else:
+            abort(415)
+
+        batch_size = request.args.get('batch_size', app.config.get('BULK_BATCH_SIZE', BULK_BATCH_SIZE), type=int)
+        if batch_size < 1 or batch_size > BULK_BATCH_SIZE_MAX:
+            abort(422)
+
+        try:
+            refresh_category_cache()
+        except SQLAlchemyError:
+            abort(500)
+
+        lines = (line.decode('utf-8', errors='replace') for line in request.stream)
+        def before_batch_commit(batch):
+            question_counts.added((row['category'], row['difficulty']) for row in batch)
+            dataset_version.bump()
+
+        result = import_questions(read_rows(lines), category_cache.by_id, batch_size,
+                                  before_commit=before_batch_commit)
+
+        if result['inserted']:
+            # the new ids aren't returned by a multi-row insert, so the indexes reload on next use
+            quiz_index.invalidate()
+            suggest_index.invalidate()
+            if snapshot is not None:
+                refresh_snapshot()
+
+        result['success'] = result['rejected'] == 0 and all('error' not in batch for batch in result['batches'])
+        return replica_router.wrote(jsonify(result))
+
+    @app.route('/questions/export', methods=['GET'])
+    @admitted('export')
+    @read_replica
+    def export_questions():
+        ''' Streams every question as NDJSON, one question object per line, in the same format
+        /questions/bulk imports. Rows are read through a server-side cursor and sent in chunks while
+        they are read, so memory use doesn't grow with the size of the question bank.
+
+        :return: chunked application/x-ndjson response, optionally only the questions of ?category=<id>
+        '''
+        category_id = request.args.get('category', type=int)
+
+        query = db.session.query(Question.id, Question.question, Question.answer,
+                                 Question.difficulty, Question.category).order_by(Question.id)
+
+        if category_id is not None:
+            try:
+                refresh_category_cache()
+            except SQLAlchemyError:
+                abort(500)
+            if category_id not in category_cache.by_id:
+                abort(404)
+            query = query.filter(Question.category == category_id)
+
+        # yield_per also turns on stream_results, a server-side cursor on Postgres
+        rows = query.yield_per(EXPORT_CHUNK_SIZE)
+
+        def generate():
+            chunk = []
+            for row in rows:
+                chunk.append(json.dumps(row._asdict()))
+                if len(chunk) == EXPORT_CHUNK_SIZE:
+                    yield '\n'.join(chunk) + '\n'
+                    chunk = []
+            if chunk:
+                yield '\n'.join(chunk) + '\n'
+
+        response = app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+        response.headers['Content-Disposition'] = 'attachment; filename=questions.ndjson'
+        return response
 
     @app.route('/questions/<question_id>', methods=['DELETE'])
     def delete_question(question_id):
@@ -132,137 +620,504 @@ def create_app(test_config=None):
         # Hence a try ... except block is only used for an actual SQLAlchemy error
         # delete returns the number of rows deleted, so check if the number of deleted rows is zero
         try:
+            counted_as = db.session.query(Question.category, Question.difficulty).filter_by(id=question_id).first()
             affected_questions = Question.query.filter_by(id=question_id).delete()
             if affected_questions == 0:
                 return jsonify({
                     'success': False
                 })
             else:
+                question_counts.removed([counted_as])
+                dataset_version.bump()
                 db.session.commit()
-                return jsonify({
+                quiz_index.remove(question_id)
+                suggest_index.remove(question_id)
+                if snapshot is not None:
+                    refresh_snapshot()
+                return replica_router.wrote(jsonify({
                     'success': True
-                })
+                }))
         except SQLAlchemyError:
             # if there really is an error in SQLAlchemy
             abort(500)
 
+    def bulk_selection():
+        ''' Reads the JSON body of a bulk DELETE or PATCH and its WHERE clause, see question_criteria
+
+        :return: (body, condition, None), or (None, None, 422 response) if the body is invalid
+        '''
+        body = request.get_json(silent=True)
+        try:
+            if not isinstance(body, dict):
+                raise ValueError('expected a JSON object')
+            return body, question_criteria(body, app.config.get('BULK_IDS_MAX', BULK_IDS_MAX)), None
+        except ValueError as invalid:
+            return None, None, invalid_bulk_request(invalid)
+
+    def invalid_bulk_request(invalid):
+        return jsonify({
+            'success': False,
+            'error': 422,
+            'message': str(invalid)
+        }), 422
+
+    @app.route('/questions', methods=['DELETE'])
+    @admitted('bulk')
+    def bulk_delete_questions():
+        ''' Deletes every question selected by the JSON body in one statement and one transaction. The body
+        holds ids, a list of question ids, and/or category (a database id) and difficulty, all of which must
+        match, e.g. {"ids": [4, 8, 15]} or {"category": 3, "difficulty": 1}.
+
+        :return: JSON with the number of questions deleted
+        '''
+        body, condition, error = bulk_selection()
+        if error is not None:
+            return error
+
+        try:
+            deleted = delete_questions(condition)
+            if deleted:
+                question_counts.removed((category, difficulty) for _, category, difficulty in deleted)
+                dataset_version.bump()
+            db.session.commit()
+        except SQLAlchemyError:
+            abort(500)
+
+        if len(deleted) > BULK_INDEX_UPDATE_MAX:
+            quiz_index.invalidate()
+            suggest_index.invalidate()
+        else:
+            for question_id, _, _ in deleted:
+                quiz_index.remove(question_id)
+                suggest_index.remove(question_id)
+        if deleted and snapshot is not None:
+            refresh_snapshot()
+
+        return replica_router.wrote(jsonify({
+            'success': True,
+            'deleted': len(deleted)
+        }))
+
+    @app.route('/questions', methods=['PATCH'])
+    @admitted('bulk')
+    def bulk_update_questions():
+        ''' Changes the category and/or difficulty of every question selected by the JSON body in one statement
+        and one transaction. The questions are selected like DELETE /questions, the new values are in set,
+        e.g. {"category": 3, "set": {"difficulty": 2}} or {"ids": [4, 8], "set": {"category": 5}}.
+
+        :return: JSON with the number of questions updated
+        '''
+        body, condition, error = bulk_selection()
+        if error is not None:
+            return error
+
+        try:
+            refresh_category_cache()
+        except SQLAlchemyError:
+            abort(500)
+
+        try:
+            values = question_changes(body.get('set'), category_cache.by_id)
+        except ValueError as invalid:
+            return invalid_bulk_request(invalid)
+
+        try:
+            updated = update_questions(condition, values)
+            if updated:
+                question_counts.moved(((category, difficulty),
+                                       (values.get('category', category), values.get('difficulty', difficulty)))
+                                      for _, category, difficulty in updated)
+                dataset_version.bump()
+            db.session.commit()
+        except SQLAlchemyError:
+            abort(500)
+
+        # only the category is in the quiz index, and the texts in the suggest index don't change
+        if 'category' in values:
+            if len(updated) > BULK_INDEX_UPDATE_MAX:
+                quiz_index.invalidate()
+            else:
+                for question_id, _, _ in updated:
+                    quiz_index.remove(question_id)
+                    quiz_index.add(question_id, values['category'])
+        if updated and snapshot is not None:
+            refresh_snapshot()
+
+        return replica_router.wrote(jsonify({
+            'success': True,
+            'updated': len(updated)
+        }))
+
     @app.route('/questions', methods=['POST'])
+    @admitted('search')
+    @read_replica
     def search_questions():
         ''' Performs a case-insensitive search of the questions for the search term.
-        Looks for anything that contains the search term, does not need exact match.
+        Looks for anything that contains the search term, does not need exact match. On Postgres with
+        the search migration applied, whole-word matches are ranked first using the full-text index.
+        Every match is returned, unless a page is sent in the request body, then that page of results is.
 
         :return: Returns the questions that match the search term in a dict in JSON
-        also returns number of questions returned and category
+        also returns number of questions matching and category
         '''
         json_data = request.get_json()
-        search_term = '%' + json_data['searchTerm'] + '%'
-
-        # find matches for searchTerm in Question, use ilike on db for case-insensitive search
-        question_matches = Question.query.filter(Question.question.ilike(search_term)).all()
+        search_term = json_data['searchTerm']
+        page_num = json_data.get('page')
 
-        question_list = []
+        if page_num is not None and (not isinstance(page_num, int) or page_num < 1):
+            abort(422)
 
-        for question in question_matches:
-            question_list.append({
-                'id': question.id,
-                'question': question.question,
-                'answer': question.answer,
-                'category': question.category,
-                'difficulty': question.difficulty
-            })
+        try:
+            question_matches, total_questions = question_search.search(search_term, page_num)
+        except SQLAlchemyError:
+            abort(500)
 
         # NOTE: we return None for category per https://knowledge.udacity.com/questions/645582
-        return jsonify({
-            'questions': question_list,
-            'total_questions': len(question_matches),
+        return json_response({
+            'questions': question_matches,
+            'total_questions': total_questions,
             'current_category': None,
             'category': None
         })
 
+    def refresh_suggest_index():
+        ''' Reloads the type-ahead index from the database if it was never loaded or has gone stale. One
+        request reloads it while the others keep using the current index. '''
+        if suggest_index.is_stale() and suggest_index.start_reload():
+            try:
+                suggest_index.load(db.session.query(Question.id, Question.question))
+            finally:
+                suggest_index.finish_reload()
+
+    @app.route('/questions/suggest', methods=['GET'])
+    @admitted('suggest')
+    @read_replica
+    def suggest_questions():
+        ''' Type-ahead for the search box, answered from the in-memory prefix index without a query
+        to the database once the index is loaded. Every word typed must appear in the question, the
+        last one may be incomplete, e.g. ?q=van go matches "How many paintings did Van Gogh sell?"
+
+        :return: JSON list of up to limit suggestions with the question id and text
+        '''
+        query = request.args.get('q', '')
+        limit = request.args.get('limit', SUGGEST_LIMIT, type=int)
+
+        if limit < 1 or limit > SUGGEST_LIMIT_MAX:
+            abort(422)
+
+        try:
+            refresh_suggest_index()
+        except SQLAlchemyError:
+            abort(500)
+
+        suggestions = suggest_index.suggest(query, limit)
+
+        return jsonify({
+            'suggestions': [{'id': question_id, 'question': text} for question_id, text in suggestions]
+        })
+
+    @app.route('/questions/suggest/stats', methods=['GET'])
+    def suggest_index_stats():
+        ''' Reports the size and approximate memory footprint of the type-ahead index
+
+        :return: JSON with the number of questions and tokens indexed and the bytes used
+        '''
+        try:
+            refresh_suggest_index()
+        except SQLAlchemyError:
+            abort(500)
+
+        return jsonify(suggest_index.stats())
+
     @app.route('/categories/<int:id>/questions', methods=['GET'])
+    @read_replica
+    @conditional(category_questions_version)
     def get_questions_by_category(id):
-        ''' Questions are returned by category, for a given category. NOTE: we don't paginate
-        questions when displayed by category because the id is sent by the user clicking an
-        existing category, we assume it exists
+        ''' Questions are returned by category, for a given category, one page at a time like /questions.
+        A category id that doesn't exist returns a 404.
         :param id: The database id of the category to return questions for
         :return: JSON of questions, total number of questions and category of questions
         '''
-        questions = Question.query.filter(Question.category == id).all()
+        page_num, after = page_args()
 
-        questions_list = []
+        try:
+            refresh_category_cache()
+        except SQLAlchemyError:
+            abort(500)
 
-        for question in questions:
-            questions_list.append({
-                'id': question.id,
-                'question': question.question,
-                'answer': question.answer,
-                'category': question.category,
-                'difficulty': question.difficulty
-            })
+        if id not in category_cache.by_id:
+            abort(404)
 
-        category = Category.query.filter(Category.id == id).one_or_none()
+        try:
+            questions_list = paginate_questions(page_num, after, category_id=id)
+            total_questions = count_questions(id)
+        except SQLAlchemyError:
+            abort(500)
 
-        current_category = category.type
+        current_category = category_cache.by_id[id]
 
-        return jsonify({
+        return json_response({
             'questions': questions_list,
-            'total_questions': len(questions),
-            'current_category': current_category
+            'total_questions': total_questions,
+            'current_category': current_category,
+            'next_cursor': next_page_cursor(questions_list)
+        })
+
+    @app.route('/categories/stats', methods=['GET'])
+    @read_replica
+    @conditional(questions_version)
+    def get_category_stats():
+        ''' Returns the number of questions per category and per difficulty, from the stored counts
+
+        :return: JSON with the total, a count per difficulty, and a total and count per difficulty for every category
+        '''
+        try:
+            refresh_category_cache()
+            counts = question_counts.by_category()
+        except SQLAlchemyError:
+            abort(500)
+
+        difficulties = {}
+        categories = []
+        for category_id, category_type in category_cache.by_id.items():
+            by_difficulty = counts.get(category_id, {})
+            categories.append({
+                'id': category_id,
+                'type': category_type,
+                'total_questions': sum(by_difficulty.values()),
+                'difficulties': by_difficulty
+            })
+        for by_difficulty in counts.values():
+            for difficulty, count in by_difficulty.items():
+                difficulties[difficulty] = difficulties.get(difficulty, 0) + count
+
+        return json_response({
+            'success': True,
+            'total_questions': sum(difficulties.values()),
+            'difficulties': difficulties,
+            'categories': categories
         })
 
+    def refresh_quiz_index():
+        ''' Reloads the quiz index, from the snapshot if it is enabled or else from the database, if it was
+        never loaded or has gone stale. One request reloads it while the others keep drawing from the current
+        index. '''
+        if snapshot is not None:
+            refresh_snapshot()
+        if quiz_index.is_stale() and quiz_index.start_reload():
+            try:
+                if snapshot is not None:
+                    quiz_index.load(snapshot.id_category_pairs())
+                else:
+                    quiz_index.load(db.session.execute(select_quiz_index()))
+            finally:
+                quiz_index.finish_reload()
+
+    def quiz_category_id(category):
+        ''' Turns the quiz_category sent by the frontend into a database category id
+
+        :param category: dict with the 0-indexed id and type of the category chosen
+        :return: the 1-indexed database id, or None if type is "click" (ALL categories)
+        '''
+        if category['type'] == 'click':
+            return None
+        return int(category['id']) + 1
+
+    def draw_quiz_question(category_id, previous_questions):
+        ''' Draws one question that hasn't been asked yet from the quiz index
+
+        The index only holds ids, so the drawn question is loaded by primary key. If another
+        worker deleted it since the index was built, it is dropped from the index and we draw again.
+
+        :param category_id: database id of the category, None for all categories
+        :param previous_questions: ids of the questions already asked in this game
+        :return: dict of the question drawn, or None once every question has been asked
+        '''
+        refresh_quiz_index()
+
+        seen = set(previous_questions)
+
+        while True:
+            question_id = quiz_index.draw(category_id, seen)
+            if question_id is None:
+                return None
+
+            question = load_question(question_id)
+            if question is not None:
+                return question
+
+            quiz_index.remove(question_id)
+
     @app.route('/quizzes', methods=['POST'])
+    @admitted('quiz')
+    @read_replica
     def get_quiz_questions():
         ''' Gets questions from given category and presents questions that haven't been asked yet.
         If ALL is chosen, then request type is "click" and all questions are presented, one at a
-        time. Questions are randomized to be presented in a different order during each game.'''
+        time. Questions are drawn at random from the quiz index, so each game has a different order.'''
         json_data = request.get_json()
 
         previous_questions = json_data['previous_questions']
         category = json_data['quiz_category']
-        # need to add one to category, in the db they are 1-indexed, set category_id
-        category_id = int(category['id']) + 1
-        # category_id = category + 1
 
-        # look to find a question that hasn't been asked and return it as question_to_return
-        # if category type is 'click', we look at all categories / all questions
-        if category['type'] == 'click':
-            try:
-                questions = Question.query.order_by(Question.id).all()
-            except SQLAlchemyError:
-                abort(500)
-        # else if category is non-zero, we look at a specific category
-        else:
-            try:
-                questions = Question.query.filter(Question.category == category_id).order_by(Question.id).all()
-            except SQLAlchemyError:
-                abort(500)
+        # if category type is 'click', we look at all categories / all questions, else at a specific category
+        category_id = quiz_category_id(category)
 
-        # randomize questions
-        random.shuffle(questions)
+        # look to find a question that hasn't been asked and return it, None if all the questions were used up
+        try:
+            question_dict = draw_quiz_question(category_id, previous_questions)
+        except SQLAlchemyError:
+            abort(500)
+
+        return json_response({
+            'question': question_dict
+        })
+
+    @app.route('/quizzes/batch', methods=['POST'])
+    @admitted('quiz')
+    @read_replica
+    def get_quiz_questions_batch():
+        ''' Same as /quizzes, but returns the next count questions at once, so a client can prefetch a
+        whole round in one round trip. The questions are drawn together and loaded with a single query.
+
+        :return: JSON list of up to count questions that haven't been asked yet, fewer once the category
+        runs out, an empty list when every question has been asked
+        '''
+        json_data = request.get_json()
+
+        previous_questions = json_data['previous_questions']
+        category_id = quiz_category_id(json_data['quiz_category'])
+        count = json_data.get('count', 1)
+
+        if not isinstance(count, int) or count < 1 or count > QUIZ_BATCH_MAX:
+            abort(422)
+
+        seen = set(previous_questions)
+        questions = []
+
+        try:
+            refresh_quiz_index()
+
+            while len(questions) < count:
+                question_ids = quiz_index.draw_many(category_id, seen, count - len(questions))
+                if not question_ids:
+                    break
+
+                found = load_questions_by_id(question_ids)
 
+                for question_id in question_ids:
+                    seen.add(question_id)
+                    if question_id in found:
+                        questions.append(found[question_id])
+                    else:
+                        # deleted by another worker since the index was built
+                        quiz_index.remove(question_id)
+        except SQLAlchemyError:
+            abort(500)
+
+        return json_response({
+            'questions': questions
+        })
+
+    @app.route('/quizzes/sessions', methods=['POST'])
+    @admitted('quiz')
+    def start_quiz_session():
+        ''' Starts a quiz session, so the client doesn't have to send previous_questions on every call.
+        The questions of the chosen category are shuffled once into a deck that is kept on the server,
+        in the database so any worker can serve the session, see /quizzes/sessions/<session_id>/next
+        for drawing from it. Both routes write the deck, so they don't read from replicas.
+
+        :return: JSON with the session_id to send with each next call and the number of questions in the deck
+        '''
+        json_data = request.get_json()
+
+        category_id = quiz_category_id(json_data['quiz_category'])
+        # a client switching from the stateless mode can hand over the questions it already asked
+        previous_questions = json_data.get('previous_questions') or []
+        if not isinstance(previous_questions, list) or \
+                not all(isinstance(question_id, int) for question_id in previous_questions):
+            abort(422)
+        seen = set(previous_questions)
+
+        try:
+            refresh_quiz_index()
+        except SQLAlchemyError:
+            abort(500)
+
+        deck = [question_id for question_id in quiz_index.ids(category_id) if question_id not in seen]
+        random.shuffle(deck)
+
+        try:
+            session_id = quiz_sessions.create(deck)
+        except SQLAlchemyError:
+            abort(500)
+
+        return jsonify({
+            'success': True,
+            'session_id': session_id,
+            'total_questions': len(deck)
+        })
+
+    @app.route('/quizzes/sessions/<session_id>/next', methods=['POST'])
+    @admitted('quiz')
+    def next_quiz_session_question(session_id):
+        ''' Pops the next question off a quiz session's deck
+
+        :param session_id: the session_id returned by /quizzes/sessions
+        :return: JSON with the next question, or None once the deck is used up, same as /quizzes
+        '''
         question_to_return = None
-        for question in questions:
-            if question.id not in previous_questions:
-                question_to_return = question
-                break
-
-        # need to check if all the questions were used up and question_to_return is None
-        # if question_to_return is None:
-        if question_to_return is None:
-            question_dict = None
-        else:
-            question_dict = {
-                'id': question_to_return.id,
-                'question': question_to_return.question,
-                'answer': question_to_return.answer,
-                'difficulty': question_to_return.difficulty,
-                'category': question_to_return.category
-            }
 
+        try:
+            while question_to_return is None:
+                question_id = quiz_sessions.pop(session_id)
+                if question_id is None:
+                    break
+                # the question may have been deleted since the deck was shuffled, then we skip it
+                question_to_return = load_question(question_id)
+        except KeyError:
+            # unknown or expired session
+            abort(404)
+        except SQLAlchemyError:
+            abort(500)
+
+        return json_response({
+            'question': question_to_return
+        })
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        ''' Exposes the request and database metrics of this worker in the Prometheus text format
+
+        :return: text/plain metrics, latency per route, SQL statements and time per request, pool checkout waits
+        '''
+        return app.response_class(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    @app.route('/healthz', methods=['GET'])
+    def liveness():
+        ''' Liveness probe, answers as long as the worker can handle requests, without touching the database '''
         return jsonify({
-            'question': question_dict
+            'success': True
         })
 
+    @app.route('/readyz', methods=['GET'])
+    def readiness():
+        ''' Readiness probe, 200 once this worker is warmed up and can reach the database, 503 until then.
+        A worker that wasn't warmed up by the server hook is warmed up by its first probe.
+
+        :return: JSON with readiness and the seconds each warm-up step took
+        '''
+        # before the database check, the warm-up requests replace this thread's session
+        warm_up.run()
+        stats = warm_up.stats()
+
+        try:
+            db.session.execute('SELECT 1')
+        except SQLAlchemyError:
+            stats['ready'] = False
+
+        return jsonify(dict(stats, success=stats['ready'])), 200 if stats['ready'] else 503
+
     @app.errorhandler(werkzeug.exceptions.BadRequest)
     def handle_bad_request(e):
         ''' Werkzeug 400 error handler for 400 errors -- usually these are bad routes. '''
@@ -286,6 +1141,15 @@ def create_app(test_config=None):
             "message": "bad request type"
         }), 405
 
+    @app.errorhandler(415)
+    def unsupported_media_type(error):
+        ''' Handles 415 errors, indicating an upload in a format the route doesn't read'''
+        return jsonify({
+            "success": False,
+            "error": 415,
+            "message": "unsupported media type"
+        }), 415
+
     @app.errorhandler(422)
     def unprocessable(error):
         ''' Handles 422 errors, which are not currently thrown by any "try...except" clause. '''
@@ -304,5 +1168,35 @@ def create_app(test_config=None):
             "message": "unprocessable"
         }), 500
 
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        ''' Handles 503 errors, a request shed by admission control because its route was at its limit'''
+        response = jsonify({
+            "success": False,
+            "error": 503,
+            "message": "service unavailable"
+        })
+        response.headers['Retry-After'] = str(app.config.get('ADMISSION_RETRY_AFTER', ADMISSION_RETRY_AFTER))
+        return response, 503
+
+    @app.cli.command('init-db')
+    def init_db():
+        ''' Creates the tables of a new database, run once with: flask init-db
+
+        Tables that already exist are left alone, existing databases are upgraded with the migrations.
+        '''
+        db.create_all()
+        question_counts.rebuild()
+        db.session.commit()
+        click.echo('Created the tables in {}'.format(repr(db.engine.url)))
+
+    @app.cli.command('rebuild-counts')
+    def rebuild_counts():
+        ''' Recounts the questions per category and difficulty, e.g. after deleting categories by hand '''
+        question_counts.rebuild()
+        dataset_version.bump()
+        db.session.commit()
+        click.echo('Recounted the questions')
+
     return app
 
@@ -0,0 +1,227 @@
+'''
+Admission control for the expensive routes. Each class of routes (search, quizzes, export, bulk
+writes) may run a limited number of requests at once per process, a bounded number more wait for a
+free slot, and a waiting request gives up after its deadline. A request that finds the queue full
+or runs out of time is shed with a fast 503 instead of tying up a worker, so an overload of slow
+requests can't starve the cheap routes like /categories, which have no limit.
+
+A waiting request holds a server thread too, so the limits are derived from the threads per process,
+and all the limited classes together share a budget of one thread less: a mixed flood of searches
+and quizzes still leaves a thread for the unlimited routes.
+'''
+
+import asyncio
+import threading
+import time
+
+from .metrics import Counter
+
+# server threads per process the limits are derived from, the gunicorn threads of a worker by default
+ADMISSION_THREADS = 8
+# route class -> (share of the threads running it at once, share of the threads waiting for it at most,
+# seconds a request waits at most)
+ADMISSION_SHARES = {
+    'search': (0.25, 0.25, 1.0),
+    'quiz': (0.5, 0.25, 0.5),
+    'suggest': (0.5, 0.25, 0.5),
+    'export': (0.125, 0, 0),
+    'bulk': (0.125, 0.125, 5.0),
+}
+# seconds a shed client is told to wait before retrying
+ADMISSION_RETRY_AFTER = 1
+
+# reasons a request is shed, the label of the shed counter
+QUEUE_FULL = 'queue_full'
+DEADLINE = 'deadline'
+# the limited classes together hold as many threads as they may
+BUDGET_FULL = 'budget_full'
+
+
+def admission_limits(threads):
+    ''' Derives the limit of every route class from the server threads per process
+
+    :param threads: threads a process serves requests with
+    :return: dict of route class -> (requests running at once, requests waiting at most, seconds a request
+    waits at most), running and waiting together leave at least one thread free if there are two or more
+    '''
+    limits = {}
+    for name, (running, waiting, timeout) in ADMISSION_SHARES.items():
+        concurrency = max(1, int(threads * running))
+        queue_size = max(0, min(int(threads * waiting), threads - 1 - concurrency))
+        limits[name] = (concurrency, queue_size, timeout)
+    return limits
+
+
+class AdmissionBudget:
+    ''' Counts the requests running or waiting in any limited class, which may not exceed size '''
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        ''' Takes a unit of the budget without waiting, False if none is left '''
+        with self._lock:
+            if self.used >= self.size:
+                return False
+            self.used += 1
+            return True
+
+    def give(self):
+        with self._lock:
+            self.used -= 1
+
+
+class ConcurrencyLimit:
+    ''' Counting limit with a bounded wait queue, for requests running in threads '''
+
+    def __init__(self, concurrency, queue_size, timeout, budget=None):
+        ''' Creates a limit
+
+        :param concurrency: requests that may hold the limit at once
+        :param queue_size: requests that may wait for it at once, more are refused right away
+        :param timeout: seconds a request waits at most
+        :param budget: optional AdmissionBudget shared with other limits, held while running or waiting
+        '''
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.budget = budget
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        ''' Takes a slot, waiting for one if needed
+
+        :return: None once the slot is taken, else the reason the request is shed, BUDGET_FULL, QUEUE_FULL or
+        DEADLINE
+        '''
+        if self.budget is not None and not self.budget.take():
+            return BUDGET_FULL
+        reason = self._acquire()
+        if reason is not None and self.budget is not None:
+            self.budget.give()
+        return reason
+
+    def _acquire(self):
+        with self._condition:
+            if self.active < self.concurrency:
+                self.active += 1
+                return None
+            if self.waiting >= self.queue_size:
+                return QUEUE_FULL
+
+            deadline = time.monotonic() + self.timeout
+            self.waiting += 1
+            try:
+                while self.active >= self.concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return DEADLINE
+                    self._condition.wait(remaining)
+                self.active += 1
+                return None
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+        if self.budget is not None:
+            self.budget.give()
+
+
+class AsyncConcurrencyLimit:
+    ''' The same limit for coroutines running on one event loop, see ConcurrencyLimit '''
+
+    def __init__(self, concurrency, queue_size, timeout, budget=None):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.budget = budget
+        self.active = 0
+        self.waiting = 0
+        self._condition = None
+
+    async def acquire(self):
+        if self.budget is not None and not self.budget.take():
+            return BUDGET_FULL
+        reason = await self._acquire()
+        if reason is not None and self.budget is not None:
+            self.budget.give()
+        return reason
+
+    async def _acquire(self):
+        if self.active < self.concurrency:
+            self.active += 1
+            return None
+        if self.waiting >= self.queue_size:
+            return QUEUE_FULL
+
+        if self._condition is None:
+            # created on first use, inside the server's event loop
+            self._condition = asyncio.Condition()
+        self.waiting += 1
+        try:
+            async with self._condition:
+                await asyncio.wait_for(
+                    self._condition.wait_for(lambda: self.active < self.concurrency), self.timeout)
+            self.active += 1
+            return None
+        except asyncio.TimeoutError:
+            return DEADLINE
+        finally:
+            self.waiting -= 1
+
+    async def release(self):
+        self.active -= 1
+        if self.budget is not None:
+            self.budget.give()
+        if self._condition is not None:
+            async with self._condition:
+                self._condition.notify()
+
+
+class AdmissionControl:
+    ''' The limits of every route class of one app, and the counters of the requests they shed '''
+
+    def __init__(self, limits=None, metrics=None, limit_class=ConcurrencyLimit, threads=ADMISSION_THREADS):
+        ''' Creates the limits
+
+        :param limits: dict of route class -> (concurrency, queue size, timeout) or None, merged into the limits
+        derived from threads
+        :param metrics: optional Metrics to count the shed requests in
+        :param limit_class: ConcurrencyLimit, or AsyncConcurrencyLimit for the ASGI handlers
+        :param threads: server threads per process, see admission_limits
+        '''
+        self.threads = threads
+        # shared by every class, so they can't take every thread between them either
+        self.budget = AdmissionBudget(max(1, threads - 1))
+        limits = dict(admission_limits(threads), **(limits or {}))
+        self.limits = {name: limit_class(*spec, budget=self.budget) for name, spec in limits.items() if spec is not None}
+        self.metrics = metrics
+        self.shed = Counter('trivia_requests_shed_total', 'Requests refused with a 503 by admission control, '
+                                                          'by route class and reason.')
+        if metrics is not None:
+            # the Flask app and its ASGI wrapper share one counter
+            existing = [metric for metric in metrics.registry if metric.name == self.shed.name]
+            self.shed = existing[0] if existing else metrics.add(self.shed)
+
+    def limit(self, name):
+        ''' The limit of a route class, None if it has none '''
+        return self.limits.get(name)
+
+    def count_shed(self, name, reason):
+        labels = (('route_class', name), ('reason', reason))
+        if self.metrics is not None:
+            self.metrics.inc(self.shed, labels)
+        else:
+            self.shed.inc(labels)
+
+    def stats(self):
+        ''' Requests running and waiting per route class, for monitoring, the shared budget is in self.budget '''
+        return {name: {'active': limit.active, 'waiting': limit.waiting, 'concurrency': limit.concurrency,
+                       'queue_size': limit.queue_size} for name, limit in self.limits.items()}
@@ -0,0 +1,419 @@
+'''
+Optional ASGI entry point. GET /questions, POST /questions (search) and POST /quizzes are answered
+by coroutines that query Postgres through an asyncpg connection pool, so a request waiting on the
+database doesn't hold a worker thread and one process can keep hundreds of them in flight. Every
+other route, and any request these handlers don't accept as valid, is passed on unchanged to the
+Flask app from create_app, which runs in asgiref's thread pool. The JSON of both paths is the same,
+and both share the Flask app's category cache, quiz index, response cache and metrics.
+
+Needs the optional asyncpg and asgiref packages and a Postgres database, run it with e.g.:
+    pip install asyncpg asgiref uvicorn
+    uvicorn --factory flaskr.asgi:create_asgi_app --workers 4
+'''
+
+import asyncio
+import json
+import time
+from urllib.parse import parse_qsl
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+from sqlalchemy.engine.url import make_url
+from werkzeug.http import parse_etags
+
+from . import create_app, QUESTIONS_PER_PAGE
+from .admission import AdmissionControl, AsyncConcurrencyLimit, ADMISSION_RETRY_AFTER
+from .pagination import encode_cursor, decode_cursor
+from .queries import postgresql_sql, select_questions, select_quiz_index
+from .search import SEARCH_CONFIG
+from .serializers import get_serializer
+from .versioning import VERSION_ROW_ID
+
+# connections in the asyncpg pool of each process
+ASYNC_POOL_SIZE = 20
+
+# the Flask routes' statements as SQL text, the async routes add their WHERE, ORDER BY and LIMIT to them
+SELECT_QUESTIONS = postgresql_sql(select_questions())
+SELECT_QUIZ_INDEX = postgresql_sql(select_quiz_index())
+# same body as the Flask app's 500 handler
+INTERNAL_ERROR = {'success': False, 'error': 500, 'message': 'unprocessable'}
+SERVICE_UNAVAILABLE = {'success': False, 'error': 503, 'message': 'service unavailable'}
+
+
+def asyncpg_dsn(database_url):
+    ''' Turns a SQLAlchemy database URL into a DSN asyncpg accepts
+
+    :raises ValueError: if the URL isn't a Postgres one
+    '''
+    url = make_url(database_url)
+    if url.get_backend_name() != 'postgresql':
+        raise ValueError('the ASGI mode needs a Postgres database, got {}'.format(url.drivername))
+    # drop the driver, e.g. postgresql+psycopg2://
+    url.drivername = 'postgresql'
+    return str(url)
+
+
+def create_asgi_app(test_config=None):
+    ''' Creates the Flask app with create_app and wraps it in the ASGI app '''
+    return AsyncTrivia(create_app(test_config))
+
+
+class AsyncTrivia:
+    ''' ASGI app answering the hot read routes itself and handing everything else to the Flask app '''
+
+    def __init__(self, flask_app):
+        if asyncpg is None or WsgiToAsgi is None:
+            raise RuntimeError('the ASGI mode needs the asyncpg and asgiref packages')
+
+        config = flask_app.config
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.dsn = asyncpg_dsn(config.get('ASYNC_DATABASE_URL') or config['SQLALCHEMY_DATABASE_URI'])
+        self.pool_size = config.get('ASYNC_POOL_SIZE', ASYNC_POOL_SIZE)
+        self.pool = None
+        self.dumps = get_serializer(config.get('JSON_SERIALIZER', 'auto'))
+        self.server_timing = config.get('SERVER_TIMING', False)
+        self.full_text = config.get('SEARCH_FULL_TEXT')
+
+        extensions = flask_app.extensions
+        self.metrics = extensions['metrics']
+        self.category_cache = extensions['category_cache']
+        self.response_cache = extensions['response_cache']
+        self.quiz_index = extensions['quiz_index']
+        self.compressor = extensions.get('compressor')
+
+        self.routes = {
+            ('GET', '/questions'): self.get_questions,
+            ('POST', '/questions'): self.search_questions,
+            ('POST', '/quizzes'): self.get_quiz_questions,
+        }
+        # the same limits as the Flask routes, kept by the event loop, and the same shed counter
+        self.admission = AdmissionControl(config.get('ADMISSION_LIMITS'), self.metrics,
+                                          limit_class=AsyncConcurrencyLimit, threads=extensions['admission'].threads)
+        self.route_classes = {
+            ('POST', '/questions'): 'search',
+            ('POST', '/quizzes'): 'quiz',
+        }
+        self.retry_after = str(config.get('ADMISSION_RETRY_AFTER', ADMISSION_RETRY_AFTER)).encode('ascii')
+        # the snapshot already answers these without waiting on the database
+        if extensions.get('snapshot') is not None:
+            self.routes = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        route = (scope.get('method'), scope.get('path'))
+        handler = self.routes.get(route) if scope['type'] == 'http' else None
+        if handler is None:
+            await self.wsgi(scope, receive, send)
+            return
+
+        body = await read_body(receive)
+        started = time.perf_counter()
+        stats = {'statements': 0, 'seconds': 0.0}
+
+        route_class = self.route_classes.get(route)
+        limit = self.admission.limit(route_class)
+        shed_reason = await limit.acquire() if limit is not None else None
+        if shed_reason is not None:
+            self.admission.count_shed(route_class, shed_reason)
+            response = (503, self.dumps(SERVICE_UNAVAILABLE), [(b'retry-after', self.retry_after)], None)
+        else:
+            try:
+                response = await handler(scope, body, stats)
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError):
+                response = (500, self.dumps(INTERNAL_ERROR), [], None)
+            finally:
+                if limit is not None:
+                    await limit.release()
+
+        if response is None:
+            # not something this handler accepts, let the Flask route answer it, errors included
+            await self.wsgi(scope, replay_body(body), send)
+            return
+
+        status, payload, headers, cache_key = response
+        if self.compressor is not None and status == 200:
+            # the same negotiation and cached compressed bodies as the Flask app's compress_response
+            headers = headers + [(b'vary', b'Accept-Encoding')]
+            encoding = self.compressor.choose(header(scope, b'accept-encoding'), len(payload))
+            if encoding is not None:
+                payload = self.compressor.compress(payload, encoding, cache_key)
+                headers = [(name, b'W/' + value if name == b'etag' else value) for name, value in headers]
+                headers.append((b'content-encoding', encoding.encode('ascii')))
+
+        duration = time.perf_counter() - started
+        self.record(scope, status, duration, stats)
+
+        headers = headers + [(b'access-control-allow-headers', b'Content-Type,Authorization,true'),
+                             (b'access-control-allow-methods', b'GET,PUT,POST,PATCH,DELETE,OPTIONS')]
+        if any(name == b'origin' for name, _ in scope.get('headers', ())):
+            headers.append((b'access-control-allow-origin', b'*'))
+        if payload is not None:
+            headers.append((b'content-type', b'application/json'))
+        if self.server_timing:
+            headers.append((b'server-timing', 'app;dur={:.2f}, db;dur={:.2f};desc="{} queries"'.format(
+                duration * 1000, stats['seconds'] * 1000, stats['statements']).encode('latin-1')))
+
+        payload = payload or b''
+        headers.append((b'content-length', str(len(payload)).encode('ascii')))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': payload})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.get_pool()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.pool is not None:
+                    await self.pool.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def get_pool(self):
+        ''' Returns the asyncpg pool, created on first use when the server doesn't send lifespan events '''
+        if self.pool is None:
+            pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=self.pool_size)
+            if self.pool is None:
+                self.pool = pool
+            else:
+                await pool.close()
+        return self.pool
+
+    def record(self, scope, status, duration, stats):
+        ''' Feeds the request into the same /metrics series the Flask routes use '''
+        route = scope['path']
+        self.metrics.observe(self.metrics.request_duration, duration,
+                             (('route', route), ('method', scope['method']), ('status', status)))
+        self.metrics.observe(self.metrics.request_statements, stats['statements'], (('route', route),))
+        self.metrics.observe(self.metrics.request_db_time, stats['seconds'], (('route', route),))
+
+    @staticmethod
+    async def query(connection, stats, method, statement, *args):
+        ''' Runs one statement with connection.fetch, fetchrow or fetchval and counts it in stats '''
+        started = time.perf_counter()
+        try:
+            return await getattr(connection, method)(statement, *args)
+        finally:
+            stats['statements'] += 1
+            stats['seconds'] += time.perf_counter() - started
+
+    async def refresh_category_cache(self, connection, stats):
+        if self.category_cache.is_stale():
+            self.category_cache.load(
+                [tuple(row) for row in await self.query(connection, stats, 'fetch', 'SELECT id, type FROM categories')])
+
+    async def total_questions(self, connection, stats):
+        ''' Reads the total from the stored counts, counting the rows if there are none or no counts table,
+        like QuestionCounts.total '''
+        try:
+            total = await self.query(connection, stats, 'fetchval', 'SELECT sum(count) FROM question_counts')
+        except asyncpg.UndefinedTableError:
+            total = None
+        if total is None:
+            total = await self.query(connection, stats, 'fetchval', 'SELECT count(id) FROM questions')
+        return int(total)
+
+    async def get_questions(self, scope, body, stats):
+        ''' Async GET /questions, with the same ETag, 304 and response cache handling as the Flask route '''
+        args = parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True)
+        arguments = dict(args)
+
+        try:
+            page_num = int(arguments.get('page', 1))
+        except ValueError:
+            page_num = 1
+        if page_num < 1:
+            return None
+
+        after = None
+        if 'after' in arguments:
+            try:
+                after = decode_cursor(arguments['after'])
+            except ValueError:
+                return None
+
+        pool = await self.get_pool()
+        async with pool.acquire() as connection:
+            version = await self.query(connection, stats, 'fetchval',
+                                       'SELECT version FROM dataset_version WHERE id = $1', VERSION_ROW_ID)
+            await self.refresh_category_cache(connection, stats)
+            categories = self.category_cache.by_id
+            if version is None or 1 not in categories:
+                # no version row yet, or no category to show, the Flask route knows what to do
+                return None
+
+            etag = 'q{}-{}'.format(version, self.category_cache.digest)
+            etag_headers = [(b'etag', '"{}"'.format(etag).encode('latin-1'))]
+
+            if_none_match = header(scope, b'if-none-match')
+            if if_none_match is not None and parse_etags(if_none_match).contains_weak(etag):
+                return 304, None, etag_headers, None
+
+            key = (scope['path'], tuple(sorted(args)), etag)
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                return 200, cached, etag_headers, key
+
+            if after is not None:
+                rows = await self.query(connection, stats, 'fetch',
+                                        SELECT_QUESTIONS + ' WHERE id > $1 ORDER BY id LIMIT $2',
+                                        after, QUESTIONS_PER_PAGE)
+            else:
+                rows = await self.query(connection, stats, 'fetch',
+                                        SELECT_QUESTIONS + ' ORDER BY id LIMIT $1 OFFSET $2',
+                                        QUESTIONS_PER_PAGE, (page_num - 1) * QUESTIONS_PER_PAGE)
+            total_questions = await self.total_questions(connection, stats)
+
+        questions = [dict(row) for row in rows]
+        payload = self.dumps({
+            'questions': questions,
+            'total_questions': total_questions,
+            'categories': categories,
+            'category': categories[1],
+            'next_cursor': encode_cursor(questions[-1]['id']) if len(questions) == QUESTIONS_PER_PAGE else None
+        })
+        self.response_cache.put(key, payload)
+        return 200, payload, etag_headers, key
+
+    async def uses_full_text(self, connection, stats):
+        ''' True if the questions table has the search_vector column, checked once like QuestionSearch does '''
+        if self.full_text is None:
+            self.full_text = await self.query(
+                connection, stats, 'fetchval',
+                "SELECT EXISTS (SELECT 1 FROM information_schema.columns "
+                "WHERE table_name = 'questions' AND column_name = 'search_vector')")
+        return self.full_text
+
+    async def search_questions(self, scope, body, stats):
+        ''' Async POST /questions, the same ranked full-text or substring search as QuestionSearch '''
+        try:
+            json_data = json.loads(body)
+            search_term = json_data['searchTerm']
+            page_num = json_data.get('page')
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return None
+        if not isinstance(search_term, str) or \
+                (page_num is not None and (not isinstance(page_num, int) or page_num < 1)):
+            return None
+
+        contains_term = '%' + search_term + '%'
+        # every match without a page, LIMIT NULL is no limit on Postgres
+        limit = QUESTIONS_PER_PAGE if page_num is not None else None
+        offset = (page_num - 1) * QUESTIONS_PER_PAGE if page_num is not None else 0
+
+        pool = await self.get_pool()
+        async with pool.acquire() as connection:
+            if await self.uses_full_text(connection, stats):
+                match = "(search_vector @@ plainto_tsquery('{0}', $1) OR question ILIKE $2)".format(SEARCH_CONFIG)
+                rows = await self.query(
+                    connection, stats, 'fetch',
+                    SELECT_QUESTIONS + ' WHERE ' + match +
+                    " ORDER BY ts_rank(search_vector, plainto_tsquery('{0}', $1)) DESC, id"
+                    " LIMIT $3 OFFSET $4".format(SEARCH_CONFIG),
+                    search_term, contains_term, limit, offset)
+                total_questions = await self.query(connection, stats, 'fetchval',
+                                                   'SELECT count(id) FROM questions WHERE ' + match,
+                                                   search_term, contains_term)
+            else:
+                rows = await self.query(connection, stats, 'fetch',
+                                        SELECT_QUESTIONS + ' WHERE question ILIKE $1 ORDER BY id LIMIT $2 OFFSET $3',
+                                        contains_term, limit, offset)
+                total_questions = await self.query(connection, stats, 'fetchval',
+                                                   'SELECT count(id) FROM questions WHERE question ILIKE $1',
+                                                   contains_term)
+
+        return 200, self.dumps({
+            'questions': [dict(row) for row in rows],
+            'total_questions': total_questions,
+            'current_category': None,
+            'category': None
+        }), [], None
+
+    async def get_quiz_questions(self, scope, body, stats):
+        ''' Async POST /quizzes, draws from the shared quiz index and loads the drawn question '''
+        try:
+            json_data = json.loads(body)
+            seen = set(json_data['previous_questions'])
+            category = json_data['quiz_category']
+            category_id = None if category['type'] == 'click' else int(category['id']) + 1
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return None
+
+        # loading and drawing take the quiz index's lock, which Flask threads hold too, so they run in the
+        # default executor instead of blocking the event loop
+        loop = asyncio.get_event_loop()
+        pool = await self.get_pool()
+        async with pool.acquire() as connection:
+            # one request reloads a stale index, like the Flask routes, the others draw from the current one
+            if self.quiz_index.is_stale():
+                if self.quiz_index.start_reload(wait=False):
+                    try:
+                        rows = [tuple(row) for row in await self.query(connection, stats, 'fetch', SELECT_QUIZ_INDEX)]
+                        await loop.run_in_executor(None, self.quiz_index.load, rows)
+                    finally:
+                        self.quiz_index.finish_reload()
+                elif not self.quiz_index.populated:
+                    # the first load is still running, the Flask route waits for it on a thread, not on the loop
+                    return None
+
+            question = None
+            while True:
+                question_id = await loop.run_in_executor(None, self.quiz_index.draw, category_id, seen)
+                if question_id is None:
+                    break
+                row = await self.query(connection, stats, 'fetchrow', SELECT_QUESTIONS + ' WHERE id = $1', question_id)
+                if row is not None:
+                    question = dict(row)
+                    break
+                # deleted by another worker since the index was built
+                await loop.run_in_executor(None, self.quiz_index.remove, question_id)
+
+        return 200, self.dumps({'question': question}), [], None
+
+
+async def read_body(receive):
+    ''' Reads the whole request body from the ASGI receive channel '''
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+    return b''.join(chunks)
+
+
+def replay_body(body):
+    ''' Returns a receive channel that hands out an already read body again, for passing a request on '''
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        return {'type': 'http.disconnect'}
+
+    return receive
+
+
+def header(scope, name):
+    ''' Returns the value of a request header, or None '''
+    for header_name, value in scope.get('headers', ()):
+        if header_name == name:
+            return value.decode('latin-1')
+    return None
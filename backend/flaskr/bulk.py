@@ -0,0 +1,270 @@
+'''
+Bulk question import used by POST /questions/bulk. The upload is read line by line as it
+arrives, each row is validated on its own, and valid rows are inserted in batches with one
+multi-row INSERT and one commit per batch, so neither the upload nor the rows are ever held
+in memory as a whole.
+
+Also the bulk DELETE /questions and PATCH /questions, which select questions by a list of ids
+and/or a category and difficulty, and change or remove all of them with one statement.
+'''
+
+import csv
+import json
+
+from sqlalchemy import and_, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, Question
+
+# columns a CSV upload must have in its header row
+CSV_FIELDS = ('question', 'answer', 'difficulty', 'category')
+# only the first errors are reported, an upload in the wrong format would otherwise fill the response
+MAX_REPORTED_ERRORS = 100
+
+
+def read_ndjson(lines):
+    ''' Parses newline-delimited JSON, one question object per line, blank lines are skipped
+
+    :param lines: iterable of decoded lines
+    :return: generator of (line number, row dict or None, error message or None)
+    '''
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield line_number, None, 'invalid JSON: {}'.format(error)
+            continue
+        if not isinstance(row, dict):
+            yield line_number, None, 'expected a JSON object'
+            continue
+        yield line_number, row, None
+
+
+def read_csv(lines):
+    ''' Parses CSV with a header row naming the question, answer, difficulty and category columns
+
+    :param lines: iterable of decoded lines
+    :return: generator of (line number, row dict or None, error message or None)
+    '''
+    reader = csv.DictReader(lines)
+    if reader.fieldnames is None or not set(CSV_FIELDS) <= set(reader.fieldnames):
+        yield 1, None, 'CSV header must contain the columns {}'.format(', '.join(CSV_FIELDS))
+        return
+
+    for row in reader:
+        yield reader.line_num, row, None
+
+
+def _integer(value, field):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError('{} must be an integer'.format(field))
+    return value
+
+
+def _difficulty(value, field):
+    if not 1 <= _integer(value, field) <= 5:
+        raise ValueError('{} must be between 1 and 5'.format(field))
+    return value
+
+
+def _row_integer(value, field):
+    ''' Reads an integer from an NDJSON number or a CSV string, without truncating 3.7 or taking true as 1 '''
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        try:
+            return int(value.strip())
+        except ValueError:
+            pass
+    return _integer(value, field)
+
+
+def validate_question(row, category_ids):
+    ''' Checks one uploaded row and turns it into the values for an INSERT
+
+    :param row: dict read from the upload
+    :param category_ids: ids of the categories that exist, the category is a database id, not the
+    0-indexed id the frontend sends to /add_question
+    :return: dict of column values
+    :raises ValueError: with a message saying what is wrong with the row
+    '''
+    values = {}
+
+    for field in ('question', 'answer'):
+        text = row.get(field)
+        if not isinstance(text, str) or not text.strip():
+            raise ValueError('{} is required'.format(field))
+        values[field] = text
+
+    for field in ('difficulty', 'category'):
+        values[field] = _row_integer(row.get(field), field)
+
+    if not 1 <= values['difficulty'] <= 5:
+        raise ValueError('difficulty must be between 1 and 5')
+    if values['category'] not in category_ids:
+        raise ValueError('category {} does not exist'.format(values['category']))
+
+    return values
+
+
+def import_questions(rows, category_ids, batch_size, before_commit=None):
+    ''' Validates and inserts parsed rows, one transaction per batch
+
+    A batch that fails in the database is rolled back and reported, the following batches are
+    still inserted.
+
+    :param rows: generator from read_ndjson or read_csv
+    :param category_ids: ids of the categories that exist
+    :param batch_size: number of rows inserted per statement and transaction
+    :param before_commit: optional function called with the list of row values of each batch, in the batch's
+    transaction before it is committed
+    :return: dict with the total inserted, per-batch results and the first row-level errors
+    '''
+    result = {
+        'inserted': 0,
+        'rejected': 0,
+        'batches': [],
+        'errors': []
+    }
+    batch = []
+
+    def flush():
+        batch_result = {
+            'batch': len(result['batches']) + 1,
+            'rows': len(batch)
+        }
+        try:
+            db.session.execute(Question.__table__.insert(), batch)
+            if before_commit is not None:
+                before_commit(batch)
+            db.session.commit()
+            batch_result['inserted'] = len(batch)
+            result['inserted'] += len(batch)
+        except SQLAlchemyError:
+            db.session.rollback()
+            batch_result['inserted'] = 0
+            batch_result['error'] = 'database error, batch rolled back'
+        result['batches'].append(batch_result)
+        batch.clear()
+
+    for line_number, row, error in rows:
+        if error is None:
+            try:
+                batch.append(validate_question(row, category_ids))
+            except ValueError as invalid:
+                error = str(invalid)
+
+        if error is not None:
+            result['rejected'] += 1
+            if len(result['errors']) < MAX_REPORTED_ERRORS:
+                result['errors'].append({'line': line_number, 'error': error})
+            continue
+
+        if len(batch) >= batch_size:
+            flush()
+
+    if batch:
+        flush()
+
+    return result
+
+
+def question_criteria(body, max_ids):
+    ''' Turns the selection of a bulk DELETE or PATCH into the WHERE clause of its statement
+
+    :param body: dict with ids, a list of question ids, and/or category (a database id) and difficulty,
+    every one given must match
+    :param max_ids: the most ids one request may list
+    :return: SQLAlchemy condition on the questions table
+    :raises ValueError: if nothing is selected or a value is invalid, so a request can't change every question by mistake
+    '''
+    table = Question.__table__
+    conditions = []
+
+    if 'ids' in body:
+        ids = body['ids']
+        if not isinstance(ids, list) or not ids:
+            raise ValueError('ids must be a non-empty list')
+        if len(ids) > max_ids:
+            raise ValueError('at most {} ids can be sent at once'.format(max_ids))
+        conditions.append(table.c.id.in_(sorted({_integer(question_id, 'ids') for question_id in ids})))
+    if 'category' in body:
+        conditions.append(table.c.category == _integer(body['category'], 'category'))
+    if 'difficulty' in body:
+        conditions.append(table.c.difficulty == _difficulty(body['difficulty'], 'difficulty'))
+
+    if not conditions:
+        raise ValueError('select the questions with ids, category or difficulty')
+    return and_(*conditions)
+
+
+def question_changes(changes, category_ids):
+    ''' Checks the set object of a bulk PATCH
+
+    :param changes: dict with the new category (a database id) and/or difficulty
+    :param category_ids: ids of the categories that exist
+    :return: dict of column values for the UPDATE
+    :raises ValueError: if nothing is changed or a value is invalid
+    '''
+    if not isinstance(changes, dict):
+        raise ValueError('set must be an object')
+    unknown = set(changes) - {'category', 'difficulty'}
+    if unknown:
+        raise ValueError('only category and difficulty can be changed, not {}'.format(', '.join(sorted(unknown))))
+
+    values = {}
+    if 'category' in changes:
+        values['category'] = _integer(changes['category'], 'category')
+        if values['category'] not in category_ids:
+            raise ValueError('category {} does not exist'.format(values['category']))
+    if 'difficulty' in changes:
+        values['difficulty'] = _difficulty(changes['difficulty'], 'difficulty')
+
+    if not values:
+        raise ValueError('set must contain category or difficulty')
+    return values
+
+
+def _returns_rows():
+    # DELETE and UPDATE ... RETURNING, other databases read the rows with a SELECT first
+    return db.engine.dialect.name == 'postgresql'
+
+
+def delete_questions(condition):
+    ''' Deletes every question matching condition with one DELETE, in the current transaction
+
+    :return: list of (id, category, difficulty) of the deleted questions
+    '''
+    table = Question.__table__
+
+    if _returns_rows():
+        return db.session.execute(
+            table.delete().where(condition).returning(table.c.id, table.c.category, table.c.difficulty)).fetchall()
+
+    rows = db.session.execute(select([table.c.id, table.c.category, table.c.difficulty]).where(condition)).fetchall()
+    if rows:
+        db.session.execute(table.delete().where(condition))
+    return rows
+
+
+def update_questions(condition, values):
+    ''' Sets values on every question matching condition with one UPDATE, in the current transaction
+
+    :return: list of (id, category, difficulty) of the updated questions, with the values from before the update
+    '''
+    table = Question.__table__
+    before = select([table.c.id, table.c.category, table.c.difficulty]).where(condition)
+
+    if _returns_rows():
+        # the FOR UPDATE subquery locks the rows and reads their old values, UPDATE ... FROM joins it
+        old = before.with_for_update().alias('old')
+        return db.session.execute(
+            table.update().where(table.c.id == old.c.id).values(**values)
+            .returning(old.c.id, old.c.category, old.c.difficulty)).fetchall()
+
+    rows = db.session.execute(before).fetchall()
+    if rows:
+        db.session.execute(table.update().where(condition).values(**values))
+    return rows
@@ -0,0 +1,103 @@
+'''
+Process-local caches. Categories almost never change, so they are loaded once and served from
+memory as a ready made id -> type map and list, instead of running Category.query.all() on every
+request. Rendered JSON bodies of the read routes are kept in a small LRU cache keyed by the
+dataset version, so a new version simply stops hitting the old entries.
+'''
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class CategoryCache:
+    ''' Holds the categories as loaded from the database, reloaded after ttl seconds or when invalidated '''
+
+    def __init__(self, ttl=None):
+        ''' Creates an empty cache
+
+        :param ttl: seconds after which the categories are reloaded, None keeps them until invalidate is called
+        '''
+        self.ttl = ttl
+        # (id -> type map, list of types ordered by id), replaced as a whole so readers never see half a load
+        self._categories = ({}, [])
+        self._digest = None
+        self._loaded_at = None
+
+    def load(self, rows):
+        ''' Replaces the cached categories
+
+        :param rows: iterable of (category id, type) pairs
+        '''
+        by_id = dict(sorted(rows))
+        self._categories = (by_id, list(by_id.values()))
+        self._digest = hashlib.sha1(json.dumps(sorted(by_id.items())).encode('utf-8')).hexdigest()[:12]
+        self._loaded_at = time.monotonic()
+
+    def is_stale(self):
+        ''' True if the cache was never loaded, was invalidated or is older than its ttl '''
+        if self._loaded_at is None:
+            return True
+        if self.ttl is None:
+            return False
+        return time.monotonic() - self._loaded_at > self.ttl
+
+    def invalidate(self):
+        ''' Hook for anything that changes the categories table, the next request reloads it '''
+        self._loaded_at = None
+
+    @property
+    def by_id(self):
+        ''' Dict of category id -> type, callers must not modify it '''
+        return self._categories[0]
+
+    @property
+    def types(self):
+        ''' List of category types ordered by id, callers must not modify it '''
+        return self._categories[1]
+
+    @property
+    def digest(self):
+        ''' Short hash of the categories, changes whenever a reload finds different categories '''
+        return self._digest
+
+
+class ResponseCache:
+    ''' Bounded LRU cache of rendered response bodies '''
+
+    def __init__(self, max_entries):
+        ''' Creates an empty cache
+
+        :param max_entries: most bodies kept, the least recently used is dropped beyond that. 0 disables the cache.
+        '''
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        ''' Returns the body cached under key, or None '''
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        ''' Caches a body under key, evicting the least recently used one if the cache is full '''
+        if self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
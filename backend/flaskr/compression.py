@@ -0,0 +1,114 @@
+'''
+Negotiated response compression. JSON bodies of at least COMPRESSION_MIN_SIZE bytes are sent
+brotli (if the brotli package is installed) or gzip compressed to clients that accept it, which
+shrinks question listings several times over. Compressed bodies of the routes behind the response
+cache are cached next to the plain body, so a cached page is compressed once per encoding instead
+of once per client.
+'''
+
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from werkzeug.http import parse_accept_header
+
+from .metrics import Counter
+
+# smaller bodies gain little and cost a compressor call each
+COMPRESSION_MIN_SIZE = 1024
+# gzip levels go from 1 (fastest) to 9, brotli qualities from 0 to 11
+COMPRESSION_GZIP_LEVEL = 6
+COMPRESSION_BROTLI_QUALITY = 5
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson')
+
+
+def compressible(mimetype):
+    ''' True for the content types worth compressing, JSON and text '''
+    return mimetype in COMPRESSIBLE_MIMETYPES or (mimetype or '').startswith('text/')
+
+
+class ResponseCompressor:
+    ''' Picks the encoding of a response and compresses its body '''
+
+    def __init__(self, min_size=COMPRESSION_MIN_SIZE, gzip_level=COMPRESSION_GZIP_LEVEL,
+                 brotli_quality=COMPRESSION_BROTLI_QUALITY, cache=None, metrics=None):
+        ''' Creates a compressor
+
+        :param min_size: bodies smaller than this many bytes are sent as they are
+        :param gzip_level: gzip compression level
+        :param brotli_quality: brotli quality, only used when the brotli package is installed
+        :param cache: optional ResponseCache the compressed bodies of cached responses are kept in
+        :param metrics: optional Metrics to count the bytes before and after compression in
+        '''
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.cache = cache
+        # preferred first when the client accepts several with the same quality
+        self.encodings = ('br', 'gzip') if brotli is not None else ('gzip',)
+        self.metrics = metrics
+        if metrics is not None:
+            self.bytes_in = metrics.add(Counter(
+                'trivia_compression_input_bytes_total', 'Bytes of response bodies before compression, by encoding.'))
+            self.bytes_out = metrics.add(Counter(
+                'trivia_compression_output_bytes_total', 'Bytes of response bodies after compression, by encoding.'))
+
+    def choose(self, accept_encoding, size):
+        ''' Returns the encoding to send a body of size bytes in, None to send it uncompressed
+
+        :param accept_encoding: the Accept-Encoding request header, or None
+        '''
+        if not accept_encoding or size < self.min_size:
+            return None
+        return parse_accept_header(accept_encoding).best_match(self.encodings)
+
+    def compress(self, body, encoding, cache_key=None):
+        ''' Returns body compressed with encoding, from the cache if cache_key is the key of a cached response '''
+        if cache_key is not None and self.cache is not None:
+            compressed = self.cache.get((cache_key, encoding))
+            if compressed is not None:
+                self.count(encoding, len(body), len(compressed))
+                return compressed
+
+        if encoding == 'br':
+            compressed = brotli.compress(body, quality=self.brotli_quality)
+        else:
+            compressed = gzip.compress(body, compresslevel=self.gzip_level)
+
+        if cache_key is not None and self.cache is not None:
+            self.cache.put((cache_key, encoding), compressed)
+        self.count(encoding, len(body), len(compressed))
+        return compressed
+
+    def count(self, encoding, size_in, size_out):
+        if self.metrics is not None:
+            self.metrics.inc(self.bytes_in, (('encoding', encoding),), size_in)
+            self.metrics.inc(self.bytes_out, (('encoding', encoding),), size_out)
+
+    def compress_response(self, response, accept_encoding, cache_key=None):
+        ''' Compresses a Flask response in place if the client accepts it and the body is large enough
+
+        Streamed and already encoded responses are left alone. A strong ETag is made weak, since the
+        compressed bytes differ from the plain ones the ETag was computed for.
+        '''
+        if response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+                or 'Content-Encoding' in response.headers or not compressible(response.mimetype):
+            return response
+
+        # caches must keep the plain and compressed bodies apart
+        response.vary.add('Accept-Encoding')
+
+        body = response.get_data()
+        encoding = self.choose(accept_encoding, len(body))
+        if encoding is None:
+            return response
+
+        response.set_data(self.compress(body, encoding, cache_key))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+        return response
@@ -0,0 +1,133 @@
+'''
+Stored question counts. The question_counts table holds the number of questions per category and
+difficulty, adjusted in the same transaction as every write to the questions, so the listings read
+their totals from a handful of rows instead of counting the questions table, and GET /categories/stats
+can report counts per category and difficulty for the price of one small query.
+'''
+
+from collections import Counter
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from models import db, Question, QuestionCount
+
+# stored for a question without a category or difficulty
+UNSET = 0
+
+
+def count_key(category, difficulty):
+    ''' Returns the (category, difficulty) key a question is counted under '''
+    return (UNSET if category is None else int(category), UNSET if difficulty is None else int(difficulty))
+
+
+class QuestionCounts:
+    ''' Reads and adjusts the stored counts '''
+
+    def adjust(self, changes):
+        ''' Applies count changes as part of the current transaction, the caller commits them
+
+        :param changes: dict or Counter of (category, difficulty) key -> number of questions added, negative if removed
+        '''
+        table = QuestionCount.__table__
+        # always in key order, so concurrent writes lock the count rows in the same order and can't deadlock
+        changes = [(key, delta) for key, delta in sorted(changes.items()) if delta != 0]
+        if not changes:
+            return
+
+        if db.engine.dialect.name == 'postgresql':
+            # one upsert, a concurrent insert of the same key can't make it fail like UPDATE then INSERT
+            statement = postgresql_insert(table).values([
+                {'category': category, 'difficulty': difficulty, 'count': delta}
+                for (category, difficulty), delta in changes])
+            db.session.execute(statement.on_conflict_do_update(
+                index_elements=[table.c.category, table.c.difficulty],
+                set_={'count': table.c.count + statement.excluded.count}))
+            return
+
+        for (category, difficulty), delta in changes:
+            updated = db.session.execute(
+                table.update()
+                .where(table.c.category == category)
+                .where(table.c.difficulty == difficulty)
+                .values(count=table.c.count + delta))
+            if updated.rowcount == 0:
+                db.session.execute(table.insert(), {'category': category, 'difficulty': difficulty, 'count': delta})
+
+    def added(self, rows):
+        ''' Counts rows of (category, difficulty) as added, see adjust '''
+        self.adjust(Counter(count_key(category, difficulty) for category, difficulty in rows))
+
+    def removed(self, rows):
+        ''' Counts rows of (category, difficulty) as removed, see adjust '''
+        self.adjust(Counter({key: -number for key, number in
+                             Counter(count_key(category, difficulty) for category, difficulty in rows).items()}))
+
+    def moved(self, pairs):
+        ''' Counts rows of ((old category, old difficulty), (new category, new difficulty)) as changed, in one
+        adjust so the count rows are locked in order, see adjust '''
+        changes = Counter()
+        for old, new in pairs:
+            changes[count_key(*old)] -= 1
+            changes[count_key(*new)] += 1
+        self.adjust(changes)
+
+    def total(self, category_id=None):
+        ''' Returns the number of questions, in category_id if given
+
+        Falls back to counting the questions when no counts are stored for it, e.g. an empty category
+        or a database that the counts migration hasn't run on yet.
+        '''
+        query = db.session.query(func.sum(QuestionCount.count))
+        if category_id is not None:
+            query = query.filter(QuestionCount.category == category_id)
+        try:
+            total = query.scalar()
+        except (OperationalError, ProgrammingError):
+            # no question_counts table, the failed statement ended the transaction on Postgres
+            db.session.rollback()
+            total = None
+
+        if total is None:
+            query = db.session.query(func.count(Question.id))
+            if category_id is not None:
+                query = query.filter(Question.category == category_id)
+            total = query.scalar()
+
+        return int(total)
+
+    def by_category(self):
+        ''' Returns a dict of category id -> {difficulty: count}, without the empty ones, counting the
+        questions if the counts migration hasn't run yet '''
+        try:
+            rows = db.session.query(QuestionCount.category, QuestionCount.difficulty, QuestionCount.count).all()
+        except (OperationalError, ProgrammingError):
+            db.session.rollback()
+            rows = [(category, difficulty, count) for (category, difficulty), count in self.recount().items()]
+
+        counts = {}
+        for category, difficulty, count in rows:
+            if count:
+                counts.setdefault(category, {})[difficulty] = count
+        return counts
+
+    @staticmethod
+    def recount():
+        ''' Counts the questions table, returns a Counter of (category, difficulty) key -> number of questions '''
+        rows = db.session.query(Question.category, Question.difficulty, func.count(Question.id)) \
+            .group_by(Question.category, Question.difficulty)
+        totals = Counter()
+        for category, difficulty, count in rows:
+            totals[count_key(category, difficulty)] += count
+        return totals
+
+    def rebuild(self):
+        ''' Recounts every question into the counts table as part of the current transaction '''
+        db.session.query(QuestionCount).delete()
+        totals = self.recount()
+        if totals:
+            db.session.execute(QuestionCount.__table__.insert(), [
+                {'category': category, 'difficulty': difficulty, 'count': count}
+                for (category, difficulty), count in totals.items()
+            ])
@@ -0,0 +1,204 @@
+'''
+Request instrumentation exposed in the Prometheus text format at GET /metrics: latency per route,
+SQL statements and database time per request (counted with SQLAlchemy engine events), and how long
+requests wait to check a connection out of the pool. Everything is kept in process, so each worker
+reports its own numbers.
+'''
+
+import threading
+import time
+import weakref
+
+from flask import g, has_app_context
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def format_labels(labels):
+    ''' Turns a tuple of (name, value) pairs into the {name="value"} part of a sample line '''
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+class Histogram:
+    ''' Cumulative histogram per label set, rendered as _bucket, _sum and _count samples '''
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> [count per bucket..., sum, count]
+        self._series = {}
+
+    def observe(self, value, labels=()):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series.setdefault(labels, [0] * len(self.buckets) + [0.0, 0])
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def totals(self, labels=()):
+        ''' Returns the (sum, count) observed for a label set '''
+        series = self._series.get(labels)
+        if series is None:
+            return 0.0, 0
+        return series[-2], series[-1]
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        for labels, series in sorted(self._series.items()):
+            for bound, count in zip(self.buckets, series):
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(labels + (('le', bound),)), count))
+            lines.append('{}_bucket{} {}'.format(self.name, format_labels(labels + (('le', '+Inf'),)), series[-1]))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(labels), series[-2]))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(labels), series[-1]))
+        return lines
+
+
+class Counter:
+    ''' Monotonic counter per label set '''
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._series = {}
+
+    def inc(self, labels=(), amount=1):
+        self._series[labels] = self._series.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._series.get(labels, 0)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} counter'.format(self.name)]
+        for labels, value in sorted(self._series.items()):
+            lines.append('{}{} {}'.format(self.name, format_labels(labels), value))
+        return lines
+
+
+class Metrics:
+    ''' The metrics of one app, plus the hooks that feed them '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._engines = weakref.WeakSet()
+        self._pool = None
+        self.request_duration = Histogram(
+            'trivia_request_duration_seconds', 'Time spent handling a request, by route.', LATENCY_BUCKETS)
+        self.request_statements = Histogram(
+            'trivia_request_sql_statements', 'SQL statements executed per request, by route.', STATEMENT_BUCKETS)
+        self.request_db_time = Histogram(
+            'trivia_request_db_seconds', 'Time spent executing SQL per request, by route.', LATENCY_BUCKETS)
+        self.pool_checkout = Histogram(
+            'trivia_db_pool_checkout_seconds', 'Time spent waiting to check a connection out of the pool.',
+            LATENCY_BUCKETS)
+        self.registry = [self.request_duration, self.request_statements, self.request_db_time, self.pool_checkout]
+
+    def add(self, metric):
+        ''' Registers another Histogram or Counter to be rendered at /metrics, returns it '''
+        self.registry.append(metric)
+        return metric
+
+    def instrument_engine(self, engine):
+        ''' Hooks the statement and pool checkout timers into engine, safe to call on every request '''
+        with self._lock:
+            if engine not in self._engines:
+                event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+                event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+                self._engines.add(engine)
+
+            # the pool is replaced when the engine is disposed, e.g. after a fork, so check it every time
+            pool = engine.pool
+            if not getattr(pool, '_trivia_timed_connect', False):
+                connect = pool.connect
+
+                def timed_connect():
+                    started = time.perf_counter()
+                    try:
+                        return connect()
+                    finally:
+                        self.observe(self.pool_checkout, time.perf_counter() - started)
+
+                pool.connect = timed_connect
+                pool._trivia_timed_connect = True
+            self._pool = pool
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._trivia_query_started = time.perf_counter()
+
+    @staticmethod
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if has_app_context() and 'sql_statements' in g:
+            g.sql_statements += 1
+            started = getattr(context, '_trivia_query_started', None)
+            if started is not None:
+                g.sql_seconds += time.perf_counter() - started
+
+    def start_request(self):
+        ''' Resets the per-request counters, called before each request '''
+        g.request_started = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_seconds = 0.0
+
+    def finish_request(self, route, method, status, request_g=None):
+        ''' Records the finished request, called after each request
+
+        :param request_g: the g of the request, for a streamed response that finishes after its context is gone
+        :return: tuple of the request duration, number of SQL statements and the time spent in SQL
+        '''
+        if request_g is None:
+            request_g = g
+        duration = time.perf_counter() - request_g.request_started
+        labels = (('route', route), ('method', method), ('status', status))
+        route_labels = (('route', route),)
+
+        with self._lock:
+            self.request_duration.observe(duration, labels)
+            self.request_statements.observe(request_g.sql_statements, route_labels)
+            self.request_db_time.observe(request_g.sql_seconds, route_labels)
+
+        return duration, request_g.sql_statements, request_g.sql_seconds
+
+    def observe(self, histogram, value, labels=()):
+        ''' Thread-safe observe for histograms fed from outside the request hooks '''
+        with self._lock:
+            histogram.observe(value, labels)
+
+    def inc(self, counter, labels=(), amount=1):
+        ''' Thread-safe increment for counters '''
+        with self._lock:
+            counter.inc(labels, amount)
+
+    def render(self):
+        ''' Returns every metric in the Prometheus text exposition format '''
+        with self._lock:
+            lines = []
+            for metric in self.registry:
+                lines.extend(metric.render())
+            lines.extend(self._render_pool())
+        return '\n'.join(lines) + '\n'
+
+    def _render_pool(self):
+        ''' Gauges of the connection pool, for the pool types that report them '''
+        pool = self._pool
+        if pool is None or not hasattr(pool, 'checkedout'):
+            return []
+        gauges = [
+            ('trivia_db_pool_size', 'Connections the pool keeps open.', pool.size()),
+            ('trivia_db_pool_checked_out', 'Connections currently checked out of the pool.', pool.checkedout()),
+            ('trivia_db_pool_overflow', 'Connections open beyond the pool size.', pool.overflow()),
+        ]
+        lines = []
+        for name, help, value in gauges:
+            lines.extend(['# HELP {} {}'.format(name, help), '# TYPE {} gauge'.format(name), '{} {}'.format(name, value)])
+        return lines
@@ -0,0 +1,39 @@
+'''
+Opaque keyset cursors used by the paginated routes. A cursor wraps the id of the last row
+a client has seen, so the next page can be fetched with "WHERE id > :after" instead of an
+OFFSET that makes the database walk past every earlier row.
+'''
+
+import base64
+import binascii
+
+
+def encode_cursor(last_id):
+    ''' Turns the id of the last row on a page into an opaque cursor string
+
+    :param last_id: database id of the last row returned
+    :return: url-safe cursor string, or None if there is no next page
+    '''
+    if last_id is None:
+        return None
+
+    return base64.urlsafe_b64encode(str(last_id).encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    ''' Turns a cursor string produced by encode_cursor back into a row id
+
+    :param cursor: cursor string sent by the client as ?after=
+    :return: the row id the cursor points at
+    :raises ValueError: if the cursor is not one we produced
+    '''
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        last_id = int(base64.urlsafe_b64decode(padded.encode('ascii')).decode('ascii'))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError('invalid cursor: {}'.format(cursor))
+
+    if last_id < 0:
+        raise ValueError('invalid cursor: {}'.format(cursor))
+
+    return last_id
@@ -0,0 +1,113 @@
+'''
+Opt-in per-request profiler. When PROFILING_ENABLED is set, requests carrying PROFILE_TOKEN in the
+X-Profile header (or a random sample of PROFILE_SAMPLE_RATE of all requests) run under cProfile, and
+the SQL they issue is captured. Without a PROFILE_TOKEN the header is ignored, so clients can't make
+the server profile their requests, only sampling picks requests then. Each profiled request leaves a .pstats file and a .sql.txt trace in PROFILE_DIR,
+keeping only the newest PROFILE_MAX_FILES profiles. When profiling is off none of this is hooked in.
+
+Read a profile with:
+    python -m pstats <file>.pstats
+'''
+
+import cProfile
+import hmac
+import os
+import random
+import re
+import time
+from datetime import datetime
+
+from flask import g, has_app_context
+from sqlalchemy import event
+
+PROFILE_HEADER = 'X-Profile'
+PSTATS_SUFFIX = '.pstats'
+SQL_SUFFIX = '.sql.txt'
+
+
+class RequestProfiler:
+    ''' Decides which requests to profile, runs cProfile around them and writes the results '''
+
+    def __init__(self, directory, max_files, sample_rate=0.0, token=None):
+        ''' Creates the profiler
+
+        :param directory: where the profiles are written, created if needed
+        :param max_files: most profiles kept, older ones are deleted
+        :param sample_rate: fraction of all requests to profile, 0 to only profile on request
+        :param token: value the X-Profile header must carry to profile a request, None to only profile by sampling
+        '''
+        self.directory = directory
+        self.max_files = max_files
+        self.sample_rate = sample_rate
+        self.token = token
+        self._engines = set()
+        os.makedirs(directory, exist_ok=True)
+
+    def should_profile(self, request):
+        ''' True if the request sent the profile token in the header or was picked by sampling '''
+        header = request.headers.get(PROFILE_HEADER, '')
+        if self.token and hmac.compare_digest(header.encode('utf-8'), self.token.encode('utf-8')):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def instrument_engine(self, engine):
+        ''' Hooks the SQL capture into engine, only statements of profiled requests are kept '''
+        if id(engine) not in self._engines:
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+            self._engines.add(id(engine))
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if has_app_context() and 'profile_sql' in g and context is not None:
+            context._trivia_profile_started = time.perf_counter()
+
+    @staticmethod
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if has_app_context() and 'profile_sql' in g:
+            started = getattr(context, '_trivia_profile_started', None)
+            seconds = time.perf_counter() - started if started is not None else 0.0
+            g.profile_sql.append((seconds, statement, parameters))
+
+    def start(self, request):
+        ''' Starts profiling the current request '''
+        g.profile_name = '{}-{}-{}-{}'.format(
+            datetime.now().strftime('%Y%m%d-%H%M%S-%f'), os.getpid(), request.method,
+            re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_') or 'root')
+        g.profile_sql = []
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+    def finish(self):
+        ''' Stops profiling the current request and writes its files, does nothing if it wasn't profiled
+
+        :return: name of the profile written, without suffix, or None
+        '''
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return None
+        profiler.disable()
+
+        base = os.path.join(self.directory, g.profile_name)
+        profiler.dump_stats(base + PSTATS_SUFFIX)
+
+        statements = g.pop('profile_sql')
+        with open(base + SQL_SUFFIX, 'w') as trace:
+            trace.write('-- {} statements, {:.2f} ms in SQL\n'.format(
+                len(statements), sum(seconds for seconds, _, _ in statements) * 1000))
+            for seconds, statement, parameters in statements:
+                trace.write('\n-- {:.2f} ms, parameters: {!r}\n{};\n'.format(seconds * 1000, parameters, statement))
+
+        self.prune()
+        return g.profile_name
+
+    def prune(self):
+        ''' Deletes the oldest profiles beyond max_files '''
+        profiles = sorted(name[:-len(PSTATS_SUFFIX)] for name in os.listdir(self.directory)
+                          if name.endswith(PSTATS_SUFFIX))
+        for name in profiles[:-self.max_files] if self.max_files > 0 else profiles:
+            for suffix in (PSTATS_SUFFIX, SQL_SUFFIX):
+                try:
+                    os.remove(os.path.join(self.directory, name + suffix))
+                except FileNotFoundError:
+                    pass
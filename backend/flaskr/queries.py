@@ -0,0 +1,54 @@
+'''
+Core-level reads of the questions table for the hot read routes. These select only the columns
+the API returns and turn each row straight into a dict, skipping ORM object construction, the
+identity map and Question.format().
+'''
+
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+from models import db, Question
+
+questions_table = Question.__table__
+
+# the columns every question in an API response has
+QUESTION_COLUMNS = (
+    questions_table.c.id,
+    questions_table.c.question,
+    questions_table.c.answer,
+    questions_table.c.category,
+    questions_table.c.difficulty,
+)
+
+
+def select_questions():
+    ''' Returns a SELECT of the question columns, for the caller to add filters, ordering and limits '''
+    return select(QUESTION_COLUMNS)
+
+
+def select_quiz_index():
+    ''' Returns a SELECT of the (id, category) pairs the quiz index is loaded from '''
+    return select([questions_table.c.id, questions_table.c.category])
+
+
+def postgresql_sql(statement):
+    ''' Renders a statement without parameters as Postgres SQL text, for the ASGI mode's asyncpg queries,
+    so both modes read the same columns '''
+    return str(statement.compile(dialect=postgresql.dialect()))
+
+
+def fetch_questions(statement):
+    ''' Runs a SELECT built from select_questions and returns its rows as question dicts '''
+    return [dict(row) for row in db.session.execute(statement)]
+
+
+def fetch_question(question_id):
+    ''' Returns one question dict by id, or None if it doesn't exist '''
+    row = db.session.execute(select_questions().where(questions_table.c.id == question_id)).first()
+    return dict(row) if row is not None else None
+
+
+def fetch_questions_by_id(question_ids):
+    ''' Returns a dict of question id -> question dict for the ids that exist, in one query '''
+    statement = select_questions().where(questions_table.c.id.in_(question_ids))
+    return {question['id']: question for question in fetch_questions(statement)}
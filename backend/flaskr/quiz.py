@@ -0,0 +1,179 @@
+'''
+In-memory index of question ids used to draw quiz questions. Instead of loading and shuffling
+every question in a category for each /quizzes call, the index keeps the ids per category and
+samples one that hasn't been asked yet in O(1) expected time.
+'''
+
+import random
+import threading
+import time
+
+# how many random picks are tried before falling back to scanning the unseen ids
+MAX_REJECTIONS = 16
+
+
+class QuizIndex:
+    ''' Per-category lists of question ids, kept in sync by the routes that write questions
+
+    The None key holds every question, which is what the "click" (ALL) quiz draws from.
+    Each list has a matching id -> position map so ids can be removed in O(1) by swapping
+    the last id into the hole.
+    '''
+
+    def __init__(self, ttl=None):
+        ''' Creates an empty index
+
+        :param ttl: seconds after which the index is considered stale and should be reloaded,
+        None means it never goes stale on its own
+        '''
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # held by the one thread reloading the index, the others keep using the current one
+        self._reload_lock = threading.Lock()
+        self._populated = False
+        self._ids = {}
+        self._positions = {}
+        self._category_of = {}
+        self._loaded_at = None
+
+    def load(self, rows):
+        ''' Replaces the contents of the index
+
+        :param rows: iterable of (question id, category id) pairs
+        '''
+        ids = {None: []}
+        positions = {None: {}}
+        category_of = {}
+
+        for question_id, category in rows:
+            category = None if category is None else int(category)
+            category_of[question_id] = category
+            keys = (None,) if category is None else (None, category)
+            for key in keys:
+                key_ids = ids.setdefault(key, [])
+                positions.setdefault(key, {})[question_id] = len(key_ids)
+                key_ids.append(question_id)
+
+        with self._lock:
+            self._ids = ids
+            self._positions = positions
+            self._category_of = category_of
+            self._loaded_at = time.monotonic()
+            self._populated = True
+
+    @property
+    def populated(self):
+        ''' True once the index was loaded, even if it has gone stale since '''
+        return self._populated
+
+    def start_reload(self, wait=None):
+        ''' Claims the reload of a stale index, so only one caller at a time loads it
+
+        Other callers keep using the current index meanwhile and get False, except before the first load,
+        when there is nothing to use yet and they wait for the load in progress instead.
+
+        :param wait: whether to wait for a reload in progress, by default only if the index isn't populated
+        :return: True if the caller should now load the index and then call finish_reload
+        '''
+        if not self._reload_lock.acquire(blocking=not self._populated if wait is None else wait):
+            return False
+        if self.is_stale():
+            return True
+        # another caller reloaded it while we waited
+        self._reload_lock.release()
+        return False
+
+    def finish_reload(self):
+        ''' Lets the next stale check reload the index again, call it after start_reload returned True '''
+        self._reload_lock.release()
+
+    def invalidate(self):
+        ''' Makes the next is_stale call return True, for writes too large to apply one question at a time '''
+        self._loaded_at = None
+
+    def is_stale(self):
+        ''' True if the index was never loaded or is older than its ttl '''
+        if self._loaded_at is None:
+            return True
+        if self.ttl is None:
+            return False
+        return time.monotonic() - self._loaded_at > self.ttl
+
+    def add(self, question_id, category):
+        ''' Adds a newly created question to the index '''
+        category = None if category is None else int(category)
+
+        with self._lock:
+            if question_id in self._category_of:
+                return
+            self._category_of[question_id] = category
+            keys = (None,) if category is None else (None, category)
+            for key in keys:
+                key_ids = self._ids.setdefault(key, [])
+                self._positions.setdefault(key, {})[question_id] = len(key_ids)
+                key_ids.append(question_id)
+
+    def remove(self, question_id):
+        ''' Removes a deleted question from the index, unknown ids are ignored '''
+        with self._lock:
+            if question_id not in self._category_of:
+                return
+            category = self._category_of.pop(question_id)
+            keys = (None,) if category is None else (None, category)
+            for key in keys:
+                key_ids = self._ids[key]
+                key_positions = self._positions[key]
+                position = key_positions.pop(question_id)
+                last_id = key_ids.pop()
+                if last_id != question_id:
+                    key_ids[position] = last_id
+                    key_positions[last_id] = position
+
+    def ids(self, category=None):
+        ''' Returns a copy of the ids in a category, or of all ids if category is None '''
+        with self._lock:
+            return list(self._ids.get(category, ()))
+
+    def draw(self, category, seen):
+        ''' Picks one question id uniformly at random from those not in seen
+
+        :param category: category id to draw from, None draws from all questions
+        :param seen: set of question ids that were already asked
+        :return: a question id, or None if every question in the category has been seen
+        '''
+        drawn = self.draw_many(category, seen, 1)
+        return drawn[0] if drawn else None
+
+    def draw_many(self, category, seen, count):
+        ''' Picks up to count distinct question ids uniformly at random from those not in seen
+
+        :param category: category id to draw from, None draws from all questions
+        :param seen: set of question ids that were already asked
+        :param count: how many ids to draw
+        :return: list of question ids in the order they should be asked, shorter than count
+        once the category runs out of unseen questions
+        '''
+        with self._lock:
+            ids = self._ids.get(category)
+            if not ids:
+                return []
+
+            # rejection sampling is uniform over the unseen ids and, while at most half of
+            # them are seen or already drawn, needs fewer than two picks per id on average
+            if (len(seen) + count) * 2 <= len(ids):
+                drawn = []
+                drawn_set = set()
+                for _ in range(count * MAX_REJECTIONS):
+                    question_id = ids[random.randrange(len(ids))]
+                    if question_id not in seen and question_id not in drawn_set:
+                        drawn.append(question_id)
+                        drawn_set.add(question_id)
+                        if len(drawn) == count:
+                            return drawn
+
+            unseen = [question_id for question_id in ids if question_id not in seen]
+
+        return random.sample(unseen, min(count, len(unseen)))
+
+    def __len__(self):
+        return len(self._category_of)
@@ -0,0 +1,67 @@
+'''
+Read replica routing. Routes that only read (listings, search, suggestions, quizzes) run their
+SELECTs on one of the replica databases in DATABASE_REPLICA_URLS, picked round robin per request,
+while every write goes to the primary. Replicas lag behind the primary, so a client that just added
+or deleted a question gets a cookie that sends its reads to the primary for READ_YOUR_WRITES_WINDOW
+seconds, and it sees its own change right away.
+'''
+
+import itertools
+import threading
+import time
+
+from sqlalchemy import create_engine
+
+# cookie holding the time until which the client reads from the primary
+PRIMARY_COOKIE = 'trivia_read_primary_until'
+
+
+def replica_urls(setting):
+    ''' Turns a comma separated string, or a list, of database URLs into a list '''
+    if not setting:
+        return []
+    if isinstance(setting, str):
+        setting = setting.split(',')
+    return [url.strip() for url in setting if url.strip()]
+
+
+class ReplicaRouter:
+    ''' Picks the replica engine of a read-only request, or None when it has to use the primary '''
+
+    def __init__(self, urls, engine_options=None, read_your_writes_window=5):
+        ''' Creates an engine per replica, they connect on first use
+
+        :param urls: database URLs of the replicas, an empty list routes everything to the primary
+        :param engine_options: keyword arguments for create_engine, the same pool settings as the primary
+        :param read_your_writes_window: seconds a client reads from the primary after it wrote
+        '''
+        self.engines = [create_engine(url, **(engine_options or {})) for url in urls]
+        self.read_your_writes_window = read_your_writes_window
+        self._lock = threading.Lock()
+        self._cycle = itertools.cycle(self.engines)
+
+    def choose(self, request):
+        ''' Returns the replica engine for a read-only request, None if it should read from the primary '''
+        if not self.engines:
+            return None
+
+        try:
+            if float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time():
+                return None
+        except ValueError:
+            pass
+
+        with self._lock:
+            return next(self._cycle)
+
+    def wrote(self, response):
+        ''' Sends the reads of the client that got this response to the primary for a while '''
+        if self.engines and self.read_your_writes_window > 0:
+            response.set_cookie(PRIMARY_COOKIE, '{:.3f}'.format(time.time() + self.read_your_writes_window),
+                                max_age=self.read_your_writes_window, httponly=True)
+        return response
+
+    def dispose(self):
+        ''' Closes the pooled replica connections, e.g. in a freshly forked worker '''
+        for engine in self.engines:
+            engine.dispose()
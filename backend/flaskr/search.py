@@ -0,0 +1,64 @@
+'''
+Question search used by POST /questions. On Postgres databases that ran
+migrations/001_question_search.sql, searches use the GIN-indexed search_vector column for
+ranked full-text matches and the trigram index for substring matches. Databases without it,
+like a freshly created test database, fall back to a plain case-insensitive substring search.
+'''
+
+from sqlalchemy import func, inspect, literal_column, or_
+
+from models import db, Question
+from .queries import fetch_questions, select_questions
+
+# text search configuration, must match the one used by the trigger in the migration
+SEARCH_CONFIG = 'english'
+
+
+class QuestionSearch:
+    ''' Runs question searches, picking the full-text or fallback path once per process '''
+
+    def __init__(self, per_page, full_text=None):
+        ''' Creates the searcher
+
+        :param per_page: number of results on each page
+        :param full_text: True or False to force a search path, None to detect it from the database
+        '''
+        self.per_page = per_page
+        self.full_text = full_text
+
+    def uses_full_text(self):
+        ''' True if the database has the search_vector column from the search migration '''
+        if self.full_text is None:
+            engine = db.get_engine()
+            self.full_text = engine.dialect.name == 'postgresql' and any(
+                column['name'] == 'search_vector' for column in inspect(engine).get_columns('questions'))
+
+        return self.full_text
+
+    def search(self, search_term, page=None):
+        ''' Finds the questions matching search_term
+
+        :param search_term: text the user typed in the search box
+        :param page: page of results to return, starting at 1, None returns every match
+        :return: tuple of the question dicts on the page and the total number of matches
+        '''
+        # substring match, same as the original search, served by the trigram index on Postgres
+        contains_term = Question.question.ilike('%' + search_term + '%')
+
+        if self.uses_full_text():
+            search_vector = literal_column('questions.search_vector')
+            query = func.plainto_tsquery(SEARCH_CONFIG, search_term)
+            # stop words like "how" never match the tsvector, the substring match still finds them
+            match = or_(search_vector.op('@@')(query), contains_term)
+            order_by = (func.ts_rank(search_vector, query).desc(), Question.id)
+        else:
+            match = contains_term
+            order_by = (Question.id,)
+
+        statement = select_questions().where(match).order_by(*order_by)
+        if page is not None:
+            statement = statement.limit(self.per_page).offset((page - 1) * self.per_page)
+        questions = fetch_questions(statement)
+        total_questions = db.session.query(func.count(Question.id)).filter(match).scalar()
+
+        return questions, total_questions
@@ -0,0 +1,46 @@
+'''
+JSON serializers for API responses. orjson is used when it's installed, it encodes the question
+listings several times faster than the standard library json module that jsonify uses; without it
+the standard library is used with compact separators.
+'''
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def orjson_dumps(data):
+    ''' Encodes data with orjson, allowing the integer keys of the categories map '''
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+
+def stdlib_dumps(data):
+    ''' Encodes data with the standard library json module '''
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+SERIALIZERS = {
+    'orjson': orjson_dumps,
+    'stdlib': stdlib_dumps,
+}
+
+
+def get_serializer(name='auto'):
+    ''' Picks the function used to encode responses
+
+    :param name: 'orjson', 'stdlib', or 'auto' for orjson when it's installed and stdlib otherwise
+    :return: function taking the data and returning the encoded bytes
+    :raises ValueError: for an unknown name, or 'orjson' when it isn't installed
+    '''
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'stdlib'
+
+    if name not in SERIALIZERS:
+        raise ValueError('unknown JSON serializer: {}'.format(name))
+    if name == 'orjson' and orjson is None:
+        raise ValueError('JSON_SERIALIZER is orjson, but orjson is not installed')
+
+    return SERIALIZERS[name]
@@ -0,0 +1,168 @@
+'''
+Server-side quiz sessions. A session holds a pre-shuffled deck of question ids, so a client
+playing a game only sends its session token and the server pops the next id, instead of the
+client resending (and the server re-checking) every previous question on each call.
+
+The decks are kept in the quiz_sessions table by default, so a session started on one worker can be
+played on any other. QuizSessionStore keeps them in memory instead, which only works with a single
+process, e.g. flask run.
+'''
+
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from models import db, QuizSession, DECK_ID_WIDTH
+
+
+class QuizSessionStore:
+    ''' Bounded, process-local store of quiz decks keyed by session token
+
+    Sessions expire after ttl seconds without being used, and once max_sessions is reached
+    the least recently used session is evicted to make room for a new one.
+    '''
+
+    def __init__(self, max_sessions, ttl):
+        ''' Creates an empty store
+
+        :param max_sessions: most sessions kept at once
+        :param ttl: seconds a session may sit unused before it expires
+        '''
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # token -> (last used time, deck), ordered from least to most recently used
+        self._sessions = OrderedDict()
+
+    def _expire(self, now):
+        ''' Drops expired sessions, the least recently used ones are always at the front '''
+        while self._sessions:
+            token, (last_used, _) = next(iter(self._sessions.items()))
+            if now - last_used <= self.ttl:
+                break
+            del self._sessions[token]
+
+    def create(self, deck):
+        ''' Stores a new deck and returns its session token
+
+        :param deck: list of question ids, already shuffled, the next question is popped off the end
+        :return: url-safe session token
+        '''
+        token = secrets.token_urlsafe(16)
+        now = time.monotonic()
+
+        with self._lock:
+            self._expire(now)
+            while len(self._sessions) >= self.max_sessions:
+                self._sessions.popitem(last=False)
+            self._sessions[token] = (now, deck)
+
+        return token
+
+    def pop(self, token):
+        ''' Takes the next question id off a session's deck
+
+        :param token: session token returned by create
+        :return: the next question id, or None once the deck is empty
+        :raises KeyError: if the session doesn't exist or has expired
+        '''
+        now = time.monotonic()
+
+        with self._lock:
+            self._expire(now)
+            _, deck = self._sessions.pop(token)
+            self._sessions[token] = (now, deck)
+
+            if not deck:
+                return None
+            return deck.pop()
+
+    def remaining(self, token):
+        ''' Returns how many questions are left in a session's deck
+
+        :raises KeyError: if the session doesn't exist or has expired
+        '''
+        with self._lock:
+            self._expire(time.monotonic())
+            return len(self._sessions[token][1])
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class DatabaseQuizSessionStore:
+    ''' Store of quiz decks in the quiz_sessions table, shared by every worker, same methods as QuizSessionStore
+
+    Sessions expire after ttl seconds without being used, expired ones are deleted when a session is created.
+    '''
+
+    def __init__(self, ttl):
+        ''' Creates the store
+
+        :param ttl: seconds a session may sit unused before it expires
+        '''
+        self.ttl = ttl
+
+    def _cutoff(self, now):
+        return now - timedelta(seconds=self.ttl)
+
+    def create(self, deck):
+        ''' Stores a new deck and commits it, see QuizSessionStore.create '''
+        token = secrets.token_urlsafe(16)
+        now = datetime.utcnow()
+
+        QuizSession.query.filter(QuizSession.last_used < self._cutoff(now)).delete(synchronize_session=False)
+        db.session.add(QuizSession(token, ''.join(str(question_id).zfill(DECK_ID_WIDTH) for question_id in deck),
+                                   len(deck), now))
+        db.session.commit()
+
+        return token
+
+    def pop(self, token):
+        ''' Takes the next question id off a session's deck and commits it, see QuizSessionStore.pop
+
+        :raises KeyError: if the session doesn't exist or has expired
+        '''
+        now = datetime.utcnow()
+        table = QuizSession.__table__
+        # the UPDATE locks the row until the commit, so two workers popping the same session take different ids
+        popped = db.session.execute(
+            table.update()
+            .where(table.c.token == token)
+            .where(table.c.last_used >= self._cutoff(now))
+            .where(table.c.remaining > 0)
+            .values(remaining=table.c.remaining - 1, last_used=now)).rowcount
+
+        row = self._read(token)
+        db.session.commit()
+
+        if row is None or row.last_used < self._cutoff(now):
+            raise KeyError(token)
+        if not popped:
+            return None
+        return int(row.next_id)
+
+    def remaining(self, token):
+        ''' Returns how many questions are left in a session's deck
+
+        :raises KeyError: if the session doesn't exist or has expired
+        '''
+        row = self._read(token)
+        if row is None or row.last_used < self._cutoff(datetime.utcnow()):
+            raise KeyError(token)
+        return row.remaining
+
+    @staticmethod
+    def _read(token):
+        ''' Reads a session with only the id at position remaining of its deck, not the whole deck '''
+        # the session routes don't read from replicas, a replica may not have the session yet
+        next_id = func.substr(QuizSession.deck, QuizSession.remaining * DECK_ID_WIDTH + 1, DECK_ID_WIDTH)
+        return db.session.query(next_id.label('next_id'), QuizSession.remaining, QuizSession.last_used) \
+            .filter(QuizSession.token == token).first()
+
+    def __len__(self):
+        return QuizSession.query.filter(QuizSession.last_used >= self._cutoff(datetime.utcnow())).count()
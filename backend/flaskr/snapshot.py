@@ -0,0 +1,191 @@
+'''
+Optional in-memory snapshot of the whole question bank, turned on with SNAPSHOT_ENABLED. The
+questions are loaded once into column-oriented arrays (ids, categories and difficulties as typed
+arrays, question and answer texts as one UTF-8 blob each plus offsets), with the positions of each
+category's questions in a per-category array. The read routes then page, count and look up
+questions without touching the database. A snapshot is never modified: a refresh builds a new one
+and swaps it in with a single assignment, so readers always see a whole snapshot.
+
+About 9 MB per 100k questions of ~60 characters, against ~35 MB for the same rows as dicts of strings.
+'''
+
+import sys
+import threading
+from array import array
+from bisect import bisect_right
+
+# stored for questions without a category, their category was deleted
+NO_CATEGORY = -1
+
+
+class _Columns:
+    ''' One immutable snapshot of the questions and categories, ids are 32 bit like the integer columns '''
+
+    def __init__(self, version):
+        self.version = version
+        self.ids = array('i')
+        self.categories = array('i')
+        self.difficulties = array('i')
+        self.question_offsets = array('I', [0])
+        self.answer_offsets = array('I', [0])
+        self.question_text = b''
+        self.answer_text = b''
+        # category id -> positions of its questions, in id order
+        self.by_category = {}
+        # category id -> type
+        self.category_types = {}
+
+
+class QuestionSnapshot:
+    ''' Serves question pages, counts and lookups from the current snapshot '''
+
+    def __init__(self):
+        self._columns = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        ''' Dataset version the current snapshot was loaded at, None before the first load '''
+        columns = self._columns
+        return columns.version if columns is not None else None
+
+    @property
+    def lock(self):
+        ''' Held while a snapshot is being loaded, so concurrent refreshes load only once, the others keep
+        reading the current snapshot '''
+        return self._lock
+
+    def load(self, rows, categories, version):
+        ''' Builds a new snapshot and swaps it in
+
+        :param rows: iterable of (id, question, answer, category, difficulty) tuples, ordered by id
+        :param categories: iterable of (category id, type) pairs
+        :param version: dataset version the rows were read at
+        '''
+        columns = _Columns(version)
+        question_text = bytearray()
+        answer_text = bytearray()
+        by_category = {}
+
+        for position, (question_id, question, answer, category, difficulty) in enumerate(rows):
+            category = NO_CATEGORY if category is None else int(category)
+            columns.ids.append(question_id)
+            columns.categories.append(category)
+            columns.difficulties.append(difficulty or 0)
+            question_text += (question or '').encode('utf-8')
+            answer_text += (answer or '').encode('utf-8')
+            columns.question_offsets.append(len(question_text))
+            columns.answer_offsets.append(len(answer_text))
+            by_category.setdefault(category, array('I')).append(position)
+
+        columns.question_text = bytes(question_text)
+        columns.answer_text = bytes(answer_text)
+        columns.by_category = by_category
+        columns.category_types = dict(sorted(categories))
+
+        self._columns = columns
+
+    def _current(self):
+        if self._columns is None:
+            raise RuntimeError('the question snapshot is not loaded')
+        return self._columns
+
+    @property
+    def category_types(self):
+        ''' Dict of category id -> type, callers must not modify it '''
+        return self._current().category_types
+
+    def id_category_pairs(self):
+        ''' Yields (question id, category id) of every question, to load the quiz index from '''
+        columns = self._current()
+        for question_id, category in zip(columns.ids, columns.categories):
+            yield question_id, None if category == NO_CATEGORY else category
+
+    @staticmethod
+    def _question(columns, position):
+        category = columns.categories[position]
+        return {
+            'id': columns.ids[position],
+            'question': columns.question_text[
+                columns.question_offsets[position]:columns.question_offsets[position + 1]].decode('utf-8'),
+            'answer': columns.answer_text[
+                columns.answer_offsets[position]:columns.answer_offsets[position + 1]].decode('utf-8'),
+            'category': None if category == NO_CATEGORY else category,
+            'difficulty': columns.difficulties[position],
+        }
+
+    @staticmethod
+    def _positions(columns, category_id):
+        if category_id is None:
+            return range(len(columns.ids))
+        return columns.by_category.get(category_id, ())
+
+    def count(self, category_id=None):
+        ''' Number of questions, in category_id if given '''
+        columns = self._current()
+        return len(self._positions(columns, category_id))
+
+    def page(self, per_page, page=1, after=None, category_id=None):
+        ''' Returns one page of question dicts ordered by id, like paginate_questions
+
+        :param per_page: questions per page
+        :param page: page number starting at 1, ignored if after is given
+        :param after: id of the last question already seen, the page starts after it
+        :param category_id: only return questions of this category
+        '''
+        columns = self._current()
+        positions = self._positions(columns, category_id)
+
+        if after is not None:
+            # positions are in id order, so binary search the first one with a larger id
+            low, high = 0, len(positions)
+            while low < high:
+                middle = (low + high) // 2
+                if columns.ids[positions[middle]] <= after:
+                    low = middle + 1
+                else:
+                    high = middle
+            start = low
+        else:
+            start = (page - 1) * per_page
+
+        return [self._question(columns, position) for position in positions[start:start + per_page]]
+
+    def question(self, question_id):
+        ''' Returns one question dict by id, or None if it isn't in the snapshot '''
+        columns = self._current()
+        position = bisect_right(columns.ids, question_id) - 1
+        if position < 0 or columns.ids[position] != question_id:
+            return None
+        return self._question(columns, position)
+
+    def questions_by_id(self, question_ids):
+        ''' Returns a dict of question id -> question dict for the ids in the snapshot, like fetch_questions_by_id '''
+        found = {}
+        for question_id in question_ids:
+            question = self.question(question_id)
+            if question is not None:
+                found[question_id] = question
+        return found
+
+    def memory_bytes(self):
+        ''' Approximate bytes held by the current snapshot '''
+        columns = self._columns
+        if columns is None:
+            return 0
+        total = sum(sys.getsizeof(column) for column in (
+            columns.ids, columns.categories, columns.difficulties, columns.question_offsets,
+            columns.answer_offsets, columns.question_text, columns.answer_text, columns.by_category))
+        total += sum(sys.getsizeof(positions) for positions in columns.by_category.values())
+        return total
+
+    def stats(self):
+        ''' Size of the current snapshot, for monitoring '''
+        columns = self._columns
+        return {
+            'loaded': columns is not None,
+            'version': self.version,
+            'questions': len(columns.ids) if columns is not None else 0,
+            'categories': len(columns.category_types) if columns is not None else 0,
+            'memory_bytes': self.memory_bytes()
+        }
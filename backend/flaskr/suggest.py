@@ -0,0 +1,189 @@
+'''
+In-process prefix index over question text, used by GET /questions/suggest for type-ahead.
+Every word of every question is normalized and kept in one sorted list of (token, question id)
+pairs, so all questions with a word starting with a prefix are found with a binary search,
+without going to the database.
+'''
+
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left, insort
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    ''' Splits text into lower-case word tokens, e.g. "Who's the Boss?" -> ['who', 's', 'the', 'boss'] '''
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+
+class PrefixIndex:
+    ''' Sorted array of (token, question id) pairs plus the question text to return '''
+
+    def __init__(self, ttl=None):
+        ''' Creates an empty index
+
+        :param ttl: seconds after which the index is considered stale and should be reloaded,
+        None means it never goes stale on its own
+        '''
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # held by the one thread reloading the index, the others keep using the current one
+        self._reload_lock = threading.Lock()
+        self._populated = False
+        self._entries = []
+        # question id -> question text, also tells us which tokens to remove on delete
+        self._questions = {}
+        self._loaded_at = None
+
+    def load(self, rows):
+        ''' Replaces the contents of the index
+
+        :param rows: iterable of (question id, question text) pairs
+        '''
+        questions = {}
+        entries = []
+        for question_id, text in rows:
+            questions[question_id] = text
+            # interning stores each distinct word once, however many questions use it
+            entries.extend((sys.intern(token), question_id) for token in set(tokenize(text)))
+        entries.sort()
+
+        with self._lock:
+            self._entries = entries
+            self._questions = questions
+            self._loaded_at = time.monotonic()
+            self._populated = True
+
+    @property
+    def populated(self):
+        ''' True once the index was loaded, even if it has gone stale since '''
+        return self._populated
+
+    def start_reload(self, wait=None):
+        ''' Claims the reload of a stale index, so only one caller at a time loads it
+
+        Other callers keep using the current index meanwhile and get False, except before the first load,
+        when there is nothing to use yet and they wait for the load in progress instead.
+
+        :param wait: whether to wait for a reload in progress, by default only if the index isn't populated
+        :return: True if the caller should now load the index and then call finish_reload
+        '''
+        if not self._reload_lock.acquire(blocking=not self._populated if wait is None else wait):
+            return False
+        if self.is_stale():
+            return True
+        # another caller reloaded it while we waited
+        self._reload_lock.release()
+        return False
+
+    def finish_reload(self):
+        ''' Lets the next stale check reload the index again, call it after start_reload returned True '''
+        self._reload_lock.release()
+
+    def invalidate(self):
+        ''' Makes the next is_stale call return True, for writes too large to apply one question at a time '''
+        self._loaded_at = None
+
+    def is_stale(self):
+        ''' True if the index was never loaded or is older than its ttl '''
+        if self._loaded_at is None:
+            return True
+        if self.ttl is None:
+            return False
+        return time.monotonic() - self._loaded_at > self.ttl
+
+    def add(self, question_id, text):
+        ''' Adds a newly created question to the index '''
+        with self._lock:
+            if question_id in self._questions:
+                return
+            self._questions[question_id] = text
+            for token in set(tokenize(text)):
+                insort(self._entries, (sys.intern(token), question_id))
+
+    def remove(self, question_id):
+        ''' Removes a deleted question from the index, unknown ids are ignored '''
+        with self._lock:
+            text = self._questions.pop(question_id, None)
+            if text is None:
+                return
+            for token in set(tokenize(text)):
+                position = bisect_left(self._entries, (token, question_id))
+                if position < len(self._entries) and self._entries[position] == (token, question_id):
+                    del self._entries[position]
+
+    def suggest(self, query, limit):
+        ''' Finds questions containing every word of query, the last word may be a prefix
+
+        :param query: text typed so far in the search box
+        :param limit: the most suggestions to return
+        :return: list of (question id, question text), in order of the word the prefix matched so the
+        shortest completions come first, or by id when several words were typed
+        '''
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        # the words before the last one are complete, so they must match exactly
+        *words, prefix = tokens
+
+        with self._lock:
+            matches = None
+            for word in words:
+                word_ids = set(self._scan(word, exact=True))
+                matches = word_ids if matches is None else matches & word_ids
+                if not matches:
+                    return []
+
+            if matches is not None:
+                # the complete words already narrowed it down, checking those few questions is cheaper
+                # than walking every token that starts with a short prefix
+                candidates = (question_id for question_id in sorted(matches)
+                              if any(token.startswith(prefix) for token in tokenize(self._questions[question_id])))
+            else:
+                candidates = self._scan(prefix)
+
+            suggestions = []
+            suggested = set()
+            for question_id in candidates:
+                if question_id in suggested:
+                    continue
+                suggested.add(question_id)
+                suggestions.append((question_id, self._questions[question_id]))
+                if len(suggestions) == limit:
+                    break
+
+            return suggestions
+
+    def _scan(self, prefix, exact=False):
+        ''' Yields the question ids having a token starting with prefix, or equal to it if exact '''
+        position = bisect_left(self._entries, (prefix,))
+        while position < len(self._entries):
+            token, question_id = self._entries[position]
+            if token != prefix and (exact or not token.startswith(prefix)):
+                return
+            yield question_id
+            position += 1
+
+    def memory_bytes(self):
+        ''' Approximate memory held by the index: the entry list and its tuples, each distinct token
+        once, and the question texts
+        '''
+        with self._lock:
+            size = sys.getsizeof(self._entries) + sys.getsizeof(self._questions)
+            if self._entries:
+                size += len(self._entries) * sys.getsizeof(self._entries[0])
+            size += sum(sys.getsizeof(token) for token in {token for token, _ in self._entries})
+            size += sum(sys.getsizeof(text) for text in self._questions.values())
+        return size
+
+    def stats(self):
+        ''' Size of the index, reported by GET /questions/suggest/stats '''
+        return {
+            'questions': len(self._questions),
+            'tokens': len(self._entries),
+            'memory_bytes': self.memory_bytes()
+        }
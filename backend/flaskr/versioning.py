@@ -0,0 +1,59 @@
+'''
+Dataset version counter. Every route that writes questions bumps a single counter row in the
+same transaction as its write, so all workers agree on the version. Read routes use it as their
+ETag and as part of their response cache keys: an unchanged version means an unchanged response.
+'''
+
+import time
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, DatasetVersion
+
+# id of the one row in dataset_version
+VERSION_ROW_ID = 1
+
+
+class VersionCounter:
+    ''' Reads and bumps the dataset version '''
+
+    def __init__(self, ttl=0):
+        ''' Creates the counter
+
+        :param ttl: seconds a version read from the database is trusted before reading it again. Writes
+        from this process are seen immediately, writes from other workers only after ttl seconds.
+        '''
+        self.ttl = ttl
+        self._version = None
+        self._checked_at = None
+
+    def current(self):
+        ''' Returns the current dataset version, creating the counter row if it doesn't exist yet '''
+        if self._checked_at is not None and time.monotonic() - self._checked_at <= self.ttl:
+            return self._version
+
+        version = db.session.query(DatasetVersion.version).filter(DatasetVersion.id == VERSION_ROW_ID).scalar()
+
+        if version is None:
+            try:
+                db.session.add(DatasetVersion(VERSION_ROW_ID))
+                db.session.commit()
+            except IntegrityError:
+                # another worker created it first
+                db.session.rollback()
+            version = db.session.query(DatasetVersion.version).filter(DatasetVersion.id == VERSION_ROW_ID).scalar()
+
+        self._version = version
+        self._checked_at = time.monotonic()
+        return version
+
+    def bump(self):
+        ''' Increments the version as part of the current transaction, the caller commits it '''
+        bumped = DatasetVersion.query.filter(DatasetVersion.id == VERSION_ROW_ID) \
+            .update({DatasetVersion.version: DatasetVersion.version + 1}, synchronize_session=False)
+
+        if bumped == 0:
+            db.session.add(DatasetVersion(VERSION_ROW_ID, version=1))
+
+        # read it again next time, after the caller committed
+        self._checked_at = None
@@ -0,0 +1,92 @@
+'''
+Worker warm-up. A freshly started worker has an empty connection pool, no cached categories or
+pages and no quiz or suggest index, so its first requests would each pay for a connect and a full
+index load. WarmUp opens the pooled connections and sends the hot read requests through the app
+once, before the worker takes traffic, and /readyz reports the worker ready only once that worked.
+'''
+
+import logging
+import threading
+import time
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db
+
+log = logging.getLogger(__name__)
+
+# read requests that load the caches and indexes the hot routes need, in order
+WARM_UP_REQUESTS = (
+    ('categories', 'GET', '/categories', None),
+    ('first page', 'GET', '/questions?page=1', None),
+    ('quiz index', 'POST', '/quizzes', {'previous_questions': [], 'quiz_category': {'type': 'click', 'id': 0}}),
+    ('suggest index', 'GET', '/questions/suggest?q=a', None),
+)
+
+
+def fill_pool(engine):
+    ''' Opens as many connections as the engine's pool keeps, then returns them to the pool
+
+    :return: number of connections opened
+    '''
+    size = getattr(engine.pool, 'size', None)
+    count = size() if callable(size) else 1
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+    return count
+
+
+class WarmUp:
+    ''' Warms up one worker and remembers whether it is ready '''
+
+    def __init__(self, app):
+        self.app = app
+        self.ready = False
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def run(self):
+        ''' Opens the pooled connections and sends the warm-up requests, once per worker
+
+        :return: True if the worker is ready, False if a step failed, the next call tries again
+        '''
+        with self._lock:
+            if self.ready:
+                return True
+
+            timings = {}
+            try:
+                with self.app.app_context():
+                    started = time.perf_counter()
+                    for engine in self.app.extensions['replica_router'].engines + [db.engine]:
+                        fill_pool(engine)
+                    timings['database pool'] = time.perf_counter() - started
+
+                client = self.app.test_client()
+                for name, method, path, body in WARM_UP_REQUESTS:
+                    started = time.perf_counter()
+                    response = client.open(path, method=method, json=body)
+                    if response.status_code != 200:
+                        raise RuntimeError('{} {} answered {}'.format(method, path, response.status_code))
+                    timings[name] = time.perf_counter() - started
+            except (SQLAlchemyError, RuntimeError) as error:
+                log.warning('warm-up failed: %s', error)
+                return False
+
+            self.timings = timings
+            self.ready = True
+            log.info('warmed up in %.3fs: %s', sum(timings.values()),
+                     ', '.join('{} {:.3f}s'.format(name, seconds) for name, seconds in timings.items()))
+            return True
+
+    def stats(self):
+        ''' Readiness and the seconds each warm-up step took, for /readyz '''
+        return {
+            'ready': self.ready,
+            'warm_up_seconds': {name: round(seconds, 4) for name, seconds in self.timings.items()}
+        }
@@ -0,0 +1,44 @@
+'''
+Gunicorn settings for wsgi:app. The app is imported once in the master (preload_app) and the
+workers are forked from it, so they start without importing anything. Each worker drops the
+database connections it inherited, then warms up (connection pool, categories, first question
+page, quiz and suggest indexes, the snapshot if enabled) before it accepts its first request.
+
+Every setting can be overridden from the environment:
+    PORT / BIND, WEB_CONCURRENCY (workers), GUNICORN_THREADS (threads per worker), GUNICORN_TIMEOUT
+'''
+
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:{}'.format(os.environ.get('PORT', '8000')))
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# threads let a worker overlap requests waiting on the database, keep them at or below DB_POOL_SIZE + DB_MAX_OVERFLOW
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+preload_app = True
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+accesslog = '-'
+
+
+def post_fork(server, worker):
+    ''' Drops the pooled connections copied from the master, a connection must not be shared by two processes '''
+    from models import db
+    from wsgi import app
+
+    with app.app_context():
+        db.engine.dispose()
+    app.extensions['replica_router'].dispose()
+
+
+def post_worker_init(worker):
+    ''' Warms up the worker before it starts accepting connections '''
+    from wsgi import app
+
+    warm_up = app.extensions['warm_up']
+    if warm_up.run():
+        worker.log.info('worker %s warmed up: %s', worker.pid, warm_up.stats()['warm_up_seconds'])
+    else:
+        worker.log.warning('worker %s started cold, /readyz retries the warm-up', worker.pid)
@@ -0,0 +1,24 @@
+--
+-- Full-text search for questions, used by POST /questions when the search_vector column exists.
+-- Run once against an existing database, e.g.:  psql trivia < migrations/001_question_search.sql
+--
+
+BEGIN;
+
+-- trigram index support, lets ILIKE '%term%' substring matches use an index
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE public.questions ADD COLUMN IF NOT EXISTS search_vector tsvector;
+
+UPDATE public.questions SET search_vector = to_tsvector('pg_catalog.english', coalesce(question, ''));
+
+-- keep search_vector in sync with the question text on every insert and update
+DROP TRIGGER IF EXISTS questions_search_vector_update ON public.questions;
+CREATE TRIGGER questions_search_vector_update
+    BEFORE INSERT OR UPDATE OF question ON public.questions
+    FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(search_vector, 'pg_catalog.english', question);
+
+CREATE INDEX IF NOT EXISTS questions_search_vector_idx ON public.questions USING gin (search_vector);
+CREATE INDEX IF NOT EXISTS questions_question_trgm_idx ON public.questions USING gin (question gin_trgm_ops);
+
+COMMIT;
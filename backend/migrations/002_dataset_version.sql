@@ -0,0 +1,16 @@
+--
+-- Write counter for the questions, bumped by every route that changes them. Read routes use it
+-- for their ETags and response cache keys. Tables created by db.create_all() already have it.
+-- Run once against an existing database, e.g.:  psql trivia < migrations/002_dataset_version.sql
+--
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.dataset_version (
+    id integer NOT NULL PRIMARY KEY,
+    version integer NOT NULL DEFAULT 0
+);
+
+INSERT INTO public.dataset_version (id, version) VALUES (1, 0) ON CONFLICT (id) DO NOTHING;
+
+COMMIT;
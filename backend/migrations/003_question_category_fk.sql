@@ -0,0 +1,31 @@
+--
+-- Makes questions.category an integer foreign key to categories.id and adds a (category, id) index,
+-- so listing a category and drawing quiz questions use index scans instead of a cast and a sequential
+-- scan. Safe to run on the trivia.psql dump, where the column is already an integer, and on databases
+-- created by older versions of models.py, where it was a varchar.
+-- Run once against an existing database, e.g.:  psql trivia < migrations/003_question_category_fk.sql
+--
+
+BEGIN;
+
+ALTER TABLE public.questions
+    ALTER COLUMN category TYPE integer USING NULLIF(category::text, '')::integer;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conrelid = 'public.questions'::regclass AND contype = 'f'
+    ) THEN
+        ALTER TABLE public.questions
+            ADD CONSTRAINT questions_category_fkey FOREIGN KEY (category)
+            REFERENCES public.categories(id) ON UPDATE CASCADE ON DELETE SET NULL;
+    END IF;
+END
+$$;
+
+CREATE INDEX IF NOT EXISTS ix_questions_category_id ON public.questions (category, id);
+
+ANALYZE public.questions;
+
+COMMIT;
@@ -0,0 +1,27 @@
+--
+-- Number of questions per category and difficulty, kept up to date by the routes that add and delete
+-- questions, so listings read their totals from here instead of counting rows. Category and difficulty
+-- 0 stand for questions without one. Tables created by `flask init-db` already have it.
+-- Run once against an existing database, e.g.:  psql trivia < migrations/004_question_counts.sql
+-- Running it again recounts every category, e.g. after categories were deleted by hand.
+--
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.question_counts (
+    category integer NOT NULL,
+    difficulty integer NOT NULL,
+    count integer NOT NULL DEFAULT 0,
+    PRIMARY KEY (category, difficulty)
+);
+
+LOCK TABLE public.questions IN SHARE MODE;
+
+DELETE FROM public.question_counts;
+
+INSERT INTO public.question_counts (category, difficulty, count)
+SELECT COALESCE(category, 0), COALESCE(difficulty, 0), count(*)
+FROM public.questions
+GROUP BY 1, 2;
+
+COMMIT;
@@ -0,0 +1,22 @@
+--
+-- Quiz session decks, shared by every worker so a session started on one can be played on any other.
+-- Each row is a shuffled deck of question ids, each zero-padded to 10 characters, the remaining count says
+-- how far it has been played. The deck is stored uncompressed, so reading one id doesn't read all of it.
+-- Tables created by `flask init-db` already have it.
+-- Run once against an existing database, e.g.:  psql trivia < migrations/005_quiz_sessions.sql
+--
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.quiz_sessions (
+    token character varying(32) NOT NULL PRIMARY KEY,
+    deck text NOT NULL,
+    remaining integer NOT NULL,
+    last_used timestamp without time zone NOT NULL
+);
+
+ALTER TABLE public.quiz_sessions ALTER COLUMN deck SET STORAGE EXTERNAL;
+
+CREATE INDEX IF NOT EXISTS ix_quiz_sessions_last_used ON public.quiz_sessions (last_used);
+
+COMMIT;
@@ -1,35 +1,84 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, String, Integer, Text, DateTime, ForeignKey, Index, DDL, create_engine, event
+from sqlalchemy import orm
+from sqlalchemy.sql.expression import Select, CompoundSelect
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
-import sys
 import os
 
-db_username = os.environ['DB_USERNAME']
-db_password = os.environ["DB_PASSWORD"]
-db_host = os.environ["DB_HOST"]
 
-# from https://stackoverflow.com/a/63742743/3255525, check if unittest is running, use test db if so
-if 'unittest' in sys.modules.keys():
-    database_name = os.environ["DB_TEST"]
-else:
-    database_name = os.environ["DB_NAME"]
+def database_url(environ=os.environ):
+    ''' Returns the database URL from the environment, read when an app is set up and not at import time
 
-database_path = "postgresql://{}:{}@{}/{}".format(db_username, db_password, db_host, database_name)
+    DATABASE_URL is used as is if set, e.g. sqlite:////tmp/trivia.db, otherwise a Postgres URL is built from
+    DB_USERNAME, DB_PASSWORD, DB_HOST and DB_NAME.
 
-db = SQLAlchemy()
+    :param environ: mapping to read the variables from
+    '''
+    if environ.get('DATABASE_URL'):
+        return environ['DATABASE_URL']
+    return "postgresql://{}:{}@{}/{}".format(
+        environ['DB_USERNAME'], environ['DB_PASSWORD'], environ['DB_HOST'], environ['DB_NAME'])
+
+
+# connection pool settings, each one is only passed to the engine when its variable is set
+ENGINE_OPTION_VARIABLES = (
+  ('DB_POOL_SIZE', 'pool_size', int),
+  ('DB_MAX_OVERFLOW', 'max_overflow', int),
+  ('DB_POOL_TIMEOUT', 'pool_timeout', int),
+  ('DB_POOL_RECYCLE', 'pool_recycle', int),
+  ('DB_POOL_PRE_PING', 'pool_pre_ping', lambda value: value.lower() in ('1', 'true', 'yes', 'on')),
+)
+
+
+def engine_options(environ=os.environ):
+    ''' Reads the connection pool settings from the DB_POOL_* environment variables
+
+    :param environ: mapping to read the variables from
+    :return: dict of keyword arguments for create_engine
+    '''
+    options = {}
+    for variable, option, convert in ENGINE_OPTION_VARIABLES:
+        if environ.get(variable):
+            options[option] = convert(environ[variable])
+    return options
+
+
+class RoutingSession(SignallingSession):
+  ''' Session that runs the SELECTs of a read-only request on the replica picked for it, in g.db_replica.
+  Everything else, and every request without a replica, uses the primary database. '''
+
+  def get_bind(self, mapper=None, clause=None):
+    replica = g.get('db_replica') if has_app_context() else None
+    if replica is not None and not self._flushing and isinstance(clause, (Select, CompoundSelect)):
+      return replica
+    return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+  def create_session(self, options):
+    return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service. The URI already in the app config is used,
+    or database_path, or else database_url() from the environment. Nothing connects to the database
+    until the first query, and no tables are created, see the init-db command for that.
 '''
-def setup_db(app, database_path=database_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+def setup_db(app, database_path=None):
+    if database_path is not None:
+        app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    elif not app.config.get("SQLALCHEMY_DATABASE_URI"):
+        app.config["SQLALCHEMY_DATABASE_URI"] = database_url()
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options())
     db.app = app
     db.init_app(app)
-    db.create_all()
 
 '''
 Question
@@ -37,11 +86,15 @@ Question
 '''
 class Question(db.Model):  
   __tablename__ = 'questions'
+  # category listings and quiz draws filter on category and order by id
+  __table_args__ = (
+    Index('ix_questions_category_id', 'category', 'id'),
+  )
 
   id = Column(Integer, primary_key=True)
   question = Column(String)
   answer = Column(String)
-  category = Column(String)
+  category = Column(Integer, ForeignKey('categories.id', onupdate='CASCADE', ondelete='SET NULL'))
   difficulty = Column(Integer)
 
   def __init__(self, question, answer, category, difficulty):
@@ -87,4 +140,63 @@ class Category(db.Model):
     return {
       'id': self.id,
       'type': self.type
-    }
\ No newline at end of file
+    }
+
+'''
+DatasetVersion
+    single row counting the writes to the questions, used for ETags and cache keys
+'''
+class DatasetVersion(db.Model):
+  __tablename__ = 'dataset_version'
+
+  id = Column(Integer, primary_key=True)
+  version = Column(Integer, nullable=False, default=0)
+
+  def __init__(self, id, version=0):
+    self.id = id
+    self.version = version
+
+'''
+QuestionCount
+    number of questions per category and difficulty, kept up to date by the routes that write questions
+    so listings don't have to count rows. Category and difficulty 0 stand for questions without one.
+'''
+class QuestionCount(db.Model):
+  __tablename__ = 'question_counts'
+
+  category = Column(Integer, primary_key=True, autoincrement=False)
+  difficulty = Column(Integer, primary_key=True, autoincrement=False)
+  count = Column(Integer, nullable=False, default=0)
+
+  def __init__(self, category, difficulty, count=0):
+    self.category = category
+    self.difficulty = difficulty
+    self.count = count
+
+# characters each question id takes in a quiz session deck, enough for any 32 bit id
+DECK_ID_WIDTH = 10
+
+'''
+QuizSession
+    shuffled deck of a quiz session, shared by every worker. The deck is the question ids zero-padded to
+    DECK_ID_WIDTH characters each, never rewritten, so the next question is read with one substr at
+    position remaining - 1 however long the deck is.
+'''
+class QuizSession(db.Model):
+  __tablename__ = 'quiz_sessions'
+
+  token = Column(String(32), primary_key=True)
+  deck = Column(Text, nullable=False)
+  remaining = Column(Integer, nullable=False)
+  last_used = Column(DateTime, nullable=False, index=True)
+
+  def __init__(self, token, deck, remaining, last_used):
+    self.token = token
+    self.deck = deck
+    self.remaining = remaining
+    self.last_used = last_used
+
+
+# uncompressed, so Postgres reads just the characters substr asks for instead of the whole deck
+event.listen(QuizSession.__table__, 'after_create',
+             DDL('ALTER TABLE quiz_sessions ALTER COLUMN deck SET STORAGE EXTERNAL').execute_if(dialect='postgresql'))
@@ -1,11 +1,23 @@
+import asyncio
+import gzip
 import os
+import tempfile
+import threading
+import time
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+from unittest import mock
+from flask import jsonify
+from sqlalchemy import create_engine, event
 from sqlalchemy.exc import SQLAlchemyError
 
-from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr import asgi, create_app
+from flaskr import serializers
+from flaskr.admission import BUDGET_FULL, ConcurrencyLimit, DEADLINE, admission_limits
+from flaskr.queries import fetch_questions, select_questions
+from flaskr.sessions import QuizSessionStore
+from flaskr.snapshot import QuestionSnapshot
+from models import db, Question, Category
 
 # MAKE SURE this is the same as QUESTIONS_PER_PAGE in __init.py__
 QUESTIONS_PER_PAGE = 10
@@ -16,21 +28,13 @@ class TriviaTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
-        self.client = self.app.test_client
         self.database_name = "trivia_test"
-        self.database_path = "postgresql://{}:{}@{}/{}".format('postgres',
-                                                               'postgres',
-                                                               'localhost:5432',
-                                                               self.database_name)
-        setup_db(self.app, self.database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            # self.db.create_all()
+        # TEST_DATABASE_URL can point at any copy of the trivia test database, e.g. a SQLite file
+        self.database_path = os.environ.get('TEST_DATABASE_URL') or "postgresql://{}:{}@{}/{}".format(
+            'postgres', 'postgres', 'localhost:5432', self.database_name)
+        # the app only connects on the first query, so creating one per test is cheap
+        self.app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path})
+        self.client = self.app.test_client
     
     def tearDown(self):
         """Executed after each test"""
@@ -70,6 +74,114 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(len(data['questions']), page2_questions)
         self.assertEqual(data['total_questions'], total_questions)
 
+    def test_questions_with_cursor(self):
+        """Test that the next_cursor from page 1 returns the same questions as page 2
+
+        """
+        result = self.client().get('/questions')
+        data = json.loads(result.data)
+        self.assertTrue(data['next_cursor'])
+
+        by_cursor = json.loads(self.client().get('/questions?after=' + data['next_cursor']).data)
+        by_page = json.loads(self.client().get('/questions?page=2').data)
+
+        self.assertEqual(by_cursor['questions'], by_page['questions'])
+        self.assertEqual(by_cursor['total_questions'], 19)
+        self.assertIsNone(by_cursor['next_cursor'])
+
+    def test_questions_with_bad_cursor(self):
+        """Test that a cursor we did not hand out is rejected with a 400
+
+        """
+        result = self.client().get('/questions?after=not-a-cursor')
+
+        self.assertEqual(result.status_code, 400)
+
+    def test_questions_not_modified(self):
+        """Test that /questions sends an ETag and answers 304 when the client already has it
+
+        """
+        result = self.client().get('/questions?page=2')
+        etag = result.headers['ETag']
+
+        cached = self.client().get('/questions?page=2', headers={'If-None-Match': etag})
+
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.data, b'')
+        self.assertEqual(cached.headers['ETag'], etag)
+
+    def test_large_responses_are_compressed_once(self):
+        """Test that large listings are sent gzip compressed to clients accepting it, and compressed only once
+
+        """
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'COMPRESSION_MIN_SIZE': 512})
+        response_cache = app.extensions['response_cache']
+
+        with app.test_client() as client:
+            plain = client.get('/questions?page=1')
+            self.assertNotIn('Content-Encoding', plain.headers)
+            self.assertIn('Accept-Encoding', plain.headers['Vary'])
+            cached_bodies = len(response_cache)
+
+            compressed = client.get('/questions?page=1', headers={'Accept-Encoding': 'gzip, deflate'})
+            self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(compressed.data), plain.data)
+            self.assertLess(len(compressed.data), len(plain.data))
+            self.assertEqual(compressed.headers['ETag'], 'W/' + plain.headers['ETag'])
+            self.assertEqual(len(response_cache), cached_bodies + 1)
+
+            again = client.get('/questions?page=1', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(again.data, compressed.data)
+            self.assertEqual(len(response_cache), cached_bodies + 1)
+
+            # the weak ETag still matches, and small bodies or refused encodings are sent as they are
+            not_modified = client.get('/questions?page=1', headers={'If-None-Match': compressed.headers['ETag']})
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertNotIn('Content-Encoding', client.get('/categories', headers={'Accept-Encoding': 'gzip'}).headers)
+            self.assertNotIn('Content-Encoding', client.get('/questions?page=1',
+                                                            headers={'Accept-Encoding': 'gzip;q=0'}).headers)
+
+    def test_get_serializer_selection(self):
+        """Test that get_serializer picks orjson or the standard library, and rejects what it can't use
+
+        """
+        self.assertIs(serializers.get_serializer('stdlib'), serializers.stdlib_dumps)
+        self.assertIs(serializers.get_serializer('auto'), serializers.orjson_dumps if serializers.orjson is not None
+                      else serializers.stdlib_dumps)
+        with self.assertRaises(ValueError):
+            serializers.get_serializer('pickle')
+
+        with mock.patch.object(serializers, 'orjson', None):
+            self.assertIs(serializers.get_serializer('auto'), serializers.stdlib_dumps)
+            with self.assertRaises(ValueError):
+                serializers.get_serializer('orjson')
+
+    def test_json_response_decodes_like_jsonify(self):
+        """Test that the listing routes' serializers encode the same JSON as jsonify, int category keys included
+
+        """
+        names = ['stdlib'] + (['orjson'] if serializers.orjson is not None else [])
+
+        with self.app.app_context():
+            categories = dict(db.session.query(Category.id, Category.type))
+            data = {
+                'questions': fetch_questions(select_questions().order_by(Question.id)),
+                'total_questions': 19,
+                'categories': categories,
+                'category': categories[1],
+                'next_cursor': None
+            }
+            expected = json.loads(jsonify(data).get_data())
+            for name in names:
+                self.assertEqual(json.loads(serializers.get_serializer(name)(data)), expected, name)
+
+        paths = ['/categories', '/questions?page=1', '/categories/1/questions']
+        responses = {}
+        for name in names:
+            client = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'JSON_SERIALIZER': name}).test_client()
+            responses[name] = [json.loads(client.get(path).data) for path in paths]
+        self.assertEqual(responses['stdlib'], responses[names[-1]])
+
     def test_get_categories(self):
         ''' Tests that /categories returns a list of categories
 
@@ -81,6 +193,58 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(len(data['categories']), 6)
         self.assertEqual(data['categories'][0], 'Science')
 
+    def test_get_categories_cached(self):
+        ''' Tests that once the category cache is loaded, /categories runs no SQL at all
+
+        '''
+        self.client().get('/categories')
+
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.get_engine()
+        event.listen(engine, 'before_cursor_execute', count_statement)
+        try:
+            result = self.client().get('/categories')
+        finally:
+            event.remove(engine, 'before_cursor_execute', count_statement)
+
+        self.assertEqual(len(json.loads(result.data)['categories']), 6)
+        self.assertEqual(statements, [])
+
+    def test_category_stats(self):
+        """Test that /categories/stats counts the questions per category and difficulty
+
+        """
+        result = self.client().get('/categories/stats')
+        data = json.loads(result.data)
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['total_questions'], 19)
+        self.assertEqual(sum(data['difficulties'].values()), 19)
+        science = [category for category in data['categories'] if category['type'] == 'Science'][0]
+        self.assertEqual(science['total_questions'], 3)
+        self.assertEqual(sum(science['difficulties'].values()), 3)
+
+    def test_counts_without_counts_table(self):
+        """Test that the listings and /categories/stats count the questions on a database the counts migration
+        hasn't run on yet
+        """
+        with self.app.app_context():
+            db.engine.execute('ALTER TABLE question_counts RENAME TO question_counts_moved')
+        try:
+            self.assertEqual(json.loads(self.client().get('/questions').data)['total_questions'], 19)
+            self.assertEqual(json.loads(self.client().get('/categories/1/questions').data)['total_questions'], 3)
+            data = json.loads(self.client().get('/categories/stats').data)
+            self.assertEqual(data['total_questions'], 19)
+        finally:
+            with self.app.app_context():
+                db.session.remove()
+                db.engine.execute('ALTER TABLE question_counts_moved RENAME TO question_counts')
+
     def test_search_post_questions_how(self):
         ''' Tests for a positive search term 'how' that returns one question
 
@@ -118,6 +282,66 @@ class TriviaTestCase(unittest.TestCase):
             self.assertEqual(len(data['questions']), 0)
             self.assertEqual(data['questions'], [])
 
+    def test_search_post_questions_paginated(self):
+        ''' Tests that a search matching more than a page of questions returns them a page at a time when a
+        page is sent, and all at once, like the search box asks for them, when it isn't
+
+        '''
+        with self.app.test_client() as client:
+            every_match = json.loads(client.post('/questions', json={'searchTerm': 'the'}).data)
+            first_page = json.loads(client.post('/questions', json={'searchTerm': 'the', 'page': 1}).data)
+            second_page = json.loads(client.post('/questions', json={'searchTerm': 'the', 'page': 2}).data)
+
+            self.assertGreater(len(every_match['questions']), QUESTIONS_PER_PAGE)
+            self.assertEqual(len(every_match['questions']), every_match['total_questions'])
+            self.assertEqual(every_match['questions'], first_page['questions'] + second_page['questions'])
+            self.assertEqual(len(first_page['questions']), QUESTIONS_PER_PAGE)
+            self.assertEqual(first_page['total_questions'], second_page['total_questions'])
+            self.assertEqual(len(first_page['questions']) + len(second_page['questions']),
+                             first_page['total_questions'])
+
+    def test_suggest_questions_by_prefix(self):
+        ''' Tests that /questions/suggest completes the last word typed and matches the earlier ones
+
+        '''
+        result = self.client().get('/questions/suggest?q=van%20go')
+        data = json.loads(result.data)
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['suggestions'],
+                         [{'id': 18, 'question': "How many paintings did Van Gogh sell in his lifetime?"}])
+
+    def test_suggest_questions_limit(self):
+        ''' Tests that /questions/suggest returns at most limit suggestions and reports its index size
+
+        '''
+        data = json.loads(self.client().get('/questions/suggest?q=w&limit=3').data)
+        self.assertEqual(len(data['suggestions']), 3)
+
+        stats = json.loads(self.client().get('/questions/suggest/stats').data)
+        self.assertEqual(stats['questions'], 19)
+        self.assertGreater(stats['memory_bytes'], 0)
+
+    def test_export_questions(self):
+        ''' Tests that /questions/export streams every question as one JSON object per line
+
+        '''
+        result = self.client().get('/questions/export')
+        lines = result.data.decode('utf-8').splitlines()
+
+        self.assertEqual(result.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(lines), 19)
+        self.assertEqual(json.loads(lines[0])['id'], 2)
+
+    def test_export_questions_by_category(self):
+        ''' Tests that /questions/export?category= only exports that category
+
+        '''
+        result = self.client().get('/questions/export?category=6')
+        questions = [json.loads(line) for line in result.data.decode('utf-8').splitlines()]
+
+        self.assertEqual([question['id'] for question in questions], [10, 11])
+
 # *************** Testing getting questions by category
 
     def test_questions_by_category_get(self):
@@ -131,6 +355,20 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(len(data['questions']), 2)
         self.assertEqual(data['questions'][0]['question'],
                          "Which is the only team to play in every soccer World Cup tournament?")
+        self.assertEqual(data['questions'][0]['category'], 6)
+
+    def test_questions_by_category_paginated(self):
+        ''' Tests that /categories/<int:id>/questions is paginated and counts the whole category
+
+        The History category has four questions, all on the first page
+        '''
+        first_page = json.loads(self.client().get('/categories/4/questions').data)
+        second_page = json.loads(self.client().get('/categories/4/questions?page=2').data)
+
+        self.assertEqual([question['id'] for question in first_page['questions']], [5, 9, 12, 23])
+        self.assertIsNone(first_page['next_cursor'])
+        self.assertEqual(second_page['questions'], [])
+        self.assertEqual(second_page['total_questions'], 4)
 
     def test_questions_by_category_negative_case(self):
         ''' Tests that a bad request to /categories/<int:id>/questions returns an error
@@ -143,6 +381,21 @@ class TriviaTestCase(unittest.TestCase):
 
         self.assertEqual(data['error'], 405)
 
+    def test_questions_by_category_unknown_category(self):
+        ''' Tests that /categories/<int:id>/questions returns a 404 for a category that doesn't exist
+
+        '''
+        result = self.client().get('/categories/1000/questions')
+        data = json.loads(result.data)
+
+        self.assertEqual(result.status_code, 404)
+        self.assertFalse(data['success'])
+
+        # a client sending the ETag of a real listing still learns the category doesn't exist
+        etag = self.client().get('/categories/1/questions').headers['ETag']
+        result = self.client().get('/categories/1000/questions', headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 404)
+
 # **************** Testing playing the game, both positive and negative
     def test_quizzes_post_play_game(self):
         ''' Tests /quizzes with POST that initially playing the game returns a question
@@ -167,6 +420,273 @@ class TriviaTestCase(unittest.TestCase):
             self.assertIn(data['question']['question'],
                              "Which country won the first ever soccer World Cup in 1930?, Which is the only team to play in every soccer World Cup tournament?")
 
+    def test_quizzes_post_all_questions_used(self):
+        ''' Tests /quizzes returns no question once every question in the category was asked
+
+        '''
+        with self.app.test_client() as client:
+            to_send = {
+                'previous_questions': [10, 11],
+                'quiz_category': {
+                    "id": "5",
+                    'type': 'Sports'}
+            }
+            result = client.post(
+                '/quizzes',
+                json=to_send
+            )
+            data = json.loads(result.data)
+
+            self.assertIsNone(data['question'])
+
+    def test_quizzes_post_all_categories_skips_previous(self):
+        ''' Tests /quizzes with type "click" draws from all categories and never repeats a question
+
+        '''
+        with self.app.test_client() as client:
+            previous_questions = []
+            for _ in range(19):
+                result = client.post(
+                    '/quizzes',
+                    json={'previous_questions': previous_questions,
+                          'quiz_category': {'id': 0, 'type': 'click'}}
+                )
+                data = json.loads(result.data)
+                self.assertNotIn(data['question']['id'], previous_questions)
+                previous_questions.append(data['question']['id'])
+
+            result = client.post(
+                '/quizzes',
+                json={'previous_questions': previous_questions,
+                      'quiz_category': {'id': 0, 'type': 'click'}}
+            )
+            self.assertIsNone(json.loads(result.data)['question'])
+
+    def test_quizzes_batch_returns_distinct_unseen_questions(self):
+        ''' Tests /quizzes/batch returns count distinct questions, none of them previously asked
+
+        '''
+        with self.app.test_client() as client:
+            to_send = {
+                'previous_questions': [20],
+                'quiz_category': {'id': 0, 'type': 'click'},
+                'count': 5
+            }
+            result = client.post(
+                '/quizzes/batch',
+                json=to_send
+            )
+            data = json.loads(result.data)
+
+            question_ids = [question['id'] for question in data['questions']]
+            self.assertEqual(len(set(question_ids)), 5)
+            self.assertNotIn(20, question_ids)
+
+    def test_quizzes_batch_stops_when_category_runs_out(self):
+        ''' Tests /quizzes/batch returns fewer questions than asked for once the category runs out
+
+        '''
+        with self.app.test_client() as client:
+            to_send = {
+                'previous_questions': [10],
+                'quiz_category': {'id': '5', 'type': 'Sports'},
+                'count': 5
+            }
+            result = client.post(
+                '/quizzes/batch',
+                json=to_send
+            )
+            data = json.loads(result.data)
+
+            self.assertEqual([question['id'] for question in data['questions']], [11])
+
+    def test_quiz_session_plays_whole_category(self):
+        ''' Tests a quiz session deals every question of the category once, then returns None
+
+        '''
+        with self.app.test_client() as client:
+            result = client.post(
+                '/quizzes/sessions',
+                json={'quiz_category': {'id': '5', 'type': 'Sports'}}
+            )
+            data = json.loads(result.data)
+
+            self.assertTrue(data['success'])
+            self.assertEqual(data['total_questions'], 2)
+
+            next_url = '/quizzes/sessions/' + data['session_id'] + '/next'
+            asked = [json.loads(client.post(next_url).data)['question']['id'] for _ in range(2)]
+
+            self.assertEqual(sorted(asked), [10, 11])
+            self.assertIsNone(json.loads(client.post(next_url).data)['question'])
+
+    def test_quiz_session_shared_between_workers(self):
+        ''' Tests that a quiz session started on one worker can be played on another, and expires unused
+
+        '''
+        workers = [create_app({'SQLALCHEMY_DATABASE_URI': self.database_path}) for _ in range(2)]
+
+        data = json.loads(workers[0].test_client().post(
+            '/quizzes/sessions', json={'quiz_category': {'id': '5', 'type': 'Sports'}}).data)
+        next_url = '/quizzes/sessions/' + data['session_id'] + '/next'
+        asked = [json.loads(worker.test_client().post(next_url).data)['question']['id'] for worker in workers]
+
+        self.assertEqual(sorted(asked), [10, 11])
+        self.assertIsNone(json.loads(workers[0].test_client().post(next_url).data)['question'])
+
+        expiring = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'QUIZ_SESSION_TTL': 0})
+        data = json.loads(expiring.test_client().post(
+            '/quizzes/sessions', json={'quiz_category': {'id': '5', 'type': 'Sports'}}).data)
+        time.sleep(0.01)
+        result = expiring.test_client().post('/quizzes/sessions/' + data['session_id'] + '/next')
+        self.assertEqual(result.status_code, 404)
+
+    def test_quiz_session_previous_questions(self):
+        ''' Tests that a null previous_questions starts a whole deck, and a non-list is rejected with a 422
+
+        '''
+        with self.app.test_client() as client:
+            result = client.post('/quizzes/sessions', json={'quiz_category': {'id': '5', 'type': 'Sports'},
+                                                            'previous_questions': None})
+            self.assertEqual(json.loads(result.data)['total_questions'], 2)
+
+            result = client.post('/quizzes/sessions', json={'quiz_category': {'id': '5', 'type': 'Sports'},
+                                                            'previous_questions': 10})
+            self.assertEqual(result.status_code, 422)
+
+    def test_quiz_session_unknown_session(self):
+        ''' Tests that drawing from a session that doesn't exist returns a 404
+
+        '''
+        result = self.client().post('/quizzes/sessions/no-such-session/next')
+        data = json.loads(result.data)
+
+        self.assertEqual(result.status_code, 404)
+        self.assertFalse(data['success'])
+
+    def test_quiz_session_store_evicts_least_recently_used(self):
+        ''' Tests the session store drops the least recently used session once it is full
+
+        '''
+        store = QuizSessionStore(max_sessions=2, ttl=60)
+        first = store.create([1, 2])
+        second = store.create([3, 4])
+
+        # using the first session makes the second one the least recently used
+        self.assertEqual(store.pop(first), 2)
+        store.create([5, 6])
+
+        self.assertEqual(store.remaining(first), 1)
+        with self.assertRaises(KeyError):
+            store.pop(second)
+
+    def test_snapshot_memory_per_100k_questions(self):
+        ''' Tests the snapshot of 100k questions stays within the ~9 MB documented in flaskr/snapshot.py
+
+        '''
+        snapshot = QuestionSnapshot()
+        snapshot.load(((number, 'What is the name of the question number {} in this bank?'.format(number),
+                        'Answer {}'.format(number), number % 20 + 1, number % 5 + 1) for number in range(1, 100001)),
+                      [(category, 'Category {}'.format(category)) for category in range(1, 21)], version=1)
+
+        self.assertEqual(snapshot.count(), 100000)
+        self.assertEqual(snapshot.count(3), 5000)
+        self.assertEqual([question['id'] for question in snapshot.page(10, after=99995)],
+                         [99996, 99997, 99998, 99999, 100000])
+        self.assertLess(snapshot.memory_bytes(), 10 * 1024 * 1024)
+
+    def test_snapshot_keeps_any_integer_difficulty(self):
+        ''' Tests the snapshot stores difficulties outside of a byte, which /add_question doesn't reject
+
+        '''
+        snapshot = QuestionSnapshot()
+        snapshot.load([(1, 'Question?', 'Answer', 1, 300), (2, 'Question?', 'Answer', 1, -1000), (3, 'Q?', 'A', 1, None)],
+                      [(1, 'Science')], version=1)
+
+        self.assertEqual([question['difficulty'] for question in snapshot.page(10)], [300, -1000, 0])
+
+    def test_snapshot_serves_same_responses(self):
+        ''' Tests that with SNAPSHOT_ENABLED the listings and quizzes answer the same as from the database
+
+        '''
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'SNAPSHOT_ENABLED': True})
+
+        for path in ('/questions', '/questions?page=2', '/categories/1/questions', '/categories'):
+            expected = json.loads(self.client().get(path).data)
+            self.assertEqual(json.loads(app.test_client().get(path).data), expected)
+
+        data = json.loads(app.test_client().post('/quizzes', json={
+            'previous_questions': [20], 'quiz_category': {'type': 'Geography', 'id': '2'}}).data)
+        self.assertIn(data['question']['id'], [13, 14, 15])
+        self.assertEqual(app.extensions['snapshot'].stats()['questions'], 19)
+
+    def test_snapshot_served_while_another_request_reloads_it(self):
+        ''' Tests that a request finding a stale snapshot while another one is loading the new one serves the
+        current snapshot instead of waiting
+        '''
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'SNAPSHOT_ENABLED': True})
+        snapshot = app.extensions['snapshot']
+        self.assertEqual(json.loads(app.test_client().get('/questions').data)['total_questions'], 19)
+        loaded_version = snapshot.version
+
+        with snapshot.lock, mock.patch.object(app.extensions['dataset_version'], 'current',
+                                              return_value=loaded_version + 1):
+            data = json.loads(app.test_client().get('/questions').data)
+
+        self.assertEqual(data['total_questions'], 19)
+        self.assertEqual(snapshot.version, loaded_version)
+
+    @unittest.skipIf(asgi.asyncpg is None or asgi.WsgiToAsgi is None, 'needs the optional asyncpg and asgiref packages')
+    def test_asgi_routes_answer_like_flask(self):
+        ''' Tests that the async /questions, search and /quizzes answer the same JSON as the Flask routes
+
+        '''
+        if not self.database_path.startswith('postgresql'):
+            self.skipTest('the ASGI mode needs a Postgres database')
+
+        app = asgi.create_asgi_app({'SQLALCHEMY_DATABASE_URI': self.database_path})
+
+        async def call(method, path, query=b'', body=b'', headers=()):
+            messages = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+
+            async def send(message):
+                messages.append(message)
+
+            await app({'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'scheme': 'http',
+                       'method': method, 'path': path, 'root_path': '', 'query_string': query,
+                       'server': ('localhost', 80), 'headers': [(b'content-type', b'application/json'),
+                                                                (b'content-length', str(len(body)).encode())]
+                                                               + list(headers)},
+                      receive, send)
+            return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+        async def run():
+            try:
+                return [
+                    await call('GET', '/questions', b'page=2'),
+                    await call('POST', '/questions', body=b'{"searchTerm": "title"}'),
+                    await call('POST', '/quizzes',
+                               body=b'{"previous_questions": [20, 21], "quiz_category": {"type": "Science", "id": "0"}}'),
+                    await call('GET', '/questions', b'page=0'),
+                    await call('GET', '/questions', b'page=2', headers=[(b'accept-encoding', b'gzip')]),
+                ]
+            finally:
+                if app.pool is not None:
+                    await app.pool.close()
+
+        questions, search, quiz, bad_page, compressed = asyncio.run(run())
+
+        self.assertEqual(questions, (200, self.client().get('/questions?page=2').data))
+        self.assertEqual(json.loads(search[1]),
+                         json.loads(self.client().post('/questions', json={'searchTerm': 'title'}).data))
+        self.assertEqual(json.loads(quiz[1])['question']['id'], 22)
+        # requests the async handlers don't accept are answered by the Flask route
+        self.assertEqual(bad_page[0], 400)
+        self.assertEqual(gzip.decompress(compressed[1]), questions[1])
+
     def test_quizzes_play_with_wrong_request_type(self):
         ''' Tests whether a GET request to /quizzes fails
 
@@ -178,6 +698,210 @@ class TriviaTestCase(unittest.TestCase):
 
         self.assertFalse(data['success'])
 
+    def test_metrics_count_sql_per_route(self):
+        ''' Tests that /metrics reports the latency and SQL statements of the routes that were called
+
+        '''
+        self.client().get('/questions')
+        result = self.client().get('/metrics')
+        text = result.data.decode('utf-8')
+
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('trivia_request_duration_seconds_count{route="/questions",method="GET",status="200"} 1', text)
+        self.assertIn('trivia_request_sql_statements_count{route="/questions"} 1', text)
+
+    def test_metrics_record_streamed_response_once_sent(self):
+        ''' Tests that a streamed export is recorded after its body has been sent, with the queries it ran
+
+        '''
+        client = self.client()
+        result = client.get('/questions/export')
+        self.assertTrue(result.data)
+        self.assertNotIn('route="/questions/export"', client.get('/metrics').data.decode('utf-8'))
+
+        # the test client doesn't close streamed responses, a server does once the body has been sent
+        result.close()
+        text = client.get('/metrics').data.decode('utf-8')
+
+        self.assertIn('trivia_request_duration_seconds_count{route="/questions/export",method="GET",status="200"} 1',
+                      text)
+        self.assertIn('trivia_request_sql_statements_count{route="/questions/export"} 1', text)
+        self.assertNotIn('trivia_request_sql_statements_sum{route="/questions/export"} 0', text)
+
+    def test_admission_control_sheds_requests_over_the_limit(self):
+        """Test that a route class at its limit answers a fast 503 with Retry-After, and other routes still answer
+
+        """
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path,
+                          'ADMISSION_LIMITS': {'search': (1, 0, 0)}, 'ADMISSION_RETRY_AFTER': 2})
+        limit = app.extensions['admission'].limit('search')
+
+        with app.test_client() as client:
+            # another request holds the only slot
+            self.assertIsNone(limit.acquire())
+            try:
+                result = client.post('/questions', json={'searchTerm': 'title'})
+                self.assertEqual(result.status_code, 503)
+                self.assertEqual(result.headers['Retry-After'], '2')
+                self.assertEqual(json.loads(result.data)['error'], 503)
+                self.assertEqual(client.get('/categories').status_code, 200)
+            finally:
+                limit.release()
+
+            self.assertEqual(client.post('/questions', json={'searchTerm': 'title'}).status_code, 200)
+            self.assertIn('trivia_requests_shed_total{route_class="search",reason="queue_full"} 1',
+                          client.get('/metrics').data.decode('utf-8'))
+
+    def test_concurrency_limit_queue_and_deadline(self):
+        """Test that a waiting request gets the slot once it is released, or gives up at its deadline
+
+        """
+        limit = ConcurrencyLimit(1, 1, 0.05)
+        self.assertIsNone(limit.acquire())
+        self.assertEqual(limit.acquire(), DEADLINE)
+
+        limit.timeout = 5
+        waited = []
+        waiter = threading.Thread(target=lambda: waited.append(limit.acquire()))
+        waiter.start()
+        while limit.waiting == 0:
+            time.sleep(0.001)
+        limit.release()
+        waiter.join()
+
+        self.assertEqual(waited, [None])
+        self.assertEqual((limit.active, limit.waiting), (1, 0))
+
+    def test_admission_limits_leave_threads_free(self):
+        """Test that the limits derived from the threads per process leave a thread free in every class
+
+        """
+        for threads in range(2, 65):
+            for name, (concurrency, queue_size, _) in admission_limits(threads).items():
+                self.assertGreaterEqual(concurrency, 1)
+                self.assertLess(concurrency + queue_size, threads, (name, threads))
+
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'ADMISSION_THREADS': 8})
+        admission = app.extensions['admission']
+        self.assertEqual(admission.stats()['search'],
+                         {'active': 0, 'waiting': 0, 'concurrency': 2, 'queue_size': 2})
+
+        # all the classes together leave a thread free as well
+        held = []
+        for name in ('search', 'quiz', 'suggest', 'bulk'):
+            limit = admission.limit(name)
+            while limit.active < limit.concurrency and len(held) < 7:
+                self.assertIsNone(limit.acquire())
+                held.append(limit)
+        self.assertEqual(len(held), 7)
+        self.assertEqual(admission.limit('export').acquire(), BUDGET_FULL)
+        held.pop().release()
+        limit = admission.limit('export')
+        self.assertIsNone(limit.acquire())
+        held.append(limit)
+        for limit in held:
+            limit.release()
+        self.assertEqual(admission.budget.used, 0)
+
+    def test_stale_indexes_reloaded_by_one_request(self):
+        """Test that while one request reloads the stale suggest or quiz index, the others answer from the current one
+
+        """
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path})
+        client = app.test_client()
+        requests = {
+            'suggest_index': ('suggestions', lambda: client.get('/questions/suggest?q=van')),
+            'quiz_index': ('question', lambda: client.post('/quizzes', json={
+                'previous_questions': [], 'quiz_category': {'type': 'Sports', 'id': '5'}})),
+        }
+
+        for name, (key, send) in requests.items():
+            index = app.extensions[name]
+            self.assertEqual(send().status_code, 200)
+            index.invalidate()
+
+            # another request is reloading it
+            self.assertTrue(index.start_reload())
+            try:
+                with mock.patch.object(index, 'load') as load:
+                    result = send()
+                    self.assertEqual(result.status_code, 200)
+                    self.assertTrue(json.loads(result.data)[key])
+                    load.assert_not_called()
+            finally:
+                index.finish_reload()
+
+            send()
+            self.assertFalse(index.is_stale())
+
+    def test_readyz_warms_up_the_worker(self):
+        """Test that /readyz warms up the caches and indexes and reports ready, and /healthz answers without it
+
+        """
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path})
+
+        with app.test_client() as client:
+            self.assertEqual(json.loads(client.get('/healthz').data), {'success': True})
+            self.assertTrue(app.extensions['quiz_index'].is_stale())
+
+            result = client.get('/readyz')
+            data = json.loads(result.data)
+
+            self.assertEqual(result.status_code, 200)
+            self.assertTrue(data['ready'])
+            self.assertEqual(set(data['warm_up_seconds']),
+                             {'database pool', 'categories', 'first page', 'quiz index', 'suggest index'})
+            self.assertFalse(app.extensions['quiz_index'].is_stale())
+            self.assertFalse(app.extensions['suggest_index'].is_stale())
+            self.assertFalse(app.extensions['category_cache'].is_stale())
+            self.assertGreater(len(app.extensions['response_cache']), 0)
+
+    def test_readyz_without_database(self):
+        """Test that a worker that can't reach its database is alive but not ready
+
+        """
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:////nonexistent/trivia.db'})
+
+        with app.test_client() as client:
+            self.assertEqual(client.get('/healthz').status_code, 200)
+            result = client.get('/readyz')
+            self.assertEqual(result.status_code, 503)
+            self.assertFalse(json.loads(result.data)['ready'])
+
+    def test_server_timing_header(self):
+        ''' Tests that the Server-Timing header is only added when SERVER_TIMING is turned on
+
+        '''
+        self.assertNotIn('Server-Timing', self.client().get('/categories').headers)
+
+        self.app.config['SERVER_TIMING'] = True
+        result = self.client().get('/categories')
+
+        self.assertIn('db;dur=', result.headers['Server-Timing'])
+
+    def test_profile_request_on_header(self):
+        ''' Tests that with profiling enabled, a request with the token in X-Profile writes a pstats file and a
+        SQL trace, and that the header does nothing without the right token
+        '''
+        with tempfile.TemporaryDirectory() as profile_dir:
+            app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'PROFILING_ENABLED': True,
+                              'PROFILE_DIR': profile_dir, 'PROFILE_MAX_FILES': 1})
+            self.assertNotIn('X-Profile-Id', app.test_client().get('/questions', headers={'X-Profile': '1'}).headers)
+
+            app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'PROFILING_ENABLED': True,
+                              'PROFILE_DIR': profile_dir, 'PROFILE_MAX_FILES': 1, 'PROFILE_TOKEN': 'secret'})
+            self.assertNotIn('X-Profile-Id', app.test_client().get('/questions').headers)
+            self.assertNotIn('X-Profile-Id', app.test_client().get('/questions', headers={'X-Profile': '1'}).headers)
+            self.assertEqual(os.listdir(profile_dir), [])
+
+            for page in (1, 2):
+                result = app.test_client().get('/questions?page={}'.format(page), headers={'X-Profile': 'secret'})
+
+            profile_name = result.headers['X-Profile-Id']
+            self.assertEqual(sorted(os.listdir(profile_dir)), [profile_name + '.pstats', profile_name + '.sql.txt'])
+            with open(os.path.join(profile_dir, profile_name + '.sql.txt')) as trace:
+                self.assertIn('FROM questions', trace.read())
+
     # ************** Database modifying TESTS last! **************
 
     def test_add_delete_same_question(self):
@@ -219,6 +943,276 @@ class TriviaTestCase(unittest.TestCase):
             except SQLAlchemyError:
                 self.assertTrue(False)
 
+    def test_add_delete_question_changes_etag(self):
+        """Test that adding and deleting a question each change the ETag of /questions
+
+        """
+        with self.app.test_client() as client:
+            etags = [client.get('/questions').headers['ETag']]
+
+            result = client.post('/add_question', json={
+                'question': 'This is a test question',
+                'answer': 'This is a test answer',
+                'difficulty': '5',
+                'category': 0
+            })
+            created_question_id = json.loads(result.data)['id']
+            etags.append(client.get('/questions').headers['ETag'])
+
+            client.delete('/questions/' + str(created_question_id))
+            etags.append(client.get('/questions').headers['ETag'])
+
+            self.assertEqual(len(set(etags)), 3)
+            # the cached page must not be served once the question is gone
+            self.assertEqual(json.loads(client.get('/questions').data)['total_questions'], 19)
+
+    def test_add_delete_question_updates_stats(self):
+        """Test that adding and deleting a question adjust the stored counts
+
+        """
+        with self.app.test_client() as client:
+            result = client.post('/add_question', json={
+                'question': 'This is a test question',
+                'answer': 'This is a test answer',
+                'difficulty': '5',
+                'category': 0
+            })
+            created_question_id = json.loads(result.data)['id']
+
+            data = json.loads(client.get('/categories/stats').data)
+            science = [category for category in data['categories'] if category['id'] == 1][0]
+            self.assertEqual(data['total_questions'], 20)
+            self.assertEqual(science['total_questions'], 4)
+            self.assertEqual(json.loads(client.get('/categories/1/questions').data)['total_questions'], 4)
+
+            client.delete('/questions/' + str(created_question_id))
+            data = json.loads(client.get('/categories/stats').data)
+            self.assertEqual(data['total_questions'], 19)
+            self.assertEqual(json.loads(client.get('/categories/1/questions').data)['total_questions'], 3)
+
+    def test_read_replica_routing_and_read_your_writes(self):
+        """Test that read routes use the replica, and a client that just wrote reads from the primary
+
+        """
+        with tempfile.NamedTemporaryFile(suffix='.db') as replica_file:
+            replica_url = 'sqlite:///' + replica_file.name
+            replica = create_engine(replica_url)
+            db.metadata.create_all(replica)
+            replica.execute(Category.__table__.insert(), {'id': 1, 'type': 'Replica only'})
+
+            app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'DATABASE_REPLICA_URLS': replica_url,
+                              'CATEGORY_CACHE_TTL': 0, 'RESPONSE_CACHE_SIZE': 0})
+
+            with app.test_client() as client:
+                self.assertEqual(json.loads(client.get('/categories').data)['categories'], ['Replica only'])
+
+                result = client.post('/add_question', json={
+                    'question': 'This is a test question',
+                    'answer': 'This is a test answer',
+                    'difficulty': '5',
+                    'category': 0
+                })
+                created_question_id = json.loads(result.data)['id']
+
+                # the write went to the primary, and this client now reads from it
+                self.assertEqual(replica.execute('SELECT COUNT(*) FROM questions').scalar(), 0)
+                self.assertIn('Science', json.loads(client.get('/categories').data)['categories'])
+
+                client.delete('/questions/' + str(created_question_id))
+
+            # other clients keep reading from the replica
+            self.assertEqual(json.loads(app.test_client().get('/categories').data)['categories'], ['Replica only'])
+            replica.dispose()
+
+    def test_snapshot_quiz_session_on_other_worker(self):
+        """Test that with SNAPSHOT_ENABLED a worker that hasn't loaded the snapshot serves a quiz session started on
+        another one, and a worker that has doesn't deal a question another worker deleted
+        """
+        workers = [create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'SNAPSHOT_ENABLED': True})
+                   for _ in range(2)]
+        first, second = [worker.test_client() for worker in workers]
+        sports = {'id': '5', 'type': 'Sports'}
+
+        created_question_id = json.loads(first.post('/add_question', json={
+            'question': 'This is a test question',
+            'answer': 'This is a test answer',
+            'difficulty': '5',
+            'category': 5
+        }).data)['id']
+        try:
+            data = json.loads(first.post('/quizzes/sessions', json={'quiz_category': sports,
+                                                                    'previous_questions': [10, 11]}).data)
+            result = second.post('/quizzes/sessions/' + data['session_id'] + '/next')
+            self.assertEqual(result.status_code, 200)
+            self.assertEqual(json.loads(result.data)['question']['id'], created_question_id)
+
+            data = json.loads(first.post('/quizzes/sessions', json={'quiz_category': sports,
+                                                                    'previous_questions': [10, 11]}).data)
+            self.assertEqual(data['total_questions'], 1)
+        finally:
+            first.delete('/questions/' + str(created_question_id))
+
+        result = second.post('/quizzes/sessions/' + data['session_id'] + '/next')
+        self.assertIsNone(json.loads(result.data)['question'])
+
+    def test_snapshot_reloads_after_add_and_delete(self):
+        """Test that adding and deleting a question reload the snapshot served by /questions
+
+        """
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'SNAPSHOT_ENABLED': True})
+
+        with app.test_client() as client:
+            self.assertEqual(json.loads(client.get('/questions').data)['total_questions'], 19)
+
+            result = client.post('/add_question', json={
+                'question': 'This is a test question',
+                'answer': 'This is a test answer',
+                'difficulty': '5',
+                'category': 0
+            })
+            created_question_id = json.loads(result.data)['id']
+            data = json.loads(client.get('/categories/1/questions?page=1').data)
+            self.assertEqual(data['total_questions'], 4)
+            self.assertEqual(app.extensions['snapshot'].question(created_question_id)['answer'],
+                             'This is a test answer')
+
+            client.delete('/questions/' + str(created_question_id))
+            self.assertEqual(json.loads(client.get('/questions').data)['total_questions'], 19)
+            self.assertIsNone(app.extensions['snapshot'].question(created_question_id))
+
+    def test_bulk_import_ndjson(self):
+        """Test that /questions/bulk inserts the valid NDJSON rows in batches and reports the invalid ones
+
+        """
+        upload = '\n'.join([
+            json.dumps({'question': 'Bulk test question 1', 'answer': 'One', 'difficulty': 1, 'category': 1}),
+            json.dumps({'question': 'Bulk test question 2', 'answer': 'Two', 'difficulty': 9, 'category': 1}),
+            'not json',
+            json.dumps({'question': 'Bulk test question 3', 'answer': 'Three', 'difficulty': 3, 'category': 2}),
+        ])
+
+        try:
+            result = self.client().post('/questions/bulk?batch_size=1', data=upload,
+                                        content_type='application/x-ndjson')
+            data = json.loads(result.data)
+
+            self.assertFalse(data['success'])
+            self.assertEqual(data['inserted'], 2)
+            self.assertEqual(len(data['batches']), 2)
+            self.assertEqual([error['line'] for error in data['errors']], [2, 3])
+            self.assertEqual(json.loads(self.client().get('/questions').data)['total_questions'], 21)
+        finally:
+            with self.app.app_context():
+                Question.query.filter(Question.question.like('Bulk test%')).delete(synchronize_session=False)
+                # deleted behind the app's back, so the stored counts have to be recounted
+                self.app.extensions['question_counts'].rebuild()
+                db.session.commit()
+
+    def test_bulk_import_csv(self):
+        """Test that /questions/bulk reads CSV uploads with a header row
+
+        """
+        upload = 'question,answer,difficulty,category\n' \
+                 '"Bulk test, with a comma?",Yes,2,3\n'
+
+        try:
+            result = self.client().post('/questions/bulk', data=upload, content_type='text/csv')
+            data = json.loads(result.data)
+
+            self.assertTrue(data['success'])
+            self.assertEqual(data['inserted'], 1)
+        finally:
+            with self.app.app_context():
+                Question.query.filter(Question.question.like('Bulk test%')).delete(synchronize_session=False)
+                # deleted behind the app's back, so the stored counts have to be recounted
+                self.app.extensions['question_counts'].rebuild()
+                db.session.commit()
+
+    def test_bulk_import_rejects_non_integer_numbers(self):
+        """Test that /questions/bulk rejects fractional and boolean difficulties and categories instead of truncating them
+
+        """
+        upload = '\n'.join([
+            json.dumps({'question': 'Bulk test question 1', 'answer': 'One', 'difficulty': 3.7, 'category': 1}),
+            json.dumps({'question': 'Bulk test question 2', 'answer': 'Two', 'difficulty': True, 'category': 1}),
+            json.dumps({'question': 'Bulk test question 3', 'answer': 'Three', 'difficulty': 2, 'category': False}),
+        ])
+
+        result = self.client().post('/questions/bulk', data=upload, content_type='application/x-ndjson')
+        data = json.loads(result.data)
+
+        self.assertEqual(data['inserted'], 0)
+        self.assertEqual([error['error'] for error in data['errors']],
+                         ['difficulty must be an integer', 'difficulty must be an integer',
+                          'category must be an integer'])
+
+    def test_bulk_import_wrong_content_type(self):
+        """Test that /questions/bulk rejects uploads that are neither NDJSON nor CSV
+
+        """
+        result = self.client().post('/questions/bulk', json=[])
+
+        self.assertEqual(result.status_code, 415)
+
+    def test_bulk_update_and_delete_questions(self):
+        """Test that PATCH and DELETE /questions change many questions at once and keep the counts and quiz index
+
+        """
+        with self.app.test_client() as client:
+            try:
+                created_ids = [json.loads(client.post('/add_question', json={
+                    'question': 'Bulk test question {}'.format(number),
+                    'answer': 'Answer',
+                    'difficulty': '2',
+                    'category': 1
+                }).data)['id'] for number in range(3)]
+
+                result = client.patch('/questions', json={'ids': created_ids, 'set': {'category': 1, 'difficulty': 5}})
+                self.assertEqual(json.loads(result.data), {'success': True, 'updated': 3})
+
+                data = json.loads(client.get('/categories/stats').data)
+                science = [category for category in data['categories'] if category['id'] == 1][0]
+                art = [category for category in data['categories'] if category['id'] == 2][0]
+                self.assertEqual(science['total_questions'], 6)
+                self.assertEqual(science['difficulties']['5'], 3)
+                self.assertEqual(art['total_questions'], 4)
+                self.assertEqual(json.loads(client.get('/categories/1/questions').data)['total_questions'], 6)
+
+                # the moved questions are drawn for science once its own questions were asked
+                data = json.loads(client.post('/quizzes', json={
+                    'previous_questions': [20, 21, 22],
+                    'quiz_category': {'type': 'Science', 'id': 0}
+                }).data)
+                self.assertIn(data['question']['id'], created_ids)
+
+                result = client.delete('/questions', json={'category': 1, 'difficulty': 5})
+                self.assertEqual(json.loads(result.data), {'success': True, 'deleted': 3})
+
+                data = json.loads(client.get('/categories/stats').data)
+                self.assertEqual(data['total_questions'], 19)
+                self.assertNotIn('5', data['difficulties'])
+                self.assertEqual(json.loads(client.get('/questions').data)['total_questions'], 19)
+            finally:
+                with self.app.app_context():
+                    Question.query.filter(Question.question.like('Bulk test%')).delete(synchronize_session=False)
+                    self.app.extensions['question_counts'].rebuild()
+                    db.session.commit()
+
+    def test_bulk_update_and_delete_reject_invalid_requests(self):
+        """Test that a bulk PATCH or DELETE /questions without a valid selection or change changes nothing
+
+        """
+        with self.app.test_client() as client:
+            self.assertEqual(client.delete('/questions', json={}).status_code, 422)
+            self.assertEqual(client.delete('/questions', json={'ids': []}).status_code, 422)
+            self.assertEqual(client.delete('/questions', json={'difficulty': 9}).status_code, 422)
+            self.assertEqual(client.patch('/questions', json={'ids': [20], 'set': {'answer': 'No'}}).status_code, 422)
+            self.assertEqual(client.patch('/questions', json={'ids': [20], 'set': {'category': 999}}).status_code, 422)
+
+            result = client.delete('/questions', json={'ids': [100000]})
+            self.assertEqual(json.loads(result.data), {'success': True, 'deleted': 0})
+            self.assertEqual(json.loads(client.get('/questions').data)['total_questions'], 19)
+
     def test_add_a_question_failure(self):
         ''' Test that the wrong request type to adding a question fails
 
@@ -0,0 +1,10 @@
+'''
+Production entry point, the app a WSGI server imports. Run it with the settings in gunicorn.conf.py:
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The database settings come from the environment, see the Environment Variables in README.md.
+'''
+
+from flaskr import create_app
+
+app = create_app()